@@ -1,6 +1,10 @@
 from django.contrib import admin
-from .models import Clients
+from .models import Clients, PooledKey
 
 @admin.register(Clients)
 class ClientsAdmin(admin.ModelAdmin):
     list_display = ('user_id', 'vpn_id', 'name', 'password', 'port', 'method', 'access_url', 'created_at')
+
+@admin.register(PooledKey)
+class PooledKeyAdmin(admin.ModelAdmin):
+    list_display = ('vpn_id', 'access_url', 'created_at')
@@ -1,15 +1,18 @@
 # admin_handlers.py
+import asyncio
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ContextTypes, ConversationHandler
-from asgiref.sync import sync_to_async
-from django.conf import settings
-from bot.models import Clients
-from bot.vpn_service import create_vpn_key
+from telegram.ext import ContextTypes
+from bot import repository
+from bot.vpn_service import provision_vpn_key, revoke_keys
+from bot.settlement import KEY_REQUIRED, NOT_FOUND, SETTLED
+from bot.key_pool import rename_claimed_key
+from bot.scheduler import expiry_scheduler
 from mybot.settings import ADMIN_IDS
-from django.utils import timezone
-from dateutil.relativedelta import relativedelta
 from bot.instructions import INSTRUCTION_TEXT
+from bot.callbacks import Action, CallbackData, encode
+from bot.admin_notify import TARIFF_DISPLAY, admin_notifier, render_digest
+from bot.broadcast import OutgoingMessage
 
 
 logger = logging.getLogger(__name__)
@@ -17,18 +20,18 @@ logger = logging.getLogger(__name__)
 def get_tariff_keyboard(user_id):
     tariff_keyboard = [
         [
-            InlineKeyboardButton("1 месяц - 100р", callback_data=f"tariff_1month_{user_id}"),
-            InlineKeyboardButton("3 месяца - 250р", callback_data=f"tariff_3months_{user_id}")
+            InlineKeyboardButton("1 месяц - 100р", callback_data=encode(Action.TARIFF, user_id, 1)),
+            InlineKeyboardButton("3 месяца - 250р", callback_data=encode(Action.TARIFF, user_id, 3))
         ],
-        [InlineKeyboardButton("6 месяцев - 500р", callback_data=f"tariff_6months_{user_id}")]
+        [InlineKeyboardButton("6 месяцев - 500р", callback_data=encode(Action.TARIFF, user_id, 6))]
     ]
     return InlineKeyboardMarkup(tariff_keyboard)
 
 def get_payment_confirmation_keyboard(user_id, tariff_display, amount):
     keyboard = [
         [
-            InlineKeyboardButton(f"Платеж успешен ({amount}р, {tariff_display})", callback_data=f"payment_success_{user_id}"),
-            InlineKeyboardButton("Платеж не прошел", callback_data=f"payment_fail_{user_id}")
+            InlineKeyboardButton(f"Платеж успешен ({amount}р, {tariff_display})", callback_data=encode(Action.PAYMENT, user_id, True)),
+            InlineKeyboardButton("Платеж не прошел", callback_data=encode(Action.PAYMENT, user_id, False))
         ]
     ]
     return InlineKeyboardMarkup(keyboard)
@@ -37,16 +40,14 @@ async def notify_admin(user, context: ContextTypes.DEFAULT_TYPE):
     """
     Уведомляет админов о новой заявке.
     Если запись клиента уже создана, можно добавить информацию о выбранном тарифе.
+    Рассылка идёт в фоне (см. bot.admin_notify), обработчик пользователя её не ждёт.
     """
-    try:
-        client_obj = await sync_to_async(Clients.objects.get)(user_id=user.id)
-    except Clients.DoesNotExist:
-        client_obj = None
+    client_obj = await repository.get_client(user.id)
 
     admin_keyboard = [
         [
-            InlineKeyboardButton("Одобрить", callback_data=f"admin_approve_{user.id}"),
-            InlineKeyboardButton("Отклонить", callback_data=f"admin_reject_{user.id}")
+            InlineKeyboardButton("Одобрить", callback_data=encode(Action.ADMIN_DECISION, user.id, True)),
+            InlineKeyboardButton("Отклонить", callback_data=encode(Action.ADMIN_DECISION, user.id, False))
         ]
     ]
     admin_markup = InlineKeyboardMarkup(admin_keyboard)
@@ -58,18 +59,49 @@ async def notify_admin(user, context: ContextTypes.DEFAULT_TYPE):
         message += f"\nВыбранный тариф: {client_obj.tariff}"
     # Если клиент_obj отсутствует, не обращаемся к его атрибуту tariff
 
-    for admin_id in ADMIN_IDS:
-        try:
-            await context.bot.send_message(
-                chat_id=admin_id,
-                text=message,
-                reply_markup=admin_markup
-            )
-        except Exception as e:
-            logger.error(f"Ошибка при отправке уведомления админу {admin_id}: {e}")
+    admin_notifier.notify(context.application, message, admin_markup)
 
 
-async def handle_admin_decision(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+def tariffs_message(user_id: int) -> OutgoingMessage:
+    """Сообщение об одобрении заявки с выбором тарифа."""
+    return OutgoingMessage(
+        user_id,
+        "Ваша заявка одобрена 🤝!\nПожалуйста, выберите тариф для подключения ⬇️⬇️:",
+        get_tariff_keyboard(user_id),
+    )
+
+
+async def approve_request(user_id: int, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Одобряет заявку и ставит пользователю сообщение с тарифами в outbox.
+    Возвращает (успех, текст для администратора).
+    """
+    # === Получаем объект клиента ===
+    client_obj = await repository.get_client(user_id)
+    if client_obj is None:
+        logger.error(f"Клиент {user_id} не найден.")
+        return False, "Ошибка: заявка не найдена."
+
+   # === Ставим только статус, без .save(), иначе сработает renew_subscription() преждевременно ===
+    # Тарифы записываются в outbox той же транзакцией и уходят пользователю в фоне
+    updated = await repository.claim_pending(user_id, "approved", [tariffs_message(user_id)])
+    if not updated:
+        return False, "⚠️ Эту заявку уже обработал другой администратор."
+
+    logger.info(f"Заявка {user_id} одобрена, даты: {client_obj.subscription_start_date}–{client_obj.subscription_end_date}")
+    return True, "Заявка одобрена. Тарифы отправлены пользователю."
+
+
+async def reject_request(user_id: int, context: ContextTypes.DEFAULT_TYPE):
+    # простое обновление статуса, без логики дат; уведомление — через outbox
+    rejection = OutgoingMessage(user_id, "😪 Ваша заявка отклонена администрацией. Попробуйте в следующий раз .")
+    updated = await repository.claim_pending(user_id, "rejected", [rejection])
+    if not updated:
+        return False, "⚠️ Эту заявку уже обработал другой администратор."
+    return True, "Заявка отклонена и пользователь уведомлен."
+
+
+async def handle_admin_decision(update: Update, context: ContextTypes.DEFAULT_TYPE, data: CallbackData) -> None:
     if update.callback_query.from_user.id not in ADMIN_IDS:
         await update.callback_query.answer(
             "У вас нет прав для этого действия.", show_alert=True
@@ -79,168 +111,136 @@ async def handle_admin_decision(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
 
-    data = query.data.split("_")
-    if len(data) < 3:
-        await query.edit_message_text("Неверные данные заявки.")
-        return
+    approve, = data.args
+    if approve:
+        _, text = await approve_request(data.user_id, context)
+    else:
+        _, text = await reject_request(data.user_id, context)
+    await query.edit_message_text(text)
 
-    decision, user_id_str = data[1], data[2]
-    try:
-        user_id = int(user_id_str)
-    except ValueError:
-        await query.edit_message_text("Неверный ID пользователя.")
-        return
 
-    if decision == "approve":
-        # === Получаем объект клиента ===
-        try:
-            client_obj = await sync_to_async(Clients.objects.get)(user_id=user_id)
-        except Clients.DoesNotExist:
-            logger.error(f"Клиент {user_id} не найден.")
-            await query.edit_message_text("Ошибка: заявка не найдена.")
-            return ConversationHandler.END
-
-       # === Ставим только статус, без .save(), иначе сработает renew_subscription() преждевременно ===
-        updated = await sync_to_async(
-            Clients.objects.filter(user_id=user_id, status="pending").update
-        )(status="approved")
-        if not updated:
-            return await query.edit_message_text(
-                "⚠️ Эту заявку уже обработал другой администратор."
-            )
-
-        logger.info(f"Заявка {user_id} одобрена, даты: {client_obj.subscription_start_date}–{client_obj.subscription_end_date}")
-
-        # === Отправляем тарифы ===
-        tariff_markup = get_tariff_keyboard(user_id)
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="Ваша заявка одобрена 🤝!\nПожалуйста, выберите тариф для подключения ⬇️⬇️:",
-                reply_markup=tariff_markup
-            )
-            await query.edit_message_text("Заявка одобрена. Тарифы отправлены пользователю.")
-        except Exception as e:
-            logger.error(f"Ошибка при отправке тарифов пользователю: {e}")
-            await query.edit_message_text("Ошибка при отправке тарифов.")
-        return
+def payment_messages(settlement) -> list:
+    """Данные доступа для клиента после подтверждения оплаты; пишутся в outbox вместе с оплатой."""
+    text = (
+        "✅ Платёж подтверждён!\n\n"
+        f"Ваш VPN доступ активен до {settlement.subscription_end_date.strftime('%d.%m.%Y')}.\n\n"
+        f"{INSTRUCTION_TEXT}"
+    )
+    key_msg = (
+        "🔑 Ваш ключ для копирования(просто кликните на него, чтобы скопировать📲 ):\n"
+        f"```\n{settlement.access_url}\n```"
+    )
+    # Ключ идемпотентности — платёж клиента за конкретный период
+    event = f"paid:{settlement.user_id}:{settlement.subscription_start_date.isoformat()}"
+    return [
+        OutgoingMessage(settlement.user_id, text, key=f"{event}:1"),
+        OutgoingMessage(settlement.user_id, key_msg, parse_mode="Markdown", key=f"{event}:2"),
+    ]
 
-    elif decision == "reject":
-        # простое обновление статуса, без логики дат
-        updated = await sync_to_async(
-            Clients.objects.filter(user_id=user_id, status="pending").update
-        )(status="rejected")
-        if not updated:
-            return await query.edit_message_text(
-                "⚠️ Эту заявку уже обработал другой администратор."
-            )
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="😪 Ваша заявка отклонена администрацией. Попробуйте в следующий раз ."
-            )
-            await query.edit_message_text("Заявка отклонена и пользователь уведомлен.")
-        except Exception as e:
-            logger.error(f"Ошибка при уведомлении об отклонении: {e}")
-            await query.edit_message_text("Ошибка при уведомлении пользователя.")
-        return
 
-    else:
-        await query.edit_message_text("Неверное решение.")
-        return
+async def revoke_replaced_key(user_id: int, vpn_id: str) -> bool:
+    """Отзывает прежний ключ клиента, заменённый при оплате; неудача остаётся в логе для revoke_keys."""
+    revoked = (await revoke_keys([vpn_id])).get(vpn_id)
+    if not revoked:
+        logger.error(f"Прежний ключ клиента {user_id} не отозван, отзовите его: python manage.py revoke_keys {vpn_id}")
+    return bool(revoked)
 
-from django.db import transaction
 
-async def handle_payment_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def confirm_payment(user_id: int, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Подтверждает платёж; данные доступа уходят клиенту через outbox.
+    Возвращает (успех, текст для администратора).
+    """
+    # Статус, даты подписки, ключ и сообщения клиенту сохраняются одной транзакцией под блокировкой строки
+    settlement = await repository.mark_paid(user_id, messages=payment_messages)
+    if settlement.status == KEY_REQUIRED:
+        # Ключа ещё нет: создаём его вне транзакции и повторяем расчёт уже с ключом
+        client_obj = await repository.get_client(user_id)
+        if client_obj is None:
+            # Запись удалили между расчётом и чтением
+            logger.error(f"Клиент {user_id} не найден при подтверждении платежа.")
+            return False, "Ошибка: клиент не найден."
+        key_data = await provision_vpn_key(client_obj.name)
+        if not key_data:
+            return False, "Ошибка создания VPN-ключа."
+        settlement = await repository.mark_paid(user_id, key_data, messages=payment_messages)
+        if not settlement.key_used:
+            # Платёж успел обработать другой администратор — лишний ключ удаляем
+            await revoke_keys([str(key_data["id"])])
+
+    if settlement.status == NOT_FOUND:
+        return False, "Ошибка: клиент не найден."
+    if settlement.status != SETTLED:
+        return False, "⚠️ Этот платёж уже обработан другим администратором."
+    if settlement.key_from_pool:
+        context.application.create_task(rename_claimed_key(settlement.vpn_id, settlement.name))
+    if settlement.replaced_vpn_id:
+        context.application.create_task(revoke_replaced_key(user_id, settlement.replaced_vpn_id))
+    expiry_scheduler.schedule(user_id, settlement.subscription_end_date)
+    return True, "Платёж подтверждён, клиенту отправлены данные."
+
+
+async def fail_payment(user_id: int, context: ContextTypes.DEFAULT_TYPE):
+    # аналогично для отказа: только UPDATE и return, без повторного создания; уведомление — через outbox
+    failure = OutgoingMessage(user_id, "Платёж не прошёл ❌. Обратитесь в поддержку командой /help ⚙️.")
+    updated = await repository.mark_payment_failed(user_id, [failure])
+    if not updated:
+        return False, "⚠️ Этот платёж уже обработан другим администратором."
+    return True, "Платёж отклонён."
+
+
+async def handle_payment_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE, data: CallbackData) -> None:
     query = update.callback_query
     await query.answer()
-    _, result, user_id_str = query.data.split("_")
-    user_id = int(user_id_str)
 
     if query.from_user.id not in ADMIN_IDS:
         return await query.answer("Нет прав.", show_alert=True)
 
-    if result == "success":
-        # ———————————————  
-        # 1) Атомарно обновляем статус, только если он "awaiting_verification"
-        updated = await sync_to_async(
-            Clients.objects.filter(user_id=user_id, payment_status="awaiting_verification").update
-        )(payment_status="paid")
-        if not updated:
-            return await query.edit_message_text("⚠️ Этот платёж уже обработан другим администратором.")
-        # ———————————————
-
-        # 2) Перезагружаем свежий клиент из БД
-        client_obj = await sync_to_async(Clients.objects.get)(user_id=user_id)
-
-        # 3) Рассчитываем новый период подписки
-        months = {"1 месяц": 1, "3 месяца": 3, "6 месяцев": 6}.get(client_obj.tariff, 0)
-        today = timezone.now().date()
-        if client_obj.subscription_end_date and client_obj.subscription_end_date > today:
-            new_start = client_obj.subscription_end_date
-        else:
-            new_start = today
-        new_end = new_start + relativedelta(months=months)
-
-        # 4) Сохраняем даты в БД
-        await sync_to_async(
-            Clients.objects.filter(user_id=user_id).update
-        )(
-            subscription_start_date=new_start,
-            subscription_end_date=new_end
-        )
+    success, = data.args
+    if success:
+        _, text = await confirm_payment(data.user_id, context)
+    else:
+        _, text = await fail_payment(data.user_id, context)
+    await query.edit_message_text(text)
 
-        # 5) Загрузка обновлённого объекта (чтобы увидеть access_url)
-        client_obj = await sync_to_async(Clients.objects.get)(user_id=user_id)
-
-        # 6) Генерируем ключ **только если** его реально нет
-        if not client_obj.access_url:
-            key_data = await create_vpn_key(name=client_obj.name, user_id=client_obj.user_id)
-            if not key_data:
-                return await query.edit_message_text("Ошибка создания VPN-ключа.")
-            # Сохраняем параметры ключа
-            await sync_to_async(
-                Clients.objects.filter(user_id=user_id).update
-            )(
-                vpn_id=str(key_data["id"]),
-                access_url=key_data["accessUrl"],
-                password=key_data["password"],
-                port=key_data["port"],
-                method=key_data["method"]
-            )
-            access_url = key_data["accessUrl"]
-        else:
-            access_url = client_obj.access_url
-
-        # 7) Отправляем пользователю данные
-        text = (
-            "✅ Платёж подтверждён!\n\n"
-            f"Ваш VPN доступ активен до {new_end.strftime('%d.%m.%Y')}.\n\n"
-            f"{INSTRUCTION_TEXT}"
-        )
-        await context.bot.send_message(chat_id=user_id, text=text)
 
-        key_msg = (
-            "🔑 Ваш ключ для копирования(просто кликните на него, чтобы скопировать📲 ):\n"
-            f"```\n{access_url}\n```"
-        )
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=key_msg,
-            parse_mode="Markdown"
-        )
-        await query.edit_message_text("Платёж подтверждён, клиенту отправлены данные.")
+async def _bulk(action, user_ids, context):
+    results = await asyncio.gather(*(action(user_id, context) for user_id in user_ids), return_exceptions=True)
+    for user_id, result in zip(user_ids, results):
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка массовой обработки клиента {user_id}: {result}")
+    return sum(1 for result in results if not isinstance(result, Exception) and result[0])
+
+
+async def handle_bulk_action(update: Update, context: ContextTypes.DEFAULT_TYPE, data: CallbackData) -> None:
+    """Кнопки сводки: одобрить все показанные заявки или подтвердить все показанные платежи."""
+    query = update.callback_query
+    if query.from_user.id not in ADMIN_IDS:
+        return await query.answer("Нет прав.", show_alert=True)
+    await query.answer()
+
+    # Берём только записи, которые всё ещё ждут решения: остальные уже обработал кто-то другой
+    if data.action == Action.BULK_APPROVE:
+        # Одобрение — только смена статуса: одна транзакция на всю сводку, сколько бы заявок в ней ни было
+        approved = await repository.claim_pending_many(data.args, "approved", tariffs_message)
+        logger.info(f"Одобрены заявки: {approved}")
+        summary = f"Одобрено заявок: {len(approved)} из {len(data.args)}."
     else:
-        # аналогично для отказа: только UPDATE и return, без повторного создания
-        updated = await sync_to_async(
-            Clients.objects.filter(user_id=user_id, payment_status="awaiting_verification").update
-        )(payment_status="failed")
-        if not updated:
-            return await query.edit_message_text("⚠️ Этот платёж уже обработан другим администратором.")
-        await context.bot.send_message(chat_id=user_id, text="Платёж не прошёл ❌. Обратитесь в поддержку командой /help ⚙️.")
-        await query.edit_message_text("Платёж отклонён.")
+        # Каждому платежу нужен свой расчёт и ключ, поэтому стоимость растёт с числом платежей
+        user_ids = await repository.user_ids_by_pk(data.args, payment_status="awaiting_verification")
+        done = await _bulk(confirm_payment, user_ids, context)
+        summary = f"Подтверждено платежей: {done} из {len(data.args)}."
+    await query.edit_message_text(summary)
 
 
+async def handle_digest_page(update: Update, context: ContextTypes.DEFAULT_TYPE, data: CallbackData) -> None:
+    query = update.callback_query
+    if query.from_user.id not in ADMIN_IDS:
+        return await query.answer("Нет прав.", show_alert=True)
+    await query.answer()
+    text, markup = await render_digest(*data.args)
+    await query.edit_message_text(text, reply_markup=markup)
+
 
 async def notify_admin_payment(client_obj, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -248,12 +248,7 @@ async def notify_admin_payment(client_obj, context: ContextTypes.DEFAULT_TYPE):
     Сообщение включает выбранный тариф и сумму для оплаты.
     """
     # Определяем сумму и отображаемое название тарифа на основе выбранного тарифа
-    tariff_map = {
-        "1 месяц": ("1 месяц", "100р"),
-        "3 месяца": ("3 месяца", "250р"),
-        "6 месяцев": ("6 месяцев", "500р")
-    }
-    tariff_display, amount = tariff_map.get(client_obj.tariff, ("Неизвестно", "0"))
+    tariff_display, amount = TARIFF_DISPLAY.get(client_obj.tariff, ("Неизвестно", "0"))
     message = (
         f"Поступил платеж от пользователя {client_obj.name} (ID: {client_obj.user_id}).\n"
         f"Выбранный тариф: {tariff_display}.\n"
@@ -262,17 +257,9 @@ async def notify_admin_payment(client_obj, context: ContextTypes.DEFAULT_TYPE):
     )
     keyboard = [
         [
-            InlineKeyboardButton("Платеж успешен", callback_data=f"payment_success_{client_obj.user_id}"),
-            InlineKeyboardButton("Платеж не прошел", callback_data=f"payment_fail_{client_obj.user_id}")
+            InlineKeyboardButton("Платеж успешен", callback_data=encode(Action.PAYMENT, client_obj.user_id, True)),
+            InlineKeyboardButton("Платеж не прошел", callback_data=encode(Action.PAYMENT, client_obj.user_id, False))
         ]
     ]
     markup = InlineKeyboardMarkup(keyboard)
-    for admin_id in ADMIN_IDS:
-        try:
-            await context.bot.send_message(
-                chat_id=admin_id,
-                text=message,
-                reply_markup=markup
-            )
-        except Exception as e:
-            logger.error(f"Ошибка при отправке уведомления админу {admin_id}: {e}")
+    admin_notifier.notify(context.application, message, markup)
@@ -0,0 +1,135 @@
+# admin_notify.py Уведомления администраторов: фоновая рассылка и сводка при наплыве заявок
+import logging
+import time
+from collections import deque
+from django.conf import settings
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from bot import repository
+from bot.broadcast import Broadcaster, OutgoingMessage
+from bot.callbacks import Action, encode, max_items
+
+logger = logging.getLogger(__name__)
+
+TARIFF_DISPLAY = {
+    "1 месяц": ("1 месяц", "100р"),
+    "3 месяца": ("3 месяца", "250р"),
+    "6 месяцев": ("6 месяцев", "500р")
+}
+
+
+def digest_page_size() -> int:
+    # id всех записей страницы должны поместиться в callback_data кнопки массового действия
+    return max(1, min(settings.ADMIN_DIGEST_PAGE_SIZE, max_items(Action.BULK_CONFIRM)))
+
+
+async def render_digest(after_request: int = 0, after_payment: int = 0):
+    """
+    Страница сводки: заявки и платежи, ожидающие администратора, с кнопками
+    «одобрить все»/«подтвердить все» для показанных записей и переходом к следующей странице.
+    Возвращает (text, reply_markup).
+    """
+    requests, payments, more = await repository.pending_work_page(after_request, after_payment, digest_page_size())
+
+    lines = ["📋 Сводка необработанных заявок и платежей."]
+    if requests:
+        lines.append("\nЗаявки:")
+        lines += [f"• {client.name} (ID: {client.user_id})" for client in requests]
+    if payments:
+        lines.append("\nПлатежи:")
+        for client in payments:
+            tariff_display, amount = TARIFF_DISPLAY.get(client.tariff, ("Неизвестно", "0"))
+            lines.append(f"• {client.name} (ID: {client.user_id}) — {tariff_display}, {amount}")
+    if not requests and not payments:
+        lines.append("\nНичего не ожидает обработки.")
+
+    keyboard = []
+    if requests:
+        keyboard.append([InlineKeyboardButton(
+            f"✅ Одобрить заявки ({len(requests)})",
+            callback_data=encode(Action.BULK_APPROVE, 0, *(client.id for client in requests)),
+        )])
+    if payments:
+        keyboard.append([InlineKeyboardButton(
+            f"💳 Подтвердить платежи ({len(payments)})",
+            callback_data=encode(Action.BULK_CONFIRM, 0, *(client.id for client in payments)),
+        )])
+    navigation = []
+    if after_request or after_payment:
+        navigation.append(InlineKeyboardButton("⏮ В начало", callback_data=encode(Action.DIGEST_PAGE, 0, 0, 0)))
+    if more:
+        next_request = requests[-1].id if requests else after_request
+        next_payment = payments[-1].id if payments else after_payment
+        navigation.append(InlineKeyboardButton(
+            "Далее ▶️", callback_data=encode(Action.DIGEST_PAGE, 0, next_request, next_payment),
+        ))
+    if navigation:
+        keyboard.append(navigation)
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard) if keyboard else None
+
+
+class AdminNotifier:
+    """
+    Рассылает уведомления всем ADMIN_IDS в фоне, параллельно и с общим лимитом скорости,
+    не задерживая обработчик пользователя.
+
+    Если за последнюю минуту уведомлений больше ADMIN_DIGEST_THRESHOLD, включается режим сводки:
+    отдельные сообщения не отправляются, а раз в ADMIN_DIGEST_INTERVAL секунд администраторы получают
+    одну сводку (render_digest) со списком ожидающих заявок и платежей. Режим выключается,
+    когда поток уведомлений падает до половины порога.
+    """
+
+    def __init__(self, admin_ids=None, threshold=None, window: float = 60):
+        self.admin_ids = list(admin_ids if admin_ids is not None else settings.ADMIN_IDS)
+        self.threshold = threshold or settings.ADMIN_DIGEST_THRESHOLD
+        self.window = window
+        self.digest_mode = False
+        self.suppressed = 0
+        self._events = deque()
+        self._broadcaster = None
+
+    def _expire(self, now: float):
+        while self._events and self._events[0] <= now - self.window:
+            self._events.popleft()
+
+    def _record(self) -> bool:
+        now = time.monotonic()
+        self._events.append(now)
+        self._expire(now)
+        if not self.digest_mode and len(self._events) > self.threshold:
+            self.digest_mode = True
+            logger.warning(f"Уведомлений администраторам больше {self.threshold} в минуту, включён режим сводки")
+        return self.digest_mode
+
+    def broadcaster(self, bot) -> Broadcaster:
+        if self._broadcaster is None:
+            self._broadcaster = Broadcaster(bot)
+        return self._broadcaster
+
+    def notify(self, application, text: str, reply_markup=None) -> None:
+        """Ставит уведомление в фоновую рассылку и сразу возвращает управление."""
+        if self._record():
+            self.suppressed += 1
+            return
+        application.create_task(self.fan_out(application.bot, text, reply_markup))
+
+    async def fan_out(self, bot, text: str, reply_markup=None):
+        await self.broadcaster(bot).send_many(
+            OutgoingMessage(admin_id, text, reply_markup) for admin_id in self.admin_ids
+        )
+
+    async def send_digest(self, context):
+        """Задача JobQueue: в режиме сводки отправляет её, если с прошлого раза были новые события."""
+        self._expire(time.monotonic())
+        if not self.digest_mode:
+            return
+        if self.suppressed:
+            logger.info(f"Сводка администраторам вместо {self.suppressed} уведомлений")
+            self.suppressed = 0
+            text, markup = await render_digest()
+            await self.fan_out(context.bot, text, markup)
+        if len(self._events) <= self.threshold // 2:
+            self.digest_mode = False
+            logger.info("Поток уведомлений администраторам снизился, режим сводки выключен")
+
+
+admin_notifier = AdminNotifier()
@@ -0,0 +1,105 @@
+# admin_queue.py Команда /queue: необработанные заявки и платежи с действиями
+import logging
+from django.conf import settings
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import ContextTypes
+from bot import repository
+from bot.admin_handlers import approve_request, reject_request, confirm_payment, fail_payment
+from bot.admin_notify import TARIFF_DISPLAY
+from bot.callbacks import Action, CallbackData, encode
+from mybot.settings import ADMIN_IDS
+
+logger = logging.getLogger(__name__)
+
+QUEUE_APPROVE, QUEUE_REJECT, QUEUE_CONFIRM, QUEUE_FAIL = range(4)
+QUEUE_ACTIONS = {
+    QUEUE_APPROVE: approve_request,
+    QUEUE_REJECT: reject_request,
+    QUEUE_CONFIRM: confirm_payment,
+    QUEUE_FAIL: fail_payment,
+}
+
+
+async def render_queue(after_request: int = 0, after_payment: int = 0, notice: str = ""):
+    """
+    Экран /queue: общие счётчики (один сгруппированный запрос, кэшируется на QUEUE_TOTALS_TTL)
+    и страница заявок и платежей, читаемая по id (keyset), с кнопками действий для каждой записи.
+    Возвращает (text, reply_markup).
+    """
+    totals = await repository.pending_totals()
+    requests, payments, more = await repository.pending_work_page(
+        after_request, after_payment, settings.QUEUE_PAGE_SIZE
+    )
+
+    lines = [notice, ""] if notice else []
+    lines.append(f"🗂 Ожидают решения: заявок {totals['requests']}, платежей {totals['payments']}.")
+    if requests:
+        lines.append("\nЗаявки:")
+        lines += [f"• {client.name} (ID: {client.user_id})" for client in requests]
+    if payments:
+        lines.append("\nПлатежи:")
+        for client in payments:
+            tariff_display, amount = TARIFF_DISPLAY.get(client.tariff, ("Неизвестно", "0"))
+            lines.append(f"• {client.name} (ID: {client.user_id}) — {tariff_display}, {amount}")
+
+    def action(kind, client):
+        return encode(Action.QUEUE_ACTION, client.user_id, kind, after_request, after_payment)
+
+    keyboard = []
+    for client in requests:
+        keyboard.append([
+            InlineKeyboardButton(f"✅ {client.name}", callback_data=action(QUEUE_APPROVE, client)),
+            InlineKeyboardButton("❌ Отклонить", callback_data=action(QUEUE_REJECT, client)),
+        ])
+    for client in payments:
+        keyboard.append([
+            InlineKeyboardButton(f"💳 {client.name}", callback_data=action(QUEUE_CONFIRM, client)),
+            InlineKeyboardButton("✖️ Не прошёл", callback_data=action(QUEUE_FAIL, client)),
+        ])
+
+    navigation = []
+    if after_request or after_payment:
+        navigation.append(InlineKeyboardButton("⏮ В начало", callback_data=encode(Action.QUEUE_PAGE, 0, 0, 0)))
+    navigation.append(InlineKeyboardButton(
+        "🔄 Обновить", callback_data=encode(Action.QUEUE_PAGE, 0, after_request, after_payment),
+    ))
+    if more:
+        next_request = requests[-1].id if requests else after_request
+        next_payment = payments[-1].id if payments else after_payment
+        navigation.append(InlineKeyboardButton(
+            "Далее ▶️", callback_data=encode(Action.QUEUE_PAGE, 0, next_request, next_payment),
+        ))
+    keyboard.append(navigation)
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+
+async def queue_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.id not in ADMIN_IDS:
+        return
+    text, markup = await render_queue()
+    await update.message.reply_text(text, reply_markup=markup)
+
+
+async def handle_queue_page(update: Update, context: ContextTypes.DEFAULT_TYPE, data: CallbackData) -> None:
+    query = update.callback_query
+    if query.from_user.id not in ADMIN_IDS:
+        return await query.answer("Нет прав.", show_alert=True)
+    await query.answer()
+    text, markup = await render_queue(*data.args)
+    await query.edit_message_text(text, reply_markup=markup)
+
+
+async def handle_queue_action(update: Update, context: ContextTypes.DEFAULT_TYPE, data: CallbackData) -> None:
+    """Выполняет действие над записью и перерисовывает ту же страницу с результатом сверху."""
+    query = update.callback_query
+    if query.from_user.id not in ADMIN_IDS:
+        return await query.answer("Нет прав.", show_alert=True)
+    kind, after_request, after_payment = data.args
+    if kind not in QUEUE_ACTIONS:
+        return await query.answer("Неизвестное действие.", show_alert=True)
+    await query.answer()
+    _, notice = await QUEUE_ACTIONS[kind](data.user_id, context)
+    # Свои изменения администратор должен увидеть сразу, не дожидаясь истечения кэша счётчиков
+    repository.invalidate_totals()
+    text, markup = await render_queue(after_request, after_payment, notice=f"ID {data.user_id}: {notice}")
+    await query.edit_message_text(text, reply_markup=markup)
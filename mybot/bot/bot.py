@@ -1,39 +1,86 @@
+from telegram import Update
 from telegram.ext import (
-    Application, CommandHandler, ConversationHandler, CallbackQueryHandler,  JobQueue
+    Application, CommandHandler, ConversationHandler, JobQueue, TypeHandler
 )
 from bot.handlers import start, handle_user_request, handle_tariff_selection, cancel, help_command, subscription, handle_payment_choice, handle_renewal_choice
-from bot.admin_handlers import handle_admin_decision, handle_payment_confirmation
+from bot.admin_handlers import handle_admin_decision, handle_payment_confirmation, handle_bulk_action, handle_digest_page
+from bot.admin_notify import admin_notifier
+from bot.admin_queue import queue_command, handle_queue_page, handle_queue_action
 from bot.utils import GET_STATE_USER_REQUEST, GET_STATE_TARIFF
+from bot.vpn_service import close_outline_client
+from bot.db import close_db_connections
+from bot.key_pool import refill_key_pool
+from bot.persistence import DjangoPersistence, add_refresh_handlers
+from bot.callbacks import Action, CallbackRouter
+from bot.update_processor import KeyedUpdateProcessor, log_update_stats
+from bot.logs import configure_logging
+from bot.metrics import MeteredRequest, instrument_handlers, metrics_server
+from bot.outbox import outbox_worker
+from bot.scheduler import expiry_scheduler
+from bot.tracing import slow_command, trace_update
 import logging, asyncio
 from django.conf import settings
 
-import logging
-
-logging.basicConfig(
-    filename='bot.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
 async def error_handler(update, context):
     logger.exception("Unhandled exception:", exc_info=context.error)
 
-def main():
+async def set_bot_commands(application):
+    # Регистрируем команды у бота
+    await application.bot.set_my_commands([
+        ("start", "🚀 Запустить бота"),
+        ("help", "⚙️ Техподдержка"),
+        ("subscription", "📊 Статус подписки")
+    ])
+
+async def on_startup(application):
+    await set_bot_commands(application)
+    await metrics_server.start()
+    await outbox_worker.start(application.bot)
+    # Напоминания и отключение по сроку подписки (вместо ежедневного cron)
+    if settings.EXPIRY_SCHEDULER:
+        await expiry_scheduler.start()
+
+async def on_stop(application):
+    await expiry_scheduler.stop()
+    # Доставка из outbox останавливается, пока бот ещё может отправлять; недоставленное останется в таблице
+    await outbox_worker.stop()
+
+async def close_resources(application):
+    # Закрываем эндпоинт метрик, HTTP-клиент Outline и соединения с БД после остановки бота
+    await metrics_server.stop()
+    await close_outline_client()
+    await close_db_connections()
+
+def build_application():
+    """Собирает Application со всеми обработчиками и задачами; общий для polling и webhook."""
     job_queue = JobQueue()
-    application = Application.builder()\
+    builder = Application.builder()\
         .token(settings.TOKEN)\
+        .base_url(settings.BOT_API_BASE_URL)\
+        .request(MeteredRequest(connection_pool_size=256))\
         .job_queue(job_queue)\
-        .build()
+        .update_queue(asyncio.Queue(maxsize=settings.WEBHOOK_QUEUE_SIZE))\
+        .concurrent_updates(KeyedUpdateProcessor())\
+        .post_init(on_startup)\
+        .post_stop(on_stop)\
+        .post_shutdown(close_resources)
+    if settings.PERSISTENCE_ENABLED:
+        builder = builder.persistence(DjangoPersistence())
+    application = builder.build()
+
+    # Поля update_id, user_id и handler для всех записей лога и трасса обновления
+    application.add_handler(TypeHandler(Update, trace_update), group=-1)
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
         states={
             GET_STATE_USER_REQUEST: [
-                CallbackQueryHandler(handle_user_request, pattern='^user_request$')
+                CallbackRouter({Action.USER_REQUEST: handle_user_request})
             ],
             GET_STATE_TARIFF: [
-                CallbackQueryHandler(handle_tariff_selection, pattern='^tariff_')
+                CallbackRouter({Action.TARIFF: handle_tariff_selection})
             ]
         },
         fallbacks=[
@@ -42,34 +89,57 @@ def main():
             CommandHandler('start', start),  # ✅ опционально
             ],
         allow_reentry=True,
-        conversation_timeout=30 * 60
+        conversation_timeout=30 * 60,
+        name="main_conversation",
+        persistent=settings.PERSISTENCE_ENABLED,
     )
 
     application.add_handler(conv_handler)
+    if settings.PERSISTENCE_ENABLED and settings.PERSISTENCE_REFRESH:
+        # Несколько процессов: состояние диалога читается из БД перед обновлением и пишется сразу после
+        add_refresh_handlers(application, [conv_handler])
     application.add_handler(CommandHandler('start', start))
     application.add_handler(CommandHandler('subscription', subscription))
-    application.add_handler(CallbackQueryHandler(handle_admin_decision, pattern='^admin_'))
-    application.add_handler(CallbackQueryHandler(handle_payment_confirmation, pattern='^payment_'))
-    application.add_handler(CallbackQueryHandler(handle_tariff_selection, pattern='^tariff_'))
     application.add_handler(CommandHandler('help', help_command))
-    application.add_handler(CallbackQueryHandler(handle_user_request, pattern='^user_request$'))
-    application.add_handler(CallbackQueryHandler(handle_payment_choice, pattern='^user_paid_'))
-    application.add_handler(CallbackQueryHandler(handle_renewal_choice, pattern=r"^renew_(yes|no)_\d+$"))
+    application.add_handler(CommandHandler('queue', queue_command))
+    application.add_handler(CommandHandler('slow', slow_command))
+    # Все кнопки: один разбор callback_data и выбор обработчика по действию
+    application.add_handler(CallbackRouter({
+        Action.ADMIN_DECISION: handle_admin_decision,
+        Action.PAYMENT: handle_payment_confirmation,
+        Action.TARIFF: handle_tariff_selection,
+        Action.USER_REQUEST: handle_user_request,
+        Action.USER_PAID: handle_payment_choice,
+        Action.RENEW: handle_renewal_choice,
+        Action.BULK_APPROVE: handle_bulk_action,
+        Action.BULK_CONFIRM: handle_bulk_action,
+        Action.DIGEST_PAGE: handle_digest_page,
+        Action.QUEUE_PAGE: handle_queue_page,
+        Action.QUEUE_ACTION: handle_queue_action,
+    }))
 
     application.add_error_handler(error_handler)
+    # Задержки обработчиков и имя обработчика в логе
+    instrument_handlers(application)
 
-    # Регистрируем команды у бота
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    async def set_bot_commands():
-        await application.bot.set_my_commands([
-            ("start", "🚀 Запустить бота"),
-            ("help", "⚙️ Техподдержка"),
-            ("subscription", "📊 Статус подписки")
-        ])
-    loop.run_until_complete(set_bot_commands())
+    # Фоновое пополнение пула готовых VPN-ключей
+    if settings.KEY_POOL_HIGH > 0:
+        job_queue.run_repeating(refill_key_pool, interval=settings.KEY_POOL_REFILL_INTERVAL, first=0)
+    # Сводка для администраторов в часы наплыва заявок
+    job_queue.run_repeating(admin_notifier.send_digest, interval=settings.ADMIN_DIGEST_INTERVAL)
+    if settings.UPDATE_STATS_INTERVAL > 0:
+        job_queue.run_repeating(log_update_stats, interval=settings.UPDATE_STATS_INTERVAL)
+
+    return application
 
-    application.run_polling()
+def main(mode=None):
+    configure_logging()
+    application = build_application()
+    if (mode or settings.BOT_MODE) == "webhook":
+        from bot.webhook import serve_webhook
+        serve_webhook(application)
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,162 @@
+# broadcast.py Массовая рассылка сообщений с учётом лимитов Bot API
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass
+from typing import Iterable, Optional
+from django.conf import settings
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Ведро токенов: не больше `rate` операций в секунду, всплеск до `capacity`.
+    При RetryAfter от Telegram ведро ставится на паузу для всех отправителей сразу.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+@dataclass(frozen=True)
+class OutgoingMessage:
+    chat_id: int
+    text: str
+    reply_markup: Optional[InlineKeyboardMarkup] = None
+    parse_mode: Optional[str] = None
+    # Ключ идемпотентности для outbox: сообщение с тем же ключом записывается один раз
+    key: Optional[str] = None
+
+
+@dataclass
+class BroadcastSummary:
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
+    retried: int = 0
+
+    @property
+    def total(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+    def __str__(self):
+        return (f"отправлено {self.sent}, ошибок {self.failed}, "
+                f"заблокировали бота {self.blocked}, повторов {self.retried}")
+
+
+# Результаты одной попытки отправки
+SENT = "sent"
+BLOCKED = "blocked"      # Forbidden: пользователь заблокировал бота, повторять бессмысленно
+FAILED = "failed"        # BadRequest: Telegram отклонил само сообщение
+THROTTLED = "throttled"  # RetryAfter: лимит Telegram, повтор после паузы
+RETRY = "retry"          # сетевая или иная временная ошибка, повтор с экспоненциальной задержкой
+
+
+async def attempt_send(bot, bucket: TokenBucket, message: OutgoingMessage, attempt: int,
+                       backoff_base: float = 0.5, backoff_cap: float = 30.0) -> tuple:
+    """
+    Одна попытка отправки через общий лимит `bucket`; общая классификация ошибок для рассылок и outbox.
+    Возвращает (результат, задержка до повтора, ошибка). RetryAfter ставит `bucket` на паузу для всех
+    отправителей, задержка временной ошибки — backoff_base * 2**attempt (не больше backoff_cap) с разбросом.
+    """
+    await bucket.acquire()
+    try:
+        await bot.send_message(
+            chat_id=message.chat_id,
+            text=message.text,
+            reply_markup=message.reply_markup,
+            parse_mode=message.parse_mode,
+        )
+        return SENT, 0.0, None
+    except Forbidden as e:
+        return BLOCKED, 0.0, e
+    except BadRequest as e:
+        return FAILED, 0.0, e
+    except RetryAfter as e:
+        delay = float(e.retry_after)
+        bucket.pause(delay)
+        return THROTTLED, delay, e
+    except (NetworkError, TelegramError) as e:
+        return RETRY, min(backoff_cap, backoff_base * 2 ** attempt) * random.uniform(0.5, 1.5), e
+
+
+class Broadcaster:
+    """
+    Рассылает сообщения с ограниченной параллельностью и общим лимитом скорости.
+    RetryAfter и сетевые ошибки повторяются с экспоненциальной задержкой,
+    Forbidden (пользователь заблокировал бота) считается отдельно и не повторяется.
+    Итоги накапливаются в `summary` между вызовами send_many().
+    """
+
+    def __init__(self, bot, rate: Optional[float] = None, concurrency: Optional[int] = None,
+                 max_retries: Optional[int] = None):
+        self.bot = bot
+        self.bucket = TokenBucket(rate or settings.BROADCAST_RATE)
+        self.concurrency = concurrency or settings.BROADCAST_CONCURRENCY
+        self.max_retries = settings.BROADCAST_MAX_RETRIES if max_retries is None else max_retries
+        self.summary = BroadcastSummary()
+
+    async def send(self, message: OutgoingMessage) -> str:
+        """Отправляет одно сообщение. Возвращает 'sent', 'blocked' или 'failed'."""
+        attempt = 0
+        while True:
+            result, delay, error = await attempt_send(self.bot, self.bucket, message, attempt)
+            if result == SENT:
+                self.summary.sent += 1
+                return SENT
+            if result == BLOCKED:
+                self.summary.blocked += 1
+                return BLOCKED
+            if result == FAILED:
+                logger.error(f"Сообщение клиенту {message.chat_id} отклонено: {error}")
+                self.summary.failed += 1
+                return FAILED
+
+            attempt += 1
+            if attempt > self.max_retries:
+                logger.error(f"Не удалось отправить сообщение клиенту {message.chat_id} после {attempt} попыток")
+                self.summary.failed += 1
+                return FAILED
+            logger.warning(f"Ошибка отправки клиенту {message.chat_id} ({error}), повтор через {delay:.1f}с")
+            self.summary.retried += 1
+            await asyncio.sleep(delay)
+
+    async def send_many(self, messages: Iterable[OutgoingMessage]) -> BroadcastSummary:
+        """
+        Рассылает сообщения из итератора, не материализуя его целиком:
+        `concurrency` воркеров по очереди забирают следующее сообщение.
+        """
+        iterator = iter(messages)
+
+        async def worker():
+            for message in iterator:
+                await self.send(message)
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        return self.summary
@@ -0,0 +1,106 @@
+# cache.py Кэши в памяти процесса
+import asyncio
+import functools
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+from django.conf import settings
+
+MISSING = object()
+
+
+class TTLCache:
+    """LRU-кэш с ограничением по размеру и времени жизни записи, со счётчиками попаданий."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=MISSING):
+        item = self._data.get(key)
+        if item is not None and item[0] > time.monotonic():
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+        if item is not None:
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+def async_cached(maxsize: int, ttl: float, key: Callable, falsy_ttl: Optional[float] = None):
+    """
+    Декоратор для корутин: кэширует результат (а не объект корутины) на `ttl` секунд,
+    ложные результаты — на `falsy_ttl`, если он задан. Ключ строит функция `key` из аргументов
+    вызова, поэтому context, bot и прочие служебные аргументы в него не попадают.
+    Одновременные вызовы с одним ключом ждут одного выполнения (single-flight);
+    исключение не кэшируется и достаётся всем, кто ждал этого выполнения.
+    """
+    def decorator(func):
+        cache = TTLCache(maxsize, ttl)
+        inflight = {}
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            cache_key = key(*args, **kwargs)
+            value = cache.get(cache_key)
+            if value is not MISSING:
+                return value
+            task = inflight.get(cache_key)
+            if task is None:
+                # Отдельная задача: отмена одного из ожидающих не отменяет запрос для остальных
+                task = asyncio.ensure_future(func(*args, **kwargs))
+                inflight[cache_key] = task
+
+                def store(done):
+                    inflight.pop(cache_key, None)
+                    if not done.cancelled() and done.exception() is None:
+                        result = done.result()
+                        cache.set(cache_key, result, None if result or falsy_ttl is None else falsy_ttl)
+
+                task.add_done_callback(store)
+            return await asyncio.shield(task)
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
+
+
+client_cache = TTLCache(settings.CLIENT_CACHE_SIZE, settings.CLIENT_CACHE_TTL)
+# Растёт при каждой инвалидации: чтение, начатое до записи, не кладёт в кэш устаревшую строку
+_invalidations = 0
+
+
+def generation() -> int:
+    """Номер последней инвалидации; сравнивается до и после чтения из БД."""
+    return _invalidations
+
+
+def invalidate_client(*user_ids):
+    """Сбрасывает записи после изменения клиентов; вызывается на каждом пути записи в Clients."""
+    global _invalidations
+    _invalidations += 1
+    for user_id in user_ids:
+        client_cache.pop(user_id)
@@ -0,0 +1,178 @@
+# callbacks.py Кодирование callback_data и маршрутизация нажатий кнопок
+import base64
+import binascii
+import logging
+import struct
+from collections import deque
+from dataclasses import dataclass
+from enum import IntEnum
+from functools import lru_cache
+from typing import Optional
+from telegram import Update
+from telegram.ext import BaseHandler
+from bot.logs import bind
+
+logger = logging.getLogger(__name__)
+
+# Первый символ callback_data — версия схемы; старые строковые кнопки начинаются с буквы
+VERSION = "1"
+_HEADER = ">Bq"
+
+
+class Action(IntEnum):
+    USER_REQUEST = 1    # «Подать заявку»
+    TARIFF = 2          # выбор тарифа, args: (месяцев,)
+    USER_PAID = 3       # «Я оплатил»
+    RENEW = 4           # продление, args: (да/нет,)
+    ADMIN_DECISION = 5  # заявка, args: (одобрить/отклонить,)
+    PAYMENT = 6         # проверка платежа, args: (успешен/не прошёл,)
+    BULK_APPROVE = 7    # одобрить заявки из сводки, args: id записей Clients
+    BULK_CONFIRM = 8    # подтвердить платежи из сводки, args: id записей Clients
+    DIGEST_PAGE = 9     # страница сводки, args: (после id заявки, после id платежа)
+    QUEUE_PAGE = 10     # страница /queue, args: (после id заявки, после id платежа)
+    QUEUE_ACTION = 11   # действие в /queue, args: (QUEUE_APPROVE и т.п., страница: после id заявки, платежа)
+
+
+# Формат аргументов каждого действия для struct; размер данных проверяется точно.
+# "I*" — произвольное число значений "I" до конца данных
+ARG_FORMATS = {
+    Action.USER_REQUEST: "",
+    Action.TARIFF: "B",
+    Action.USER_PAID: "",
+    Action.RENEW: "?",
+    Action.ADMIN_DECISION: "?",
+    Action.PAYMENT: "?",
+    Action.BULK_APPROVE: "I*",
+    Action.BULK_CONFIRM: "I*",
+    Action.DIGEST_PAGE: "II",
+    Action.QUEUE_PAGE: "II",
+    Action.QUEUE_ACTION: "BII",
+}
+_STRUCTS = {
+    action: struct.Struct(_HEADER if fmt.endswith("*") else _HEADER + fmt) for action, fmt in ARG_FORMATS.items()
+}
+_ITEMS = {action: struct.Struct(">" + fmt[:-1]) for action, fmt in ARG_FORMATS.items() if fmt.endswith("*")}
+_HEADER_SIZE = struct.calcsize(_HEADER)
+# Telegram ограничивает callback_data 64 байтами
+MAX_LENGTH = 64
+
+TARIFF_CODES = {"1month": 1, "3months": 3, "6months": 6}
+
+
+@dataclass(frozen=True)
+class CallbackData:
+    action: Action
+    user_id: int = 0
+    args: tuple = ()
+
+
+def encode(action: Action, user_id: int = 0, *args) -> str:
+    """Упаковывает действие, user_id и аргументы в короткую строку для callback_data."""
+    if action in _ITEMS:
+        packed = _STRUCTS[action].pack(action, user_id) + b"".join(_ITEMS[action].pack(arg) for arg in args)
+    else:
+        packed = _STRUCTS[action].pack(action, user_id, *args)
+    data = VERSION + base64.urlsafe_b64encode(packed).rstrip(b"=").decode()
+    if len(data) > MAX_LENGTH:
+        raise ValueError(f"callback_data длиннее {MAX_LENGTH} символов: {action.name}, {len(args)} аргументов")
+    return data
+
+
+def max_items(action: Action) -> int:
+    """Сколько значений списка помещается в callback_data действия с форматом "*"."""
+    raw = (MAX_LENGTH - len(VERSION)) * 3 // 4
+    return (raw - _HEADER_SIZE) // _ITEMS[action].size
+
+
+def _decode_packed(data: str) -> Optional[CallbackData]:
+    body = data[len(VERSION):]
+    try:
+        raw = base64.urlsafe_b64decode(body + "=" * (-len(body) % 4))
+        action = Action(raw[0])
+        if action in _ITEMS:
+            _, user_id = _STRUCTS[action].unpack(raw[:_HEADER_SIZE])
+            args = [value for value, in _ITEMS[action].iter_unpack(raw[_HEADER_SIZE:])]
+        else:
+            _, user_id, *args = _STRUCTS[action].unpack(raw)
+    except (binascii.Error, ValueError, IndexError, struct.error):
+        return None
+    return CallbackData(action, user_id, tuple(args))
+
+
+def _decode_legacy(data: str) -> Optional[CallbackData]:
+    # Кнопки в уже отправленных сообщениях: user_request, tariff_3months_42, admin_approve_42 и т.п.
+    if data == "user_request":
+        return CallbackData(Action.USER_REQUEST)
+    parts = data.split("_")
+    if len(parts) != 3 or not parts[2].isdigit():
+        return None
+    prefix, value, user_id = parts[0], parts[1], int(parts[2])
+    if prefix == "tariff" and value in TARIFF_CODES:
+        return CallbackData(Action.TARIFF, user_id, (TARIFF_CODES[value],))
+    if prefix == "user" and value == "paid":
+        return CallbackData(Action.USER_PAID, user_id)
+    if prefix == "renew" and value in ("yes", "no"):
+        return CallbackData(Action.RENEW, user_id, (value == "yes",))
+    if prefix == "admin" and value in ("approve", "reject"):
+        return CallbackData(Action.ADMIN_DECISION, user_id, (value == "approve",))
+    if prefix == "payment" and value in ("success", "fail"):
+        return CallbackData(Action.PAYMENT, user_id, (value == "success",))
+    return None
+
+
+@lru_cache(maxsize=4096)
+def decode(data: str) -> Optional[CallbackData]:
+    """Разбирает callback_data (новую схему или старый строковый формат); None — данные некорректны."""
+    if len(data.encode()) > MAX_LENGTH:
+        return None
+    if data.startswith(VERSION):
+        return _decode_packed(data)
+    return _decode_legacy(data)
+
+
+# id нажатий с некорректными данными, о которых уже предупредили: роутеров несколько,
+# и каждый проверяет одно и то же нажатие
+_reported = deque(maxlen=256)
+
+
+def _report_invalid(query) -> None:
+    if query.id in _reported:
+        return
+    _reported.append(query.id)
+    logger.warning(f"Некорректные данные кнопки: {query.data!r}")
+
+
+class CallbackRouter(BaseHandler):
+    """
+    Один обработчик для всех кнопок: callback_data разбирается один раз, обработчик
+    выбирается по действию из словаря и получает разобранные данные третьим аргументом:
+    `async def handler(update, context, data: CallbackData)`.
+    """
+
+    def __init__(self, routes: dict):
+        super().__init__(self.dispatch)
+        self.routes = dict(routes)
+
+    def check_update(self, update) -> Optional[CallbackData]:
+        if not isinstance(update, Update) or update.callback_query is None:
+            return None
+        data = update.callback_query.data
+        if not isinstance(data, str):
+            return None
+        parsed = decode(data)
+        if parsed is None:
+            _report_invalid(update.callback_query)
+            return None
+        return parsed if parsed.action in self.routes else None
+
+    async def dispatch(self, update, context):
+        """Разбирает и выполняет нажатие без Application (например, в бенчмарке)."""
+        data = self.check_update(update)
+        if data is not None:
+            return await self.routes[data.action](update, context, data)
+
+    async def handle_update(self, update, application, check_result, context):
+        # check_result — уже разобранные данные из check_update, повторно не разбираем
+        handler = self.routes[check_result.action]
+        bind(handler=handler.__name__)
+        return await handler(update, context, check_result)
@@ -0,0 +1,123 @@
+# db.py Соединения с БД для долгоживущего процесса бота
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection, connections
+from bot.metrics import Gauge, db_execute_wrapper
+from bot.tracing import record_span
+
+logger = logging.getLogger(__name__)
+
+
+class DatabasePool:
+    """
+    Пул потоков, в которых бот выполняет запросы к БД.
+
+    У каждого потока своё постоянное соединение Django. Бот живёт вне цикла HTTP-запросов,
+    поэтому сигналы request_started/finished, которые обычно обслуживают CONN_MAX_AGE,
+    не срабатывают — их роль играет close_old_connections() перед каждым заданием:
+    соединение старше CONN_MAX_AGE или с ошибкой закрывается, при CONN_HEALTH_CHECKS
+    оставшееся проверяется перед повторным использованием, а закрытое Django открывает
+    заново при следующем запросе.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or settings.DB_EXECUTOR_WORKERS
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="db")
+        self._lock = threading.Lock()
+        self._open = set()
+        self.waiting = 0
+        self.busy = 0
+        self.jobs = 0
+        self.connects = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def run(self, func, *args, **kwargs):
+        """Выполняет синхронный ORM-код в потоке пула."""
+        with self._lock:
+            self.waiting += 1
+        started = time.perf_counter()
+        job = partial(self._job, started, func, args, kwargs)
+        try:
+            return await sync_to_async(job, thread_sensitive=False, executor=self._executor)()
+        finally:
+            # В span входит и ожидание свободного потока пула
+            record_span("db", func.__name__, started, time.perf_counter() - started)
+
+    def _job(self, submitted, func, args, kwargs):
+        waited = time.perf_counter() - submitted
+        with self._lock:
+            self.waiting -= 1
+            self.busy += 1
+            self.jobs += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        close_old_connections()
+        reconnect = connection.connection is None
+        try:
+            with connection.execute_wrapper(db_execute_wrapper):
+                return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.busy -= 1
+                if connection.connection is not None:
+                    self._open.add(threading.get_ident())
+                    self.connects += reconnect
+                else:
+                    self._open.discard(threading.get_ident())
+
+    def close_connections(self, timeout=5):
+        """
+        Закрывает соединения во всех потоках пула (при остановке бота или команды).
+        Соединения Django привязаны к потоку, поэтому в каждый поток отправляется своё задание:
+        барьер не даёт одному потоку забрать два задания.
+        """
+        barrier = threading.Barrier(self.workers)
+
+        def close():
+            try:
+                barrier.wait(timeout)
+            except threading.BrokenBarrierError:
+                pass
+            connections.close_all()
+            with self._lock:
+                self._open.discard(threading.get_ident())
+
+        wait([self._executor.submit(close) for _ in range(self.workers)])
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": self.workers,
+                "open_connections": len(self._open),
+                "busy": self.busy,
+                "waiting": self.waiting,
+                "jobs": self.jobs,
+                "connects": self.connects,
+                "wait_avg_ms": self.wait_total / self.jobs * 1000 if self.jobs else 0.0,
+                "wait_max_ms": self.wait_max * 1000,
+            }
+
+
+db_pool = DatabasePool()
+
+Gauge(
+    "bot_db_pool", "Состояние пула потоков БД", ("state",),
+    func=lambda: {(key,): value for key, value in db_pool.stats().items() if key != "size"},
+)
+
+
+async def run_db(func, *args, **kwargs):
+    """Выполняет синхронный ORM-код в пуле потоков БД."""
+    return await db_pool.run(func, *args, **kwargs)
+
+
+async def close_db_connections(*args):
+    """Закрывает соединения пула; подходит как post_shutdown Application."""
+    logger.info(f"Пул БД: {db_pool.stats()}")
+    await sync_to_async(db_pool.close_connections, thread_sensitive=False)()
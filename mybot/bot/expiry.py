@@ -0,0 +1,89 @@
+# expiry.py Окончание подписок: напоминания о продлении и отключение истёкших клиентов
+import logging
+from babel.dates import format_date
+from django.utils import timezone
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from bot import repository
+from bot.broadcast import OutgoingMessage
+from bot.callbacks import Action, encode
+from bot.outbox import enqueue_messages
+from bot.vpn_service import revoke_keys
+
+logger = logging.getLogger(__name__)
+
+
+def renewal_message(client) -> OutgoingMessage:
+    """Сообщение с вопросом о продлении подписки."""
+    formatted_date = format_date(client.subscription_end_date, format="d MMMM yyyy", locale="ru")
+    message_text = (
+        f"⚠️ Ваша подписка истекает завтра ({formatted_date}).\n"
+        "Хотите продлить подписку?"
+    )
+    # Кнопки для выбора: "Да" и "Нет"
+    keyboard = [
+        [InlineKeyboardButton("✅ Да", callback_data=encode(Action.RENEW, client.user_id, True))],
+        [InlineKeyboardButton("❌ Нет", callback_data=encode(Action.RENEW, client.user_id, False))]
+    ]
+    # Ключ идемпотентности: напоминание об одном периоде уходит один раз, кто бы его ни записал
+    return OutgoingMessage(client.user_id, message_text, InlineKeyboardMarkup(keyboard),
+                           key=f"renewal:{client.user_id}:{client.subscription_end_date}")
+
+
+def expired_message(client) -> OutgoingMessage:
+    """
+    Сообщение о том, что подписка закончилась,
+    с предложением подать новую заявку (аналогично кнопке /start).
+    """
+    message_text = (
+        "❌ Ваша подписка закончилась, вы больше не можете пользоваться VPN.\n"
+        "Чтобы продолжить, пожалуйста, подайте новую заявку."
+    )
+    keyboard = [
+        [InlineKeyboardButton("Подать заявку", callback_data=encode(Action.USER_REQUEST))]
+    ]
+    return OutgoingMessage(client.user_id, message_text, InlineKeyboardMarkup(keyboard),
+                           key=f"expired:{client.user_id}:{client.subscription_end_date}")
+
+
+async def iter_chunks(chunk_size: int, **filters):
+    """Обходит клиентов порциями по `chunk_size`, не держа всю выборку в памяти."""
+    after = None
+    while True:
+        chunk = await repository.fetch_clients_chunk(filters, after, chunk_size)
+        if not chunk:
+            return
+        yield chunk
+        last = chunk[-1]
+        after = (last.subscription_end_date, last.id)
+
+
+async def remind(clients: list) -> int:
+    """Записывает в outbox напоминания о продлении; повторная запись того же периода ничего не добавляет."""
+    return await enqueue_messages(renewal_message(client) for client in clients)
+
+
+async def expire(clients: list, concurrency: int = None, today=None) -> tuple:
+    """
+    Отключает клиентов с истёкшей к `today` подпиской:
+    1. под блокировкой отбирает тех, кто всё ещё не продлил, и снимает с них access_url —
+       оплата, подтверждённая во время отзыва, выдаст новый ключ вместо отзываемого;
+    2. параллельно отзывает их ключи;
+    3. одним UPDATE сбрасывает тех, у кого ключ отозван и строка не изменилась, и в той же
+       транзакции записывает им уведомление в outbox.
+    Возвращает (отключённые, не отключённые): ключ последних ещё активен, им возвращается
+    access_url, статус не тронут, следующая попытка повторит отзыв.
+    """
+    today = today or timezone.now().date()
+    clients = await repository.claim_expired(clients, today)
+    revoked = await revoke_keys([client.vpn_id for client in clients if client.vpn_id], concurrency=concurrency)
+    disabled, failed = [], []
+    for client in clients:
+        if client.vpn_id and not revoked.get(client.vpn_id):
+            logger.error(f"Не удалось отключить клиента {client.user_id} (vpn_id: {client.vpn_id})")
+            failed.append(client)
+        else:
+            disabled.append(client)
+    if failed:
+        await repository.restore_access(failed)
+    await repository.reset_expired(disabled, today, expired_message)
+    return disabled, failed
@@ -0,0 +1,81 @@
+# fake_outline.py Поддельный Outline Management API для нагрузочных тестов
+import asyncio
+import json
+import random
+import uuid
+
+# Префикс id ключей поддельного сервера: по нему нагрузочный тест убирает за собой записи в БД
+KEY_PREFIX = "load-"
+
+
+class FakeOutline:
+    """
+    ASGI-сервер с подмножеством Outline API, которым пользуется OutlineClient:
+    POST <base> — создать ключ, PUT <base><id>/name — переименовать, DELETE <base><id> — удалить,
+    GET <base> — список. Каждый запрос отвечает через `latency` ± `jitter` секунд,
+    доля `error_rate` запросов завершается ответом 500.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.keys = {}
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        self.requests += 1
+        delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self._random.random() < self.error_rate:
+            self.errors += 1
+            return await self.respond(send, 500, {"message": "fake outline error"})
+        status, payload = self.dispatch(scope["method"], scope["path"], body)
+        await self.respond(send, status, payload)
+
+    def dispatch(self, method: str, path: str, body: bytes):
+        parts = path.rstrip("/").split("/")
+        if method == "POST" and parts[-1] == "access-keys":
+            key_id = f"{KEY_PREFIX}{uuid.uuid4().hex[:16]}"
+            key = {
+                "id": key_id,
+                "name": "",
+                "password": uuid.uuid4().hex,
+                "port": 443,
+                "method": "chacha20-ietf-poly1305",
+                "accessUrl": f"ss://{key_id}@127.0.0.1:443/?outline=1",
+            }
+            self.keys[key_id] = key
+            return 201, key
+        if method == "GET" and parts[-1] == "access-keys":
+            return 200, {"accessKeys": list(self.keys.values())}
+        if method == "PUT" and parts[-1] == "name" and parts[-2] in self.keys:
+            self.keys[parts[-2]]["name"] = json.loads(body or b"{}").get("name", "")
+            return 204, None
+        if method == "DELETE" and parts[-1] in self.keys:
+            del self.keys[parts[-1]]
+            return 204, None
+        return 404, {"message": "not found"}
+
+    @staticmethod
+    async def respond(send, status: int, payload):
+        body = json.dumps(payload).encode() if payload is not None else b""
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,167 @@
+# fake_telegram.py Поддельный Bot API для бенчмарков, воспроизведения обновлений и нагрузочных тестов
+import asyncio
+import itertools
+import json
+import time
+from urllib.parse import parse_qsl
+from telegram.request import BaseRequest
+
+FAKE_BOT_USER = {"id": 1, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+
+
+def fake_message(message_id: int, chat_id, text: str = "") -> dict:
+    return {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "text": text,
+    }
+
+
+class InMemoryBotRequest(BaseRequest):
+    """
+    Подменяет HTTP-запросы к Bot API. Каждый вызов занимает `rtt` (по половине на запрос и ответ);
+    getUpdates ведёт себя как long polling: ждёт появления обновлений в `pending`.
+    sendMessage возвращает сообщение с отправленным текстом, getChatMember — «member», остальные методы — True;
+    имена методов сохраняются в `calls`, параметры — в `requests`.
+    """
+
+    def __init__(self, pending: asyncio.Queue = None, rtt: float = 0.0):
+        self.pending = pending if pending is not None else asyncio.Queue()
+        self.rtt = rtt
+        self.calls = []
+        self.requests = []
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        if self.rtt:
+            await asyncio.sleep(self.rtt / 2)
+        if api_method == "getMe":
+            result = FAKE_BOT_USER
+        elif api_method == "getUpdates":
+            timeout = (request_data.parameters if request_data else {}).get("timeout") or 0
+            result = []
+            try:
+                result.append(await asyncio.wait_for(self.pending.get(), max(timeout, 0.01)))
+                while not self.pending.empty():
+                    result.append(self.pending.get_nowait())
+            except asyncio.TimeoutError:
+                pass
+        else:
+            parameters = request_data.parameters if request_data else {}
+            self.calls.append(api_method)
+            self.requests.append((api_method, parameters))
+            result = True
+            if api_method == "sendMessage":
+                result = fake_message(next(self._message_ids), parameters.get("chat_id"), parameters.get("text", ""))
+            elif api_method == "getChatMember":
+                user = {"id": parameters.get("user_id"), "is_bot": False, "first_name": "replay"}
+                result = {"status": "member", "user": user}
+        if self.rtt:
+            await asyncio.sleep(self.rtt / 2)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class FakeBotApi:
+    """
+    ASGI-сервер, изображающий Bot API по адресу /bot<token>/<метод>; Application направляется
+    на него через base_url. Обновления для getUpdates добавляет push() (long polling честно ждёт
+    до `timeout`), исходящие вызовы записываются в `calls` как (время, метод, параметры)
+    и передаются функциям из `listeners`. getChatMember всегда отвечает «member».
+    """
+
+    def __init__(self, rtt: float = 0.0):
+        self.rtt = rtt
+        self.updates = asyncio.Queue()
+        self.calls = []
+        self.listeners = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def push(self, update: dict) -> int:
+        """Ставит обновление в очередь getUpdates, присваивая ему update_id."""
+        update["update_id"] = next(self._update_ids)
+        self.updates.put_nowait(update)
+        return update["update_id"]
+
+    def next_message_id(self) -> int:
+        return next(self._message_ids)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        headers = dict(scope["headers"])
+        if self.rtt:
+            await asyncio.sleep(self.rtt / 2)
+        result = await self.dispatch(scope["path"].rsplit("/", 1)[-1], self.parse(headers, body))
+        if self.rtt:
+            await asyncio.sleep(self.rtt / 2)
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": payload})
+
+    @staticmethod
+    def parse(headers: dict, body: bytes) -> dict:
+        content_type = headers.get(b"content-type", b"").decode()
+        if content_type.startswith("application/json"):
+            parameters = json.loads(body or b"{}")
+        elif content_type.startswith("application/x-www-form-urlencoded"):
+            parameters = dict(parse_qsl(body.decode()))
+        else:
+            parameters = {}
+        for key in ("chat_id", "user_id", "message_id", "offset", "timeout", "limit"):
+            value = parameters.get(key)
+            if isinstance(value, str) and value.lstrip("-").isdigit():
+                parameters[key] = int(value)
+        return parameters
+
+    async def dispatch(self, method: str, parameters: dict):
+        if method == "getMe":
+            return FAKE_BOT_USER
+        if method == "getUpdates":
+            return await self.get_updates(parameters.get("timeout") or 0, parameters.get("limit") or 100)
+        self.calls.append((time.perf_counter(), method, parameters))
+        for listener in self.listeners:
+            listener(method, parameters)
+        if method == "sendMessage":
+            return fake_message(self.next_message_id(), parameters.get("chat_id"), parameters.get("text", ""))
+        if method == "editMessageText":
+            return fake_message(parameters.get("message_id"), parameters.get("chat_id"), parameters.get("text", ""))
+        if method == "getChatMember":
+            user = {"id": parameters.get("user_id"), "is_bot": False, "first_name": "load"}
+            return {"status": "member", "user": user}
+        return True
+
+    async def get_updates(self, timeout: float, limit: int) -> list:
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), max(timeout, 0.01)))
+        except asyncio.TimeoutError:
+            return updates
+        while len(updates) < limit and not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
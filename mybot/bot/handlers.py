@@ -1,11 +1,12 @@
 # handlers.py
+import asyncio
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
-from asgiref.sync import sync_to_async
 from django.conf import settings
-from bot.models import Clients
-from bot.vpn_service import create_vpn_key
+from bot import repository
+from bot.callbacks import Action, CallbackData, encode
+from bot.utils import is_user_subscribed
 from bot.admin_handlers import notify_admin, get_tariff_keyboard  # notify_admin для заявок
 from django.utils import timezone
 from babel.dates import format_date
@@ -15,15 +16,32 @@ logger = logging.getLogger(__name__)
 GET_STATE_USER_REQUEST = 1
 GET_STATE_TARIFF = 2
 
+def channel_gate_message() -> dict:
+    channel = settings.CHANNEL_ID or ""
+    markup = None
+    if channel.startswith("@"):
+        markup = InlineKeyboardMarkup([[InlineKeyboardButton("📢 Перейти в канал", url=f"https://t.me/{channel[1:]}")]])
+    return {
+        "text": f"Чтобы пользоваться ботом, подпишитесь на канал {channel}, а затем снова нажмите /start. 🙏",
+        "reply_markup": markup,
+    }
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.message.from_user.id
 
+    # Проверка подписки на канал (из кэша при повторных визитах) идёт параллельно с чтением клиента
+    if settings.CHANNEL_GATE:
+        subscribed, client = await asyncio.gather(
+            is_user_subscribed(user_id, context), repository.get_client(user_id)
+        )
+        if not subscribed:
+            await update.message.reply_text(**channel_gate_message())
+            return ConversationHandler.END
+    else:
+        client = await repository.get_client(user_id)
+
     # Если у пользователя уже есть активная подписка — предложить сразу продлить
     today = timezone.now().date()
-    try:
-        client = await sync_to_async(Clients.objects.get)(user_id=user_id)
-    except Clients.DoesNotExist:
-        client = None
 
     if client and client.subscription_end_date and client.subscription_end_date >= today:
         end_str = format_date(client.subscription_end_date, format="d MMMM yyyy", locale="ru")
@@ -32,8 +50,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             "Хотите продлить её на новый период? 👍"
         )
         keyboard = [
-            [InlineKeyboardButton("✅ Да, хочу!", callback_data=f"renew_yes_{user_id}")],
-            [InlineKeyboardButton("❌ Нет", callback_data=f"renew_no_{user_id}")]
+            [InlineKeyboardButton("✅ Да, хочу!", callback_data=encode(Action.RENEW, user_id, True))],
+            [InlineKeyboardButton("❌ Нет", callback_data=encode(Action.RENEW, user_id, False))]
         ]
         await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
         return ConversationHandler.END
@@ -43,7 +61,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
          "ArtBasilioBot – бот VPN‑сервиса для безопасной передачи данных в сети интернет 🔒.\n"
          "Нажмите кнопку ниже, чтобы подать заявку. ⬇️"
      )
-    keyboard = [[InlineKeyboardButton("Подать заявку", callback_data="user_request")]]
+    keyboard = [[InlineKeyboardButton("Подать заявку", callback_data=encode(Action.USER_REQUEST))]]
     await update.message.reply_text(welcome_text, reply_markup=InlineKeyboardMarkup(keyboard))
     return ConversationHandler.END
 
@@ -58,9 +76,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 async def subscription(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.message.from_user.id
-    try:
-        client = await sync_to_async(Clients.objects.get)(user_id=user_id)
-    except Clients.DoesNotExist:
+    client = await repository.get_client(user_id)
+    if client is None:
         await update.message.reply_text("У вас пока нет активной подписки. Подайте заявку. ✨")
         return ConversationHandler.END
 
@@ -83,8 +100,8 @@ async def subscription(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         if days_left < 2:
             reply_text += "Хотите продлить подписку?"
             keyboard = [
-                [InlineKeyboardButton("✅ Да", callback_data=f"renew_yes_{user_id}")],
-                [InlineKeyboardButton("❌ Нет", callback_data=f"renew_no_{user_id}")]
+                [InlineKeyboardButton("✅ Да", callback_data=encode(Action.RENEW, user_id, True))],
+                [InlineKeyboardButton("❌ Нет", callback_data=encode(Action.RENEW, user_id, False))]
             ]
             await update.message.reply_text(reply_text, reply_markup=InlineKeyboardMarkup(keyboard))
             return ConversationHandler.END
@@ -93,42 +110,36 @@ async def subscription(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 
     else:
         reply_text = "❌ Ваша подписка закончилась, чтобы продолжить, подайте новую заявку."
-        keyboard = [[InlineKeyboardButton("Подать заявку", callback_data="user_request")]]
+        keyboard = [[InlineKeyboardButton("Подать заявку", callback_data=encode(Action.USER_REQUEST))]]
         await update.message.reply_text(reply_text, reply_markup=InlineKeyboardMarkup(keyboard))
         return ConversationHandler.END
 
-async def handle_user_request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def handle_user_request(update: Update, context: ContextTypes.DEFAULT_TYPE, data: CallbackData) -> int:
     query = update.callback_query
     await query.answer()
     user = query.from_user
-    await sync_to_async(Clients.objects.update_or_create)(
-        user_id=user.id,
-        defaults={
-            "name": user.username or user.first_name,
-            "status": "pending"
-        }
-    )
+    await repository.create_request(user.id, user.username or user.first_name)
     await query.edit_message_text("Ваша заявка отправлена на рассмотрение. Ожидайте ответа от администратора. 😊")
     await notify_admin(user, context)  # уведомление для админов о новой заявке
     return ConversationHandler.END
 
-async def handle_tariff_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def handle_tariff_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, data: CallbackData) -> int:
     query = update.callback_query
     await query.answer()
-    _, code, user_id_str = query.data.split("_")
-    user_id = int(user_id_str)
+    user_id = data.user_id
+    months, = data.args
 
     tariff_map = {
-        "1month": ("1 месяц", "100р"),
-        "3months": ("3 месяца", "250р"),
-        "6months": ("6 месяцев", "500р")
+        1: ("1 месяц", "100р"),
+        3: ("3 месяца", "250р"),
+        6: ("6 месяцев", "500р")
     }
-    tariff_text, tariff_amount = tariff_map[code]
+    if months not in tariff_map:
+        await query.edit_message_text("Неизвестный тариф.")
+        return ConversationHandler.END
+    tariff_text, tariff_amount = tariff_map[months]
 
-    client = await sync_to_async(Clients.objects.get)(user_id=user_id)
-    client.tariff = tariff_text
-    client.status = "approved"
-    await sync_to_async(client.save)()  # сохраняем только тариф и статус
+    await repository.select_tariff(user_id, tariff_text)
 
     # Инструкция по оплате
     payment_instructions = (
@@ -136,40 +147,29 @@ async def handle_tariff_selection(update: Update, context: ContextTypes.DEFAULT_
         "✅Переведите нужную сумму на номер ➡️ +79991712428.\n Выберете банк получателя Т‑банк, укажите свой Telegram-ник в комментарии к переводу \n(На айоне 🍏: На главной странице в нижнем правом углу раздел Настройки - Мой профиль - имя пользователя  .\n На андройде📱:В левом верхнем углу три полоски - Мой профиль - Имя пользователя ).\n"
         "💳 После перевода нажмите кнопку снизу «Я оплатил»."
     )
-    markup = InlineKeyboardMarkup([[InlineKeyboardButton("Я оплатил 💳", callback_data=f"user_paid_{user_id}")]])
+    markup = InlineKeyboardMarkup([[InlineKeyboardButton("Я оплатил 💳", callback_data=encode(Action.USER_PAID, user_id))]])
     await context.bot.send_message(chat_id=user_id, text=payment_instructions, reply_markup=markup)
     await query.edit_message_text("Инструкция по оплате отправлена в ЛС.")
     return ConversationHandler.END
 
 
-async def handle_payment_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_payment_choice(update: Update, context: ContextTypes.DEFAULT_TYPE, data: CallbackData):
     """
     Обрабатывает нажатие кнопки "Я оплатил".
     Обновляет статус платежа и уведомляет администраторов о поступлении платежа.
     """
     query = update.callback_query
     await query.answer()
-    data = query.data.split("_")
-    try:
-        # Ожидаем данные вида: "user_paid_{user_id}"
-        if len(data) < 3:
-            await query.edit_message_text("Ошибка данных платежа.")
-            return ConversationHandler.END
-        user_id = int(data[2])
-    except (IndexError, ValueError):
-        await query.edit_message_text("Ошибка данных платежа.")
-        return ConversationHandler.END
+    user_id = data.user_id
 
         # Обновляем статус платежа через update()
-    updated = await sync_to_async(
-        Clients.objects.filter(user_id=user_id).update
-    )(payment_status="awaiting_verification")
+    updated = await repository.mark_awaiting_verification(user_id)
     if not updated:
         await query.edit_message_text("Ошибка: клиент не найден.")
         return ConversationHandler.END
 
     # Получаем свежий объект клиента для уведомления админов
-    client_obj = await sync_to_async(Clients.objects.get)(user_id=user_id)
+    client_obj = await repository.get_client(user_id)
 
     await query.edit_message_text(
         "✅ Спасибо! Ваш платеж отмечен как выполненный. Ожидайте подтверждения администратором. ⏳"
@@ -178,17 +178,18 @@ async def handle_payment_choice(update: Update, context: ContextTypes.DEFAULT_TY
 
 
     from bot.admin_handlers import notify_admin_payment
-    await notify_admin_payment(client_obj, context)
+    if client_obj is not None:
+        await notify_admin_payment(client_obj, context)
 
     return ConversationHandler.END
 
-async def handle_renewal_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def handle_renewal_choice(update: Update, context: ContextTypes.DEFAULT_TYPE, data: CallbackData) -> int:
     query = update.callback_query
     await query.answer()
-    _, action, user_id_str = query.data.split("_")
-    user_id = int(user_id_str)
+    user_id = data.user_id
+    renew, = data.args
 
-    if action == "yes":
+    if renew:
         # показываем тарифы
         markup = get_tariff_keyboard(user_id)
         await context.bot.send_message(
@@ -198,7 +199,7 @@ async def handle_renewal_choice(update: Update, context: ContextTypes.DEFAULT_TY
         )
         return ConversationHandler.END
 
-    # action == "no": просто дружелюбно уведомляем и выходим
+    # «Нет»: просто дружелюбно уведомляем и выходим
     await query.edit_message_text(
         "Хорошо, продление не требуется. "
         "Если передумаете — нажмите /start и выберите тариф для продления."
@@ -0,0 +1,31 @@
+# key_pool.py Пул заранее созданных ключей Outline
+import logging
+from django.conf import settings
+from bot.repository import add_pooled_key, count_pooled_keys
+from bot.vpn_service import provision_vpn_key, rename_vpn_key
+
+logger = logging.getLogger(__name__)
+
+
+async def refill_key_pool(context=None):
+    """
+    Задача JobQueue: если свободных ключей меньше KEY_POOL_LOW, досоздаёт их до KEY_POOL_HIGH.
+    При недоступности Outline просто прекращает попытки до следующего запуска.
+    """
+    available = await count_pooled_keys()
+    if available >= settings.KEY_POOL_LOW:
+        return
+    created = 0
+    for _ in range(settings.KEY_POOL_HIGH - available):
+        key_data = await provision_vpn_key()
+        if not key_data:
+            break
+        await add_pooled_key(key_data)
+        created += 1
+    logger.info(f"Пул ключей пополнен: было {available}, создано {created}")
+
+
+async def rename_claimed_key(vpn_id: str, name: str):
+    """Задаёт выданному из пула ключу имя клиента; выполняется в фоне после подтверждения оплаты."""
+    if await rename_vpn_key(vpn_id, name):
+        logger.info(f"Ключ {vpn_id} из пула переименован в {name}")
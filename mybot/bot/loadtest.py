@@ -0,0 +1,225 @@
+# loadtest.py Нагрузочный тест: бот целиком против поддельных Bot API и Outline
+import asyncio
+import threading
+import time
+from collections import Counter
+import uvicorn
+from bot.callbacks import Action, encode
+from bot.fake_telegram import FakeBotApi
+
+# Пользователи нагрузочного теста: id не пересекаются с настоящими
+FIRST_USER_ID = 7_000_000_000
+
+# Шаги пути пользователя — по именам обработчиков, которые их выполняют
+JOURNEY = (
+    "start",                        # /start
+    "handle_user_request",          # «Подать заявку»
+    "handle_admin_decision",        # администратор одобряет
+    "handle_tariff_selection",      # выбор тарифа
+    "handle_payment_choice",        # «Я оплатил»
+    "handle_payment_confirmation",  # администратор подтверждает платёж
+)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class LocalServer:
+    """ASGI-приложение под uvicorn в текущем цикле событий на свободном порту 127.0.0.1."""
+
+    def __init__(self, app):
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, lifespan="on", log_level="warning"))
+        self._task = None
+        self.port = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self):
+        self._task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            if self._task.done():
+                self._task.result()
+                raise RuntimeError("uvicorn остановился при запуске")
+            await asyncio.sleep(0.01)
+        self.port = self.server.servers[0].sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.should_exit = True
+        await self._task
+
+
+class ServerThread:
+    """
+    Поднимает LocalServer для каждого приложения в отдельном потоке со своим циклом событий —
+    для команд, которые сами вызывают asyncio.run() или запускают подпроцессы.
+    Используется как контекстный менеджер; адреса серверов — в `urls`.
+    """
+
+    def __init__(self, *apps):
+        self.servers = [LocalServer(app) for app in apps]
+        self.loop = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._error = None
+
+    @property
+    def urls(self) -> list:
+        return [server.url for server in self.servers]
+
+    async def _start(self):
+        for server in self.servers:
+            await server.start()
+
+    async def _stop(self):
+        for server in self.servers:
+            await server.stop()
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self._start())
+        except Exception as e:
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        self.loop.run_forever()
+        self.loop.run_until_complete(self._stop())
+        self.loop.close()
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name="fake-servers", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+        return self
+
+    def __exit__(self, *exc_info):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+
+class JourneyDriver:
+    """
+    Проводит синтетических пользователей по пути /start → заявка → одобрение → тариф → «Я оплатил» →
+    подтверждение, отправляя обновления через FakeBotApi. Шаг завершён, когда бот ответил:
+    для команды — sendMessage в чат пользователя, для кнопки — editMessageText нажатого сообщения.
+    Задержка шага — от постановки обновления в getUpdates до этого ответа.
+    """
+
+    def __init__(self, api: FakeBotApi, admin_ids, timeout: float = 30):
+        self.api = api
+        self.admin_ids = list(admin_ids)
+        self.timeout = timeout
+        self.latencies = {step: [] for step in JOURNEY}
+        self.failures = Counter()
+        self.completed = 0
+        self._waiters = {}
+        api.listeners.append(self.on_call)
+
+    def on_call(self, method, parameters):
+        if method == "sendMessage":
+            key = ("send", parameters.get("chat_id"))
+        elif method == "editMessageText":
+            key = ("edit", parameters.get("chat_id"), parameters.get("message_id"))
+        else:
+            return
+        future = self._waiters.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result((time.perf_counter(), parameters.get("text", "")))
+
+    @staticmethod
+    def sender(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"load{user_id}", "username": f"load{user_id}"}
+
+    def command(self, user_id, text):
+        update = {"message": {
+            "message_id": self.api.next_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self.sender(user_id),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+        }}
+        return ("send", user_id), update
+
+    def click(self, from_id, data):
+        message_id = self.api.next_message_id()
+        update = {"callback_query": {
+            "id": str(message_id),
+            "chat_instance": "load",
+            "from": self.sender(from_id),
+            "message": {"message_id": message_id, "date": int(time.time()), "chat": {"id": from_id, "type": "private"}},
+            "data": data,
+        }}
+        return ("edit", from_id, message_id), update
+
+    async def step(self, name, key, update):
+        """Отправляет обновление и ждёт ответа бота; возвращает текст ответа или None по таймауту."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[key] = future
+        started = time.perf_counter()
+        self.api.push(update)
+        try:
+            finished, text = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self._waiters.pop(key, None)
+            self.failures[name] += 1
+            return None
+        self.latencies[name].append(finished - started)
+        return text
+
+    async def journey(self, user_id, admin_id):
+        steps = (
+            ("start", self.command(user_id, "/start")),
+            ("handle_user_request", self.click(user_id, encode(Action.USER_REQUEST))),
+            ("handle_admin_decision", self.click(admin_id, encode(Action.ADMIN_DECISION, user_id, True))),
+            ("handle_tariff_selection", self.click(user_id, encode(Action.TARIFF, user_id, 1))),
+            ("handle_payment_choice", self.click(user_id, encode(Action.USER_PAID, user_id))),
+            ("handle_payment_confirmation", self.click(admin_id, encode(Action.PAYMENT, user_id, True))),
+        )
+        text = None
+        for name, (key, update) in steps:
+            text = await self.step(name, key, update)
+            if text is None:
+                return
+        if "подтверждён" in text:
+            self.completed += 1
+        else:
+            self.failures["payment_not_confirmed"] += 1
+
+    async def run(self, journeys: int, rate: float, first_user_id: int = FIRST_USER_ID) -> float:
+        """Запускает `journeys` путей с частотой `rate` в секунду; возвращает общее время в секундах."""
+        started = time.perf_counter()
+        tasks = []
+        for i in range(journeys):
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            admin_id = self.admin_ids[i % len(self.admin_ids)]
+            tasks.append(asyncio.create_task(self.journey(first_user_id + i, admin_id)))
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - started
+
+    def report(self, elapsed: float) -> list:
+        steps = sum(len(values) for values in self.latencies.values())
+        lines = [
+            f"Путей: завершено {self.completed}, обновлений обработано {steps} за {elapsed:.1f} с "
+            f"— {steps / elapsed:.1f} обновлений/с, {self.completed / elapsed:.2f} путей/с",
+            f"{'обработчик':<30}{'n':>6}{'ошибок':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}",
+        ]
+        for name, values in self.latencies.items():
+            if values:
+                p50, p95, p99 = (percentile(values, q) * 1000 for q in (50, 95, 99))
+                lines.append(f"{name:<30}{len(values):>6}{self.failures[name]:>8}"
+                             f"{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}{max(values) * 1000:>10.1f}")
+            else:
+                lines.append(f"{name:<30}{0:>6}{self.failures[name]:>8}")
+        if self.failures["payment_not_confirmed"]:
+            lines.append(f"Платёж не подтверждён (ошибка Outline и т.п.): {self.failures['payment_not_confirmed']}")
+        return lines
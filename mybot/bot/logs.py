@@ -0,0 +1,173 @@
+# logs.py Логирование без файлового ввода-вывода в цикле событий: очередь, JSON-строки, ротация
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import time
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional
+from django.conf import settings
+from telegram import Update
+
+# Поля текущего обновления (update_id, user_id, handler); задача обработки обновления — свой контекст
+log_context: ContextVar[Optional[dict]] = ContextVar("log_context", default=None)
+CONTEXT_FIELDS = ("update_id", "user_id", "handler")
+
+_listener: Optional[QueueListener] = None
+_enqueue: Optional[QueueHandler] = None
+
+
+def bind(**fields) -> None:
+    """Добавляет поля ко всем записям лога до конца обработки текущего обновления."""
+    log_context.set({**(log_context.get() or {}), **fields})
+
+
+def describe_update(update) -> str:
+    """Имя обработчика до его выбора: команда или действие кнопки (CallbackRouter уточнит)."""
+    if update.callback_query is not None:
+        from bot.callbacks import decode
+        data = decode(update.callback_query.data or "")
+        return f"callback:{data.action.name}" if data else "callback"
+    message = update.effective_message
+    if message is not None and message.text and message.text.startswith("/"):
+        return message.text.split()[0].split("@")[0]
+    return "message" if message is not None else "update"
+
+
+async def bind_update_context(update: Update, context) -> None:
+    """Задаёт поля лога до того, как сработают обработчики (вызывается из tracing.trace_update, группа -1)."""
+    user = update.effective_user
+    log_context.set({
+        "update_id": update.update_id,
+        "user_id": user.id if user else None,
+        "handler": describe_update(update),
+    })
+
+
+class ContextFilter(logging.Filter):
+    # Выполняется в потоке, который пишет в лог, поэтому видит контекст текущего обновления
+    def filter(self, record):
+        fields = log_context.get()
+        if fields:
+            record.__dict__.update(fields)
+        return True
+
+
+class EnqueueHandler(QueueHandler):
+    """
+    QueueHandler, который в вызывающем потоке только подставляет аргументы в сообщение
+    и кладёт запись в очередь; форматирование в JSON, трассировку исключения и запись
+    в файл выполняет поток QueueListener.
+    """
+
+    def prepare(self, record):
+        if not record.args:
+            # Сообщение уже готовая строка (f-строка) — запись уходит в очередь как есть
+            return record
+        # Аргументы могут измениться, пока запись ждёт в очереди: подставляем их сейчас в копию
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON: время, уровень, логгер, сообщение, поля обновления, исключение."""
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        trace = getattr(record, "trace", None)
+        if trace is not None:
+            entry["trace"] = trace
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+    def formatTime(self, record, datefmt=None):
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}"
+
+
+class RotatingJsonFileHandler(RotatingFileHandler):
+    """
+    Файл лога с ротацией и по размеру (max_bytes), и по времени (раз в `interval` секунд):
+    bot.log → bot.log.1 → … → bot.log.N, старше N файлов удаляются.
+    """
+
+    def __init__(self, filename, max_bytes: int, interval: float, backup_count: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        self.interval = interval
+        # Отсчёт от последней записи в существующий файл, чтобы перезапуски не откладывали ротацию
+        started = os.stat(self.baseFilename).st_mtime if os.path.exists(self.baseFilename) else time.time()
+        self.rollover_at = started + interval
+
+    def shouldRollover(self, record):
+        if self.interval and time.time() >= self.rollover_at and os.path.exists(self.baseFilename):
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+
+def file_handler(filename=None, logger_name: str = None) -> logging.Handler:
+    handler = RotatingJsonFileHandler(
+        filename or settings.LOG_FILE,
+        max_bytes=settings.LOG_MAX_BYTES,
+        interval=settings.LOG_ROTATE_INTERVAL,
+        backup_count=settings.LOG_BACKUP_COUNT,
+    )
+    handler.setFormatter(JsonFormatter())
+    if logger_name:
+        handler.addFilter(logging.Filter(logger_name))
+    return handler
+
+
+def configure_logging(filename=None) -> QueueListener:
+    """
+    Корневой логгер пишет только в очередь (EnqueueHandler), файл ведёт фоновый QueueListener.
+    Трассы медленных обновлений (логгер bot.trace) дополнительно пишутся в TRACE_LOG_FILE.
+    Повторный вызов ничего не меняет. Очередь сбрасывается в файл при выходе из процесса.
+    """
+    global _listener, _enqueue
+    if _listener is not None:
+        return _listener
+    records = queue.SimpleQueue()
+    _enqueue = EnqueueHandler(records)
+    _enqueue.addFilter(ContextFilter())
+    root = logging.getLogger()
+    root.setLevel(settings.LOG_LEVEL)
+    root.addHandler(_enqueue)
+    handlers = [file_handler(filename)]
+    if settings.TRACE_LOG_FILE:
+        handlers.append(file_handler(settings.TRACE_LOG_FILE, logger_name="bot.trace"))
+    _listener = QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging() -> None:
+    """Дописывает оставшиеся в очереди записи и останавливает поток записи."""
+    global _listener, _enqueue
+    if _listener is None:
+        return
+    logging.getLogger().removeHandler(_enqueue)
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = _enqueue = None
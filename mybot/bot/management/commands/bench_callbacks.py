@@ -0,0 +1,99 @@
+# bench_callbacks.py Стоимость выбора обработчика для нажатия кнопки
+import random
+import time
+from django.core.management.base import BaseCommand
+from telegram import Bot, Update
+from telegram.ext import CallbackQueryHandler
+from bot.callbacks import Action, CallbackRouter, decode, encode
+
+# Цепочка обработчиков кнопок в том виде, в котором она была зарегистрирована до CallbackRouter
+LEGACY_PATTERNS = [
+    r"^user_request$",
+    r"^tariff_",
+    r"^admin_",
+    r"^payment_",
+    r"^tariff_",
+    r"^user_request$",
+    r"^user_paid_",
+    r"^renew_(yes|no)_\d+$",
+]
+
+
+async def _noop(*args):
+    return None
+
+
+def legacy_buttons(user_id):
+    return [
+        "user_request", f"tariff_3months_{user_id}", f"user_paid_{user_id}", f"renew_yes_{user_id}",
+        f"admin_approve_{user_id}", f"payment_success_{user_id}",
+    ]
+
+
+def packed_buttons(user_id):
+    return [
+        encode(Action.USER_REQUEST), encode(Action.TARIFF, user_id, 3), encode(Action.USER_PAID, user_id),
+        encode(Action.RENEW, user_id, True), encode(Action.ADMIN_DECISION, user_id, True),
+        encode(Action.PAYMENT, user_id, True),
+    ]
+
+
+def callback_update(bot, update_id, user_id, data):
+    return Update.de_json({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": "bench",
+            "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+            "data": data,
+        },
+    }, bot)
+
+
+class Command(BaseCommand):
+    help = ("Сравнивает выбор обработчика кнопки цепочкой регулярных выражений с разбором "
+            "query.data.split('_') и CallbackRouter (одна таблица действий, разбор один раз).")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--updates", type=int, default=100000, help="Сколько нажатий обработать")
+        parser.add_argument("--users", type=int, default=1000, help="Сколько разных пользователей")
+
+    def legacy_dispatch(self, handlers, update):
+        for handler in handlers:
+            if handler.check_update(update):
+                # каждый обработчик заново разбирал строку сам
+                parts = update.callback_query.data.split("_")
+                return handler, parts
+        return None
+
+    def measure(self, dispatch, updates):
+        started = time.perf_counter()
+        for update in updates:
+            dispatch(update)
+        return (time.perf_counter() - started) / len(updates) * 1e9
+
+    def handle(self, *args, **options):
+        bot = Bot("1:bench")
+        rng = random.Random(1)
+        count, users = options["updates"], options["users"]
+        clicks = [(100000 + rng.randrange(users), rng.randrange(6)) for _ in range(count)]
+        legacy = [callback_update(bot, i, uid, legacy_buttons(uid)[kind]) for i, (uid, kind) in enumerate(clicks)]
+        packed = [callback_update(bot, i, uid, packed_buttons(uid)[kind]) for i, (uid, kind) in enumerate(clicks)]
+
+        handlers = [CallbackQueryHandler(_noop, pattern=pattern) for pattern in LEGACY_PATTERNS]
+        router = CallbackRouter({action: _noop for action in Action})
+
+        regex = self.measure(lambda update: self.legacy_dispatch(handlers, update), legacy)
+        decode.cache_clear()
+        cold = self.measure(router.check_update, packed)
+        warm = self.measure(router.check_update, packed)
+        decode.cache_clear()
+        legacy_router = self.measure(router.check_update, legacy)
+
+        self.stdout.write(f"Нажатий: {count}, пользователей: {users}")
+        self.stdout.write(f"Регулярные выражения + split:      {regex:8.0f} нс/нажатие")
+        self.stdout.write(f"CallbackRouter, первое нажатие:    {cold:8.0f} нс/нажатие")
+        self.stdout.write(f"CallbackRouter, повторное нажатие: {warm:8.0f} нс/нажатие")
+        self.stdout.write(f"CallbackRouter, старые кнопки:     {legacy_router:8.0f} нс/нажатие")
+        self.stdout.write(f"Длина callback_data: {max(map(len, packed_buttons(10 ** 12)))} символов "
+                          f"против {max(map(len, legacy_buttons(10 ** 12)))}")
@@ -0,0 +1,102 @@
+# bench_persistence.py Накладные расходы DjangoPersistence на одно обновление
+import asyncio
+import time
+from django.core.management.base import BaseCommand
+from telegram import Update
+from telegram.ext import Application, CommandHandler, ConversationHandler, MessageHandler, filters
+from bot.fake_telegram import InMemoryBotRequest
+from bot.models import BotState
+from bot.persistence import DjangoPersistence
+
+FIRST_USER_ID = 900000
+
+
+def message_update(update_id, user_id, text):
+    update = {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+            "text": text,
+        },
+    }
+    if text.startswith("/"):
+        update["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return update
+
+
+class Command(BaseCommand):
+    help = "Сравнивает время обработки обновления диалогом с состоянием в памяти и в DjangoPersistence."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--updates", type=int, default=2000, help="Сколько обновлений обработать")
+        parser.add_argument("--users", type=int, default=200, help="Сколько разных пользователей")
+        parser.add_argument("--interval", type=int, default=100,
+                            help="Через сколько обновлений вызывать update_persistence (имитация update_interval)")
+
+    def build(self, persistence):
+        builder = Application.builder().token("1:bench").request(InMemoryBotRequest()).updater(None)
+        if persistence:
+            builder = builder.persistence(persistence)
+        application = builder.build()
+
+        async def begin(update, context):
+            context.user_data["starts"] = context.user_data.get("starts", 0) + 1
+            return 1
+
+        async def finish(update, context):
+            return ConversationHandler.END
+
+        application.add_handler(ConversationHandler(
+            entry_points=[CommandHandler("start", begin)],
+            states={1: [MessageHandler(filters.TEXT & ~filters.COMMAND, finish)]},
+            fallbacks=[],
+            name="bench",
+            persistent=persistence is not None,
+        ))
+        return application
+
+    async def run(self, persistence, updates, users, interval):
+        application = self.build(persistence)
+        async with application:
+            parsed = [
+                Update.de_json(
+                    message_update(i + 1, FIRST_USER_ID + i // 2 % users, "/start" if i % 2 == 0 else "ok"),
+                    application.bot,
+                )
+                for i in range(updates)
+            ]
+            started = time.perf_counter()
+            for i, update in enumerate(parsed, start=1):
+                await application.process_update(update)
+                if persistence and i % interval == 0:
+                    await application.update_persistence()
+            if persistence:
+                await application.update_persistence()
+                await persistence.flush()
+            elapsed = time.perf_counter() - started
+        return elapsed
+
+    def cleanup(self, users):
+        BotState.objects.filter(kind="conversation", namespace="bench").delete()
+        keys = [str(FIRST_USER_ID + i) for i in range(users)]
+        BotState.objects.filter(kind__in=["user", "chat"], key__in=keys).delete()
+
+    def handle(self, *args, **options):
+        updates, users, interval = options["updates"], options["users"], options["interval"]
+        self.cleanup(users)
+        try:
+            memory = asyncio.run(self.run(None, updates, users, interval))
+            persistence = DjangoPersistence(flush_delay=0)
+            stored = asyncio.run(self.run(persistence, updates, users, interval))
+        finally:
+            self.cleanup(users)
+
+        per_update = lambda total: total / updates * 1e6
+        self.stdout.write(f"Обновлений: {updates}, пользователей: {users}, update_persistence каждые {interval}")
+        self.stdout.write(f"В памяти:          {per_update(memory):8.1f} мкс/обновление")
+        self.stdout.write(f"DjangoPersistence: {per_update(stored):8.1f} мкс/обновление "
+                          f"(+{per_update(stored - memory):.1f}), записей в БД: {persistence.flushes}, "
+                          f"строк: {persistence.rows_written}")
@@ -0,0 +1,57 @@
+# bench_repository.py Пропускная способность доступа к БД из асинхронного кода
+import asyncio
+import time
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand
+from bot.models import Clients
+from bot.db import run_db
+
+FIRST_USER_ID = 910000
+
+
+class Command(BaseCommand):
+    help = ("Сравнивает чтение клиентов по user_id через sync_to_async по умолчанию "
+            "(один поток на процесс, как и aget в Django) и через пул потоков bot.db "
+            "при разном числе одновременных обработчиков.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=400, help="Сколько чтений на каждый уровень")
+        parser.add_argument("--concurrency", default="1,4,16,64", help="Уровни параллельности через запятую")
+        parser.add_argument("--latency", type=float, default=0.002,
+                            help="Дополнительная задержка на запрос, сек (сетевой RTT до MySQL)")
+
+    def read(self, user_id, latency):
+        client = Clients.objects.filter(user_id=user_id).first()
+        if latency:
+            time.sleep(latency)
+        return client
+
+    async def run(self, call, requests, concurrency, latency):
+        ids = iter(range(requests))
+
+        async def worker():
+            for i in ids:
+                await call(FIRST_USER_ID + i % 100, latency)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return requests / (time.perf_counter() - started)
+
+    def handle(self, *args, **options):
+        requests, latency = options["requests"], options["latency"]
+        levels = [int(x) for x in options["concurrency"].split(",")]
+        Clients.objects.bulk_create(
+            [Clients(user_id=FIRST_USER_ID + i, name=f"bench{i}") for i in range(100)],
+            ignore_conflicts=True,
+        )
+        thread_sensitive = sync_to_async(self.read)
+        executor = lambda user_id, latency: run_db(self.read, user_id, latency)
+        try:
+            self.stdout.write(f"Чтений на уровень: {requests}, задержка {latency * 1000:.1f}ms")
+            self.stdout.write(f"{'параллельно':>12} {'sync_to_async':>15} {'repository':>12}")
+            for level in levels:
+                single = asyncio.run(self.run(thread_sensitive, requests, level, latency))
+                pooled = asyncio.run(self.run(executor, requests, level, latency))
+                self.stdout.write(f"{level:>12} {single:>11.0f}/с {pooled:>8.0f}/с")
+        finally:
+            Clients.objects.filter(user_id__range=(FIRST_USER_ID, FIRST_USER_ID + 99)).delete()
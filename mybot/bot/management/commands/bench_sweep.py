@@ -0,0 +1,213 @@
+# bench_sweep.py Масштабируемость ежедневной проверки подписок на синтетической базе клиентов
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from bot.fake_outline import FakeOutline
+from bot.fake_telegram import FakeBotApi
+from bot.loadtest import ServerThread
+from bot.models import Clients, OutboxMessage
+
+# Синтетические клиенты бенчмарка: id не пересекаются ни с настоящими, ни с нагрузочным тестом
+FIRST_USER_ID = 8_000_000_000
+VPN_PREFIX = "bench-"
+
+# Доли клиентов по статусу и тарифу (месяцев) — примерно как в рабочей базе
+STATUSES = (("approved", 0.8), ("pending", 0.15), ("rejected", 0.05))
+TARIFFS = ((1, 0.5), (3, 0.3), (6, 0.2))
+# Доля одобренных клиентов, которых прошлые запуски не смогли отключить (ключ не отозвался, пропуск cron)
+OVERDUE_SHARE = 0.005
+
+
+def _bench_clients():
+    return Clients.objects.filter(user_id__gte=FIRST_USER_ID, user_id__lt=FIRST_USER_ID + 10 ** 9)
+
+
+def _cleanup():
+    _bench_clients().delete()
+    OutboxMessage.objects.filter(chat_id__gte=FIRST_USER_ID, chat_id__lt=FIRST_USER_ID + 10 ** 9).delete()
+
+
+def _parse_prom(path: str) -> dict:
+    """Читает значения из файла метрик проверки подписок: {"имя{метки}": число}."""
+    values = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line and not line.startswith("#"):
+                name, _, value = line.rpartition(" ")
+                values[name] = float(value)
+    return values
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=settings.BASE_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = ("Заполняет БД синтетическими клиентами (статусы, тарифы и даты окончания подписки "
+            "распределены как в рабочей базе), запускает check_subscriptions отдельным процессом "
+            "против поддельных Bot API и Outline и записывает для каждого размера время, пиковую память, "
+            "число запросов к БД и скорость рассылки в JSON — для сравнения версий между собой. "
+            "Запускать на отдельной БД.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="10000,100000",
+                            help="Размеры базы через запятую, например 10000,100000,1000000")
+        parser.add_argument("--output", default="bench_sweep.json", help="Куда записать результаты (JSON)")
+        parser.add_argument("--seed", type=int, default=1, help="Зерно генератора распределений")
+        parser.add_argument("--outbox-rate", type=float, default=1000,
+                            help="OUTBOX_RATE для проверки: по умолчанию выше лимита Telegram, "
+                                 "чтобы мерить пропускную способность кода, а не ограничителя")
+        parser.add_argument("--chunk-size", type=int, default=settings.SWEEP_CHUNK_SIZE,
+                            help="Размер порции check_subscriptions")
+        parser.add_argument("--outline-latency", type=float, default=0.02, help="Задержка ответа Outline, сек")
+        parser.add_argument("--outline-jitter", type=float, default=0.01, help="Разброс задержки Outline, сек")
+        parser.add_argument("--bot-api-rtt", type=float, default=0.0, help="Задержка ответа Bot API, сек")
+
+    def seed(self, size: int, today, rng: random.Random) -> dict:
+        """
+        Создаёт `size` клиентов. У одобренных дата окончания равномерно распределена по сроку тарифа
+        (клиенты оформляли подписку в разные дни), поэтому завтра и сегодня истекает около 1/срок из них;
+        небольшая доля просрочена на несколько дней.
+        """
+        statuses, status_weights = zip(*STATUSES)
+        tariffs, tariff_weights = zip(*TARIFFS)
+        expected = {"expiring": 0, "expired": 0}
+        batch = []
+        for i in range(size):
+            user_id = FIRST_USER_ID + i
+            status = rng.choices(statuses, status_weights)[0]
+            client = Clients(user_id=user_id, name=f"bench{i}", password="", method="", status=status)
+            if status == "approved":
+                months = rng.choices(tariffs, tariff_weights)[0]
+                if rng.random() < OVERDUE_SHARE:
+                    days_left = -rng.randint(1, 7)
+                else:
+                    days_left = rng.randint(0, months * 30)
+                end = today + timedelta(days=days_left)
+                client.tariff = str(months)
+                client.payment_status = "paid"
+                client.vpn_id = f"{VPN_PREFIX}{user_id}"
+                client.access_url = f"ss://{VPN_PREFIX}{user_id}@127.0.0.1:443/?outline=1"
+                client.subscription_start_date = end - timedelta(days=months * 30)
+                client.subscription_end_date = end
+                if days_left == 1:
+                    expected["expiring"] += 1
+                elif days_left <= 0:
+                    expected["expired"] += 1
+            elif status == "pending" and rng.random() < 0.3:
+                client.payment_status = "awaiting_verification"
+            batch.append(client)
+            if len(batch) == 10000:
+                Clients.objects.bulk_create(batch)
+                batch = []
+        Clients.objects.bulk_create(batch)
+        return expected
+
+    def sweep(self, env: dict, chunk_size: int):
+        """Запускает check_subscriptions и возвращает (время, пиковая память в МБ, код выхода)."""
+        command = [sys.executable, os.path.join(settings.BASE_DIR, "manage.py"), "check_subscriptions",
+                   "--chunk-size", str(chunk_size), "--deliver"]
+        started = time.perf_counter()
+        process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - started
+        process.returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss в Linux — в килобайтах, в macOS — в байтах
+        peak_rss = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+        return elapsed, peak_rss, process.returncode
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options["sizes"].split(",")]
+        except ValueError:
+            raise CommandError("--sizes: размеры через запятую, например 10000,100000")
+        if Clients.objects.exclude(user_id__gte=FIRST_USER_ID).exists():
+            raise CommandError("В БД есть настоящие клиенты — запустите бенчмарк на отдельной БД: "
+                               "check_subscriptions обработает всех клиентов, а не только синтетических.")
+        _cleanup()
+
+        api = FakeBotApi(rtt=options["bot_api_rtt"])
+        outline = FakeOutline(latency=options["outline_latency"], jitter=options["outline_jitter"],
+                              seed=options["seed"])
+        results = []
+        with ServerThread(api, outline) as servers, tempfile.TemporaryDirectory() as tmp:
+            api_url, outline_url = servers.urls
+            metrics_file = os.path.join(tmp, "sweep.prom")
+            env = dict(
+                os.environ,
+                BOT_API_BASE_URL=f"{api_url}/bot",
+                VPN_BASE_URL=f"{outline_url}/bench/access-keys/",
+                METRICS_SWEEP_FILE=metrics_file,
+                OUTBOX_RATE=str(options["outbox_rate"]),
+            )
+            for size in sizes:
+                today = timezone.now().date()
+                started = time.perf_counter()
+                expected = self.seed(size, today, random.Random(options["seed"]))
+                seeded = time.perf_counter() - started
+                self.stdout.write(f"Клиентов: {size} (создано за {seeded:.1f} с), истекает завтра: "
+                                  f"{expected['expiring']}, к отключению: {expected['expired']}")
+
+                api.calls.clear()
+                outline.requests = 0
+                try:
+                    wall, peak_rss, code = self.sweep(env, options["chunk_size"])
+                    if code != 0:
+                        raise CommandError(f"check_subscriptions завершилась с кодом {code}")
+                    metrics = _parse_prom(metrics_file)
+                finally:
+                    _cleanup()
+
+                sent = int(metrics.get('bot_sweep_messages{result="sent"}', 0))
+                delivery = metrics['bot_sweep_duration_seconds{stage="delivery"}']
+                result = {
+                    "clients": size,
+                    "expiring": int(metrics.get('bot_sweep_clients{stage="expiring"}', 0)),
+                    "disabled": int(metrics.get('bot_sweep_clients{stage="disabled"}', 0)),
+                    "revoke_failed": int(metrics.get('bot_sweep_clients{stage="revoke_failed"}', 0)),
+                    "wall_seconds": round(wall, 3),
+                    "sweep_seconds": {
+                        stage: metrics[f'bot_sweep_duration_seconds{{stage="{stage}"}}']
+                        for stage in ("expiring", "expired", "delivery", "total")
+                    },
+                    "peak_rss_mb": round(peak_rss, 1),
+                    "db_queries": int(metrics.get("bot_sweep_db_queries", 0)),
+                    "messages_sent": sent,
+                    "messages_failed": int(metrics.get('bot_sweep_messages{result="failed"}', 0)),
+                    "messages_per_second": round(sent / delivery, 1) if delivery else None,
+                    "bot_api_calls": len(api.calls),
+                    "outline_requests": outline.requests,
+                }
+                results.append(result)
+                self.stdout.write(
+                    f"  время {result['wall_seconds']:.2f} с (проверка {result['sweep_seconds']['total']:.2f} с), "
+                    f"память {result['peak_rss_mb']:.1f} МБ, запросов к БД {result['db_queries']}, "
+                    f"сообщений {sent} — {result['messages_per_second']}/с"
+                )
+
+        report = {
+            "revision": _git_revision(),
+            "created_at": timezone.now().isoformat(),
+            "python": platform.python_version(),
+            "database": connection.vendor,
+            "options": {key: options[key] for key in (
+                "seed", "outbox_rate", "chunk_size", "outline_latency", "outline_jitter", "bot_api_rtt")},
+            "results": results,
+        }
+        with open(options["output"], "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        self.stdout.write(f"Результаты записаны в {options['output']}")
@@ -1,117 +1,126 @@
 # check_subscriptions.py:
 import logging
 import asyncio
+import time
 from datetime import timedelta
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-import httpx
-from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot
 from django.conf import settings
-from bot.models import Clients
-from babel.dates import format_date
-from asgiref.sync import sync_to_async
-from bot.admin_handlers import get_tariff_keyboard
+from bot import expiry
+from bot.outbox import OutboxWorker
+from bot.vpn_service import close_outline_client
+from bot.db import close_db_connections
+from bot.metrics import DB_QUERY_LATENCY, Gauge, Registry
 
 logger = logging.getLogger(__name__)
-VPN_BASE_URL = settings.VPN_BASE_URL
 
 class Command(BaseCommand):
     help = ("Проверяет подписки пользователей и отправляет уведомления:\n"
             " – если подписка истекает завтра, спрашивает, хотите продлить подписку;\n"
-            " – если подписка закончилась, отключает клиента и уведомляет о необходимости подать новую заявку.")
+            " – если подписка закончилась, отключает клиента и уведомляет о необходимости подать новую заявку.\n"
+            "Обычно это делает планировщик в процессе бота (EXPIRY_SCHEDULER); команда — для cron без него "
+            "и ручного запуска.")
 
-    async def send_renewal_notification(self, bot, client):
-        """Отправляет уведомление с вопросом о продлении подписки."""
+    async def handle_async(self):
+        today = timezone.now().date()
+        self.durations, self.counts, self.outbox = {}, {}, None
+        started = time.perf_counter()
+        succeeded = False
         try:
-            formatted_date = format_date(client.subscription_end_date, format="d MMMM yyyy", locale="ru")
-            message_text = (
-                f"⚠️ Ваша подписка истекает завтра ({formatted_date}).\n"
-                "Хотите продлить подписку?"
-            )
-            # Кнопки для выбора: "Да" и "Нет"
-            keyboard = [
-                [InlineKeyboardButton("✅ Да", callback_data=f"renew_yes_{client.user_id}")],
-                [InlineKeyboardButton("❌ Нет", callback_data=f"renew_no_{client.user_id}")]
-            ]
-            markup = InlineKeyboardMarkup(keyboard)
-            await bot.send_message(chat_id=client.user_id, text=message_text, reply_markup=markup)
-            self.stdout.write(f"[Уведомление] Клиент {client.user_id}: подписка истекает {formatted_date}")
-        except Exception as e:
-            logger.error(f"Ошибка при отправке уведомления клиенту {client.user_id}: {e}")
+            async with Bot(token=settings.TOKEN, base_url=settings.BOT_API_BASE_URL) as bot:
+                await self.run_sweep(bot, today)
+            succeeded = True
+        finally:
+            self.durations["total"] = time.perf_counter() - started
+            await close_outline_client()
+            await close_db_connections()
+            if settings.METRICS_SWEEP_FILE:
+                self.write_metrics(succeeded)
 
-    async def send_expired_notification(self, bot, client):
-        """
-        Отправляет уведомление клиенту, что его подписка закончилась,
-        и предлагает подать новую заявку (аналогично кнопке /start).
-        """
+    def write_metrics(self, succeeded: bool):
+        """Итоги запуска для эндпоинта метрик бота: файл в текстовом формате Prometheus."""
+        registry = Registry()
+        Gauge("bot_sweep_last_run_timestamp_seconds", "Время окончания последней проверки подписок",
+              registry=registry).set(int(time.time()))
+        Gauge("bot_sweep_success", "Завершилась ли последняя проверка подписок без ошибок",
+              registry=registry).set(int(succeeded))
+        duration = Gauge("bot_sweep_duration_seconds", "Длительность этапов последней проверки подписок",
+                         ("stage",), registry=registry)
+        for stage, seconds in self.durations.items():
+            duration.set(round(seconds, 3), stage)
+        Gauge("bot_sweep_db_queries", "Запросов к БД за последнюю проверку подписок",
+              registry=registry).set(DB_QUERY_LATENCY.count())
+        clients = Gauge("bot_sweep_clients", "Клиентов на этапах последней проверки подписок",
+                        ("stage",), registry=registry)
+        for stage, count in self.counts.items():
+            clients.set(count, stage)
+        if self.outbox is not None:
+            messages = Gauge("bot_sweep_messages", "Итоги рассылки последней проверки подписок",
+                             ("result",), registry=registry)
+            for result in ("sent", "blocked", "failed", "retried"):
+                messages.set(getattr(self.outbox.summary, result), result)
         try:
-            message_text = (
-                "❌ Ваша подписка закончилась, вы больше не можете пользоваться VPN.\n"
-                "Чтобы продолжить, пожалуйста, подайте новую заявку."
-            )
-            keyboard = [
-                [InlineKeyboardButton("Подать заявку", callback_data="user_request")]
-            ]
-            markup = InlineKeyboardMarkup(keyboard)
-            await bot.send_message(chat_id=client.user_id, text=message_text, reply_markup=markup)
-            self.stdout.write(f"[Уведомление] Клиент {client.user_id}: уведомление об окончании подписки отправлено.")
-        except Exception as e:
-            logger.error(f"Ошибка при отправке уведомления об окончании подписки клиенту {client.user_id}: {e}")
+            registry.write(settings.METRICS_SWEEP_FILE)
+        except OSError as e:
+            logger.error(f"Не удалось записать метрики проверки подписок: {e}")
 
-    async def get_expiring_clients(self, date):
-        """Возвращает список клиентов с подпиской, истекающей ровно в 'date'."""
-        return await sync_to_async(list)(Clients.objects.filter(status="approved", subscription_end_date=date))
-
-    async def get_expired_clients(self, date):
-        """Возвращает список клиентов, у которых подписка закончилась (<= 'date')."""
-        return await sync_to_async(list)(Clients.objects.filter(status="approved", subscription_end_date__lte=date))
-
-    async def handle_async(self):
-        today = timezone.now().date()
-        bot = Bot(token=settings.TOKEN)
+    async def run_sweep(self, bot, today):
+        # Уведомления пишутся в outbox (повторный запуск за тот же день их не дублирует) и доставляются
+        # воркером бота; с --deliver — этой же командой, если бот не запущен
 
         # 1. Уведомление клиентам, у которых подписка истекает завтра:
+        stage_started = time.perf_counter()
         notify_date = today + timedelta(days=1)
-        expiring_clients = await self.get_expiring_clients(notify_date)
-        self.stdout.write(f"[DEBUG] Найдено {len(expiring_clients)} клиентов с подпиской, истекающей {notify_date}")
-        for client in expiring_clients:
-            await self.send_renewal_notification(bot, client)
+        expiring = 0
+        async for chunk in expiry.iter_chunks(self.chunk_size, status="approved", subscription_end_date=notify_date):
+            expiring += len(chunk)
+            await expiry.remind(chunk)
+        self.counts["expiring"] = expiring
+        self.durations["expiring"] = time.perf_counter() - stage_started
+        self.stdout.write(f"[DEBUG] Найдено {expiring} клиентов с подпиской, истекающей {notify_date}")
 
         # 2. Обработка клиентов с истекшей подпиской (<= сегодня):
-        expired_clients = await self.get_expired_clients(today)
-        for client in expired_clients:
-            # 1) удаляем ключ на стороне VPN
-            if client.vpn_id:
-                delete_url = f"{VPN_BASE_URL}{client.vpn_id}"
-                try:
-                    resp = await asyncio.get_running_loop().run_in_executor(
-                        None, lambda: httpx.delete(delete_url, verify=False)
-                    )
-                    if resp.status_code == 204:
-                        self.stdout.write(f"[Отключение] Клиент {client.user_id} отключен (vpn_id: {client.vpn_id})")
-                    else:
-                        self.stdout.write(f"[Ошибка] Не удалось отключить клиента {client.user_id}, статус {resp.status_code}")
-                except Exception as e:
-                    logger.error(f"Ошибка при отключении клиента {client.user_id}: {e}")
-
-            # 2) Очищаем локально все поля ключа
-            client.vpn_id           = ""
-            client.access_url       = ""
-            client.password         = ""
-            client.port             = 0
-            client.method           = ""
-            client.payment_status   = "not_paid"
-            client.status           = "pending"
-            client.tariff = ""
-            # при желании можно и subscription_start_date/subscription_end_date занулять,
-            # но обычно они остаются для истории
+        stage_started = time.perf_counter()
+        disabled = failed = 0
+        async for chunk in expiry.iter_chunks(self.chunk_size, status="approved", subscription_end_date__lte=today):
+            # Ключи отзываются параллельно, поля очищаются одним запросом на порцию,
+            # уведомления о новой заявке пишутся в outbox той же транзакцией
+            disabled_clients, failed_clients = await expiry.expire(chunk, self.revoke_concurrency, today)
+            for client in failed_clients:
+                # Ключ ещё активен: статус не тронут, следующий запуск повторит попытку
+                self.stdout.write(f"[Ошибка] Не удалось отключить клиента {client.user_id} (vpn_id: {client.vpn_id})")
+            disabled += len(disabled_clients)
+            failed += len(failed_clients)
 
-            await sync_to_async(client.save)()
-            self.stdout.write(f"[Обновление] Клиент {client.user_id}: сброшен ключ и переведен в 'pending'")
+        self.counts["disabled"], self.counts["revoke_failed"] = disabled, failed
+        self.durations["expired"] = time.perf_counter() - stage_started
+        self.stdout.write(f"[Обновление] Отключено клиентов: {disabled}, не удалось отозвать ключ: {failed}")
 
-            # 3) шлём пользователю уведомление о том, что нужно заново подать заявку
-            await self.send_expired_notification(bot, client)
+        # 3. Доставка уведомлений из outbox
+        if self.deliver:
+            stage_started = time.perf_counter()
+            outbox = self.outbox = OutboxWorker(bot)
+            await outbox.drain()
+            self.durations["delivery"] = time.perf_counter() - stage_started
+            self.stdout.write(f"[Рассылка] Итоги: {outbox.summary}")
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--revoke-concurrency", type=int, default=settings.OUTLINE_REVOKE_CONCURRENCY,
+            help="Сколько ключей отзывать одновременно",
+        )
+        parser.add_argument(
+            "--chunk-size", type=int, default=settings.SWEEP_CHUNK_SIZE,
+            help="Сколько клиентов обрабатывать за один проход",
+        )
+        parser.add_argument(
+            "--deliver", action="store_true",
+            help="Доставить уведомления из outbox самой командой — только если бот не запущен",
+        )
 
     def handle(self, *args, **options):
+        self.revoke_concurrency = options["revoke_concurrency"]
+        self.chunk_size = options["chunk_size"]
+        self.deliver = options["deliver"]
         asyncio.run(self.handle_async())
@@ -0,0 +1,53 @@
+# dbcheck.py Проверка соединений с БД из пула бота
+import asyncio
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from bot.db import close_db_connections, db_pool, run_db
+from bot.models import Clients
+
+
+class Command(BaseCommand):
+    help = ("Выполняет запросы через пул потоков БД бота и печатает его метрики: размер, открытые "
+            "соединения, переподключения и время ожидания потока. С --idle повторяет запросы после паузы, "
+            "чтобы проверить переоткрытие соединений старше CONN_MAX_AGE.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--queries", type=int, default=200, help="Сколько запросов выполнить за проход")
+        parser.add_argument("--concurrency", type=int, default=32, help="Одновременных запросов")
+        parser.add_argument("--idle", type=float, default=0, help="Пауза перед вторым проходом, сек")
+
+    async def burst(self, queries, concurrency):
+        ids = iter(range(queries))
+
+        async def worker():
+            for _ in ids:
+                await run_db(Clients.objects.exists)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    def report(self, title):
+        stats = db_pool.stats()
+        self.stdout.write(
+            f"{title}: потоков {stats['size']}, соединений {stats['open_connections']}, "
+            f"подключений {stats['connects']}, запросов {stats['jobs']}, "
+            f"ожидание avg {stats['wait_avg_ms']:.2f}ms max {stats['wait_max_ms']:.2f}ms"
+        )
+
+    async def run(self, queries, concurrency, idle):
+        self.report("Старт")
+        await self.burst(queries, concurrency)
+        self.report("Проход 1")
+        if idle:
+            await asyncio.sleep(idle)
+            await self.burst(queries, concurrency)
+            self.report(f"Проход 2 (после {idle:g} с)")
+        await close_db_connections()
+        self.report("Закрыто")
+
+    def handle(self, *args, **options):
+        database = settings.DATABASES["default"]
+        self.stdout.write(
+            f"БД: {database['ENGINE']}, CONN_MAX_AGE={database.get('CONN_MAX_AGE', 0)}, "
+            f"CONN_HEALTH_CHECKS={database.get('CONN_HEALTH_CHECKS', False)}"
+        )
+        asyncio.run(self.run(options["queries"], options["concurrency"], options["idle"]))
@@ -0,0 +1,89 @@
+# loadtest.py Нагрузочный тест бота с поддельными Bot API и Outline
+import asyncio
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from bot.bot import build_application
+from bot.db import run_db
+from bot.fake_outline import KEY_PREFIX, FakeOutline
+from bot.fake_telegram import FakeBotApi
+from bot.loadtest import FIRST_USER_ID, JourneyDriver, LocalServer
+from bot.models import Clients, OutboxMessage, PooledKey
+
+
+def _cleanup(journeys):
+    deleted, _ = Clients.objects.filter(user_id__gte=FIRST_USER_ID, user_id__lt=FIRST_USER_ID + journeys).delete()
+    PooledKey.objects.filter(vpn_id__startswith=KEY_PREFIX).delete()
+    OutboxMessage.objects.filter(chat_id__gte=FIRST_USER_ID, chat_id__lt=FIRST_USER_ID + journeys).delete()
+    return deleted
+
+
+class Command(BaseCommand):
+    help = ("Запускает бота целиком (polling, обработчики, БД, пул ключей) против поддельных Bot API "
+            "и Outline на локальных портах, проводит синтетических пользователей по пути "
+            "/start → заявка → одобрение → тариф → оплата → подтверждение с заданной частотой "
+            "и выводит пропускную способность и p50/p95/p99 по обработчикам. "
+            "Запускать на отдельной БД: тест создаёт клиентов и выдаёт им ключи.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--journeys", type=int, default=200, help="Сколько пользователей провести по пути")
+        parser.add_argument("--rate", type=float, default=10, help="Сколько новых пользователей в секунду")
+        parser.add_argument("--timeout", type=float, default=30, help="Сколько ждать ответа на шаг, сек")
+        parser.add_argument("--bot-api-rtt", type=float, default=0.0, help="Задержка ответа Bot API, сек")
+        parser.add_argument("--outline-latency", type=float, default=0.05, help="Задержка ответа Outline, сек")
+        parser.add_argument("--outline-jitter", type=float, default=0.02, help="Разброс задержки Outline, сек")
+        parser.add_argument("--outline-error-rate", type=float, default=0.0, help="Доля ответов Outline с ошибкой 500")
+        parser.add_argument("--no-key-pool", action="store_true",
+                            help="Выключить пул ключей: каждый платёж создаёт ключ в Outline")
+        parser.add_argument("--keep", action="store_true", help="Не удалять созданных тестом клиентов и ключи")
+
+    def handle(self, *args, **options):
+        journeys = options["journeys"]
+        if PooledKey.objects.exclude(vpn_id__startswith=KEY_PREFIX).exists() or Clients.objects.filter(
+            user_id__gte=FIRST_USER_ID, user_id__lt=FIRST_USER_ID + journeys
+        ).exists():
+            raise CommandError("В БД есть настоящие ключи пула или клиенты из диапазона теста — "
+                               "запустите тест на отдельной БД (остатки прошлого запуска с --keep нужно удалить).")
+        if options["no_key_pool"]:
+            settings.KEY_POOL_HIGH = 0
+        # Эндпоинт метрик тесту не нужен; проверка подписки на канал остаётся — поддельный Bot API отвечает «member»
+        settings.METRICS_PORT = 0
+        asyncio.run(self.run(options))
+
+    async def run(self, options):
+        api = FakeBotApi(rtt=options["bot_api_rtt"])
+        outline = FakeOutline(
+            latency=options["outline_latency"],
+            jitter=options["outline_jitter"],
+            error_rate=options["outline_error_rate"],
+        )
+        api_server, outline_server = LocalServer(api), LocalServer(outline)
+        await api_server.start()
+        await outline_server.start()
+        settings.BOT_API_BASE_URL = f"{api_server.url}/bot"
+        settings.VPN_BASE_URL = f"{outline_server.url}/loadtest/access-keys/"
+
+        application = build_application()
+        driver = JourneyDriver(api, settings.ADMIN_IDS, timeout=options["timeout"])
+        await application.initialize()
+        await application.post_init(application)
+        await application.start()
+        await application.updater.start_polling(poll_interval=0, timeout=1)
+        try:
+            self.stdout.write(f"Пользователей: {options['journeys']}, частота: {options['rate']}/с")
+            elapsed = await driver.run(options["journeys"], options["rate"])
+        finally:
+            await application.updater.stop()
+            await application.stop()
+            await application.post_stop(application)
+            if not options["keep"]:
+                deleted = await run_db(_cleanup, options["journeys"])
+                self.stdout.write(f"Удалено тестовых записей: {deleted}")
+            await application.shutdown()
+            await application.post_shutdown(application)
+            await api_server.stop()
+            await outline_server.stop()
+
+        for line in driver.report(elapsed):
+            self.stdout.write(line)
+        self.stdout.write(f"Outline: запросов {outline.requests}, ошибок {outline.errors}; "
+                          f"вызовов Bot API: {len(api.calls)}")
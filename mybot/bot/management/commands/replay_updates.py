@@ -0,0 +1,161 @@
+# replay_updates.py Воспроизведение записанных обновлений Telegram
+import asyncio
+import json
+import statistics
+import time
+import httpx
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+from bot.fake_telegram import InMemoryBotRequest
+from bot.webhook import WebhookApp
+
+
+def synthetic_updates(count):
+    """Сообщения /start от разных пользователей — если файл с записью не передан."""
+    now = int(time.time())
+    for i in range(count):
+        user_id = 500000 + i
+        yield {
+            "update_id": i + 1,
+            "message": {
+                "message_id": i + 1,
+                "date": now,
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"user{i}"},
+                "text": "/start",
+                "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+            },
+        }
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class Command(BaseCommand):
+    help = ("Воспроизводит записанные обновления (JSON по одному в строке): отправляет их POST-запросами "
+            "на локальный webhook или, с --compare, сравнивает задержку доставки в режимах webhook и polling.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", nargs="?", help="Файл с обновлениями; без него используются синтетические /start")
+        parser.add_argument("--url", help="Адрес webhook, например http://127.0.0.1:8443/telegram/webhook/")
+        parser.add_argument("--secret", default=settings.WEBHOOK_SECRET, help="Секрет для X-Telegram-Bot-Api-Secret-Token")
+        parser.add_argument("--count", type=int, default=200, help="Число синтетических обновлений")
+        parser.add_argument("--rate", type=float, default=50, help="Обновлений в секунду")
+        parser.add_argument("--rtt", type=float, default=0.05, help="Сетевая задержка до Telegram в --compare, сек")
+        parser.add_argument("--compare", action="store_true", help="Сравнить webhook и polling в памяти процесса")
+
+    def load_updates(self, path, count):
+        if not path:
+            return list(synthetic_updates(count))
+        with open(path, encoding="utf-8") as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+        # update_id должны возрастать, иначе polling посчитает обновления уже полученными
+        for i, update in enumerate(updates, start=1):
+            update["update_id"] = i
+        return updates
+
+    def report(self, title, latencies):
+        if not latencies:
+            self.stdout.write(f"{title}: нет данных")
+            return
+        ms = [x * 1000 for x in latencies]
+        self.stdout.write(
+            f"{title}: n={len(ms)} mean={statistics.mean(ms):.1f}ms p50={percentile(ms, 50):.1f}ms "
+            f"p95={percentile(ms, 95):.1f}ms p99={percentile(ms, 99):.1f}ms max={max(ms):.1f}ms"
+        )
+
+    async def paced(self, updates, rate):
+        """Выдаёт обновления с заданной частотой."""
+        started = time.perf_counter()
+        for i, update in enumerate(updates):
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield update
+
+    async def post_to_url(self, updates, url, secret, rate):
+        headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+        latencies, statuses = [], {}
+
+        async def post(client, update):
+            started = time.perf_counter()
+            response = await client.post(url, json=update, headers=headers)
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        async with httpx.AsyncClient() as client:
+            tasks = [asyncio.create_task(post(client, update)) async for update in self.paced(updates, rate)]
+            await asyncio.gather(*tasks)
+        self.report("webhook (ответ HTTP)", latencies)
+        self.stdout.write(f"Коды ответов: {statuses}")
+
+    def replay_application(self, pending, rtt, sent_at, latencies):
+        application = Application.builder()\
+            .token("1:replay")\
+            .request(InMemoryBotRequest(pending, rtt))\
+            .get_updates_request(InMemoryBotRequest(pending, rtt))\
+            .build()
+
+        async def record(update, context):
+            latencies.append(time.perf_counter() - sent_at[update.update_id])
+
+        application.add_handler(TypeHandler(Update, record))
+        return application
+
+    async def wait_processed(self, latencies, total, timeout=30):
+        deadline = time.perf_counter() + timeout
+        while len(latencies) < total and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+
+    async def compare_polling(self, updates, rate, rtt):
+        pending, sent_at, latencies = asyncio.Queue(), {}, []
+        application = self.replay_application(pending, rtt, sent_at, latencies)
+        async with application:
+            await application.updater.start_polling(poll_interval=0, timeout=10)
+            await application.start()
+            async for update in self.paced(updates, rate):
+                sent_at[update["update_id"]] = time.perf_counter()
+                pending.put_nowait(update)
+            await self.wait_processed(latencies, len(updates))
+            await application.updater.stop()
+            await application.stop()
+        return latencies
+
+    async def compare_webhook(self, updates, rate, rtt):
+        pending, sent_at, latencies = asyncio.Queue(), {}, []
+        application = self.replay_application(pending, rtt, sent_at, latencies)
+        webhook = WebhookApp(application, secret="replay")
+        transport = httpx.ASGITransport(app=webhook)
+        headers = {"X-Telegram-Bot-Api-Secret-Token": webhook.secret}
+
+        async def deliver(client, update):
+            # Telegram -> сервер бота: половина RTT
+            await asyncio.sleep(rtt / 2)
+            await client.post(webhook.path, json=update, headers=headers)
+
+        async with application, httpx.AsyncClient(transport=transport, base_url="http://replay") as client:
+            await application.start()
+            tasks = []
+            async for update in self.paced(updates, rate):
+                sent_at[update["update_id"]] = time.perf_counter()
+                tasks.append(asyncio.create_task(deliver(client, update)))
+            await asyncio.gather(*tasks)
+            await self.wait_processed(latencies, len(updates))
+            await application.stop()
+        return latencies
+
+    def handle(self, *args, **options):
+        updates = self.load_updates(options["file"], options["count"])
+        if options["compare"]:
+            rate, rtt = options["rate"], options["rtt"]
+            self.stdout.write(f"Обновлений: {len(updates)}, частота {rate}/с, RTT {rtt * 1000:.0f}ms")
+            self.report("polling", asyncio.run(self.compare_polling(updates, rate, rtt)))
+            self.report("webhook", asyncio.run(self.compare_webhook(updates, rate, rtt)))
+        elif options["url"]:
+            asyncio.run(self.post_to_url(updates, options["url"], options["secret"], options["rate"]))
+        else:
+            raise CommandError("Укажите --url работающего webhook или --compare")
@@ -0,0 +1,35 @@
+# revoke_keys.py Отзыв ключей Outline, которые больше не принадлежат ни одному клиенту
+import asyncio
+from django.core.management.base import BaseCommand, CommandError
+from bot.db import close_db_connections, run_db
+from bot.models import Clients
+from bot.vpn_service import close_outline_client, revoke_keys
+
+
+def assigned_keys(vpn_ids: list) -> list:
+    return list(Clients.objects.filter(vpn_id__in=vpn_ids).values_list("vpn_id", flat=True))
+
+
+class Command(BaseCommand):
+    help = ("Удаляет ключи с сервера Outline по vpn_id — например, ключи дубликатов, удалённых "
+            "миграцией 0003. Ключи, которые всё ещё записаны у клиентов, пропускаются.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("vpn_ids", nargs="+", help="vpn_id ключей для отзыва")
+
+    async def run(self, vpn_ids):
+        in_use = set(await run_db(assigned_keys, vpn_ids))
+        for vpn_id in sorted(in_use):
+            self.stdout.write(f"Ключ {vpn_id} выдан клиенту, пропущен")
+        try:
+            return await revoke_keys([vpn_id for vpn_id in vpn_ids if vpn_id not in in_use])
+        finally:
+            await close_outline_client()
+            await close_db_connections()
+
+    def handle(self, *args, **options):
+        results = asyncio.run(self.run(list(dict.fromkeys(options["vpn_ids"]))))
+        failed = [vpn_id for vpn_id, revoked in results.items() if not revoked]
+        self.stdout.write(f"Отозвано ключей: {len(results) - len(failed)}")
+        if failed:
+            raise CommandError(f"Не удалось отозвать: {' '.join(failed)}")
@@ -4,6 +4,16 @@ from bot.bot import main  # Импортируйте основную функц
 class Command(BaseCommand):
     help = "Запускает Telegram-бота"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--webhook", action="store_const", const="webhook", dest="mode",
+            help="Принимать обновления через webhook вместо long polling (по умолчанию BOT_MODE)",
+        )
+        parser.add_argument(
+            "--polling", action="store_const", const="polling", dest="mode",
+            help="Принудительно использовать long polling",
+        )
+
     def handle(self, *args, **options):
         self.stdout.write("Запуск бота...")
-        main()
+        main(options["mode"])
@@ -0,0 +1,342 @@
+# metrics.py Метрики в формате Prometheus: гистограммы задержек, счётчики и локальный эндпоинт /metrics
+import asyncio
+import functools
+import logging
+import math
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Optional
+from django.conf import settings
+from telegram.ext import ConversationHandler
+from telegram.request import HTTPXRequest
+from bot.logs import bind, log_context
+from bot.tracing import record_span
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        (REGISTRY if registry is None else registry).register(self)
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def samples(self) -> list:
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}" for key, value in values.items()]
+
+    def render(self) -> list:
+        return self.header() + self.samples()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """Значение задаётся через set() или читается при каждом сборе функцией `func` ({labels: значение})."""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, func: Optional[Callable] = None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.func = func
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def samples(self) -> list:
+        if self.func is not None:
+            try:
+                values = self.func()
+            except Exception as e:
+                logger.warning(f"Метрика {self.name} не собрана: {e}")
+                return []
+            with self._lock:
+                self._values = values if isinstance(values, dict) else {(): values}
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                # счётчики по корзинам (последняя — +Inf), сумма, количество
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *labels) -> int:
+        """Сколько значений записано в серию с этими метками."""
+        with self._lock:
+            series = self._values.get(labels)
+            return series[2] if series else 0
+
+    def samples(self) -> list:
+        with self._lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+        lines = []
+        for key, (counts, total, count) in values.items():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """Записывает метрики в файл атомарно (для разовых команд, которые не обслуживают /metrics)."""
+        temporary = f"{path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            file.write(self.render())
+        os.replace(temporary, path)
+
+
+REGISTRY = Registry()
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_duration_seconds", "Время работы обработчика обновления", ("handler", "status"),
+)
+UPDATE_DB_QUERIES = Histogram(
+    "bot_update_db_queries", "Запросов к БД за обработку одного обновления", ("handler",), buckets=COUNT_BUCKETS,
+)
+UPDATE_DB_TIME = Histogram(
+    "bot_update_db_seconds", "Суммарное время запросов к БД за обработку одного обновления", ("handler",),
+)
+DB_QUERY_LATENCY = Histogram("bot_db_query_duration_seconds", "Время одного запроса к БД")
+TELEGRAM_LATENCY = Histogram(
+    "bot_telegram_api_duration_seconds", "Время вызова Bot API", ("method",),
+)
+TELEGRAM_ERRORS = Counter(
+    "bot_telegram_api_errors_total", "Неудачные вызовы Bot API: HTTP-код ответа или тип исключения",
+    ("method", "error"),
+)
+OUTLINE_LATENCY = Histogram(
+    "bot_outline_api_duration_seconds", "Время одной попытки запроса к Outline API", ("method", "outcome"),
+)
+
+
+class UpdateStats:
+    __slots__ = ("queries", "db_time")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+
+# Счётчики текущего обновления; sync_to_async копирует контекст в поток БД, объект остаётся общим
+update_stats: ContextVar[Optional[UpdateStats]] = ContextVar("update_stats", default=None)
+
+
+def begin_update() -> UpdateStats:
+    stats = UpdateStats()
+    update_stats.set(stats)
+    return stats
+
+
+def finish_update(stats: UpdateStats) -> None:
+    handler = (log_context.get() or {}).get("handler", "unknown")
+    UPDATE_DB_QUERIES.observe(stats.queries, handler)
+    UPDATE_DB_TIME.observe(stats.db_time, handler)
+
+
+def db_execute_wrapper(execute, sql, params, many, context):
+    """connection.execute_wrapper: время каждого запроса и счётчики обновления, в котором он выполнен."""
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        DB_QUERY_LATENCY.observe(elapsed)
+        stats = update_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_time += elapsed
+
+
+def timed(callback, name: str = None):
+    """Оборачивает обработчик: имя попадает в лог (поле handler) и в гистограмму задержек."""
+    if getattr(callback, "metered", False):
+        return callback
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(*args):
+        bind(handler=name)
+        started = time.perf_counter()
+        status = "error"
+        try:
+            result = await callback(*args)
+            status = "ok"
+            return result
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, name, status)
+
+    wrapper.metered = True
+    return wrapper
+
+
+def instrument_handlers(application) -> None:
+    """Оборачивает timed() колбэки всех обработчиков приложения (кроме служебных групп < 0)."""
+    from bot.callbacks import CallbackRouter
+
+    def instrument(handler):
+        if isinstance(handler, ConversationHandler):
+            for inner in handler.entry_points + handler.fallbacks:
+                instrument(inner)
+            for handlers in handler.states.values():
+                for inner in handlers:
+                    instrument(inner)
+        elif isinstance(handler, CallbackRouter):
+            handler.routes = {action: timed(callback) for action, callback in handler.routes.items()}
+        else:
+            handler.callback = timed(handler.callback)
+
+    for group, handlers in application.handlers.items():
+        if group >= 0:
+            for handler in handlers:
+                instrument(handler)
+
+
+class MeteredRequest(HTTPXRequest):
+    """HTTPXRequest, который измеряет время каждого вызова Bot API и считает ошибки по методам."""
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            TELEGRAM_LATENCY.observe(elapsed, api_method)
+            record_span("telegram", api_method, started, elapsed)
+        if code >= 400:
+            TELEGRAM_ERRORS.inc(api_method, str(code))
+        return code, payload
+
+
+class MetricsServer:
+    """
+    Минимальный HTTP-сервер на asyncio: GET METRICS_PATH отдаёт REGISTRY и файлы метрик
+    разовых команд (METRICS_EXTRA_FILES, например итоги check_subscriptions) в текстовом формате Prometheus.
+    Работает в цикле событий бота и в polling, и в webhook режиме; порт 0 — выключен.
+    """
+
+    def __init__(self, registry=None, host=None, port=None, path=None, extra_files=None):
+        self.registry = registry or REGISTRY
+        self.host = host or settings.METRICS_LISTEN
+        self.port = settings.METRICS_PORT if port is None else port
+        self.path = (path or settings.METRICS_PATH).encode()
+        self.extra_files = settings.METRICS_EXTRA_FILES if extra_files is None else extra_files
+        self._server = None
+
+    def render(self) -> str:
+        text = self.registry.render()
+        for path in self.extra_files:
+            try:
+                with open(path, encoding="utf-8") as file:
+                    text += file.read()
+            except FileNotFoundError:
+                pass
+        return text
+
+    async def start(self):
+        if not self.port:
+            return
+        self._server = await asyncio.start_server(self.handle, self.host, self.port)
+        logger.info(f"Метрики: http://{self.host}:{self.port}{self.path.decode()}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while await asyncio.wait_for(reader.readline(), 5) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == self.path:
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+metrics_server = MetricsServer()
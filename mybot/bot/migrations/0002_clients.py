@@ -0,0 +1,35 @@
+# Generated by Django 5.1.7 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Clients',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.BigIntegerField(verbose_name='ID пользователя')),
+                ('vpn_id', models.CharField(blank=True, max_length=255, null=True, unique=True)),
+                ('name', models.CharField(max_length=100, verbose_name='Имя пользователя')),
+                ('password', models.CharField(max_length=255, verbose_name='Пароль')),
+                ('port', models.IntegerField(blank=True, default=0, null=True, verbose_name='Порт')),
+                ('method', models.CharField(max_length=100, verbose_name='Метод шифрования')),
+                ('access_url', models.TextField(blank=True, null=True)),
+                ('tariff', models.CharField(blank=True, max_length=50, null=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('approved', 'Approved'), ('rejected', 'Rejected')], default='pending', max_length=20, verbose_name='Статус заявки')),
+                ('payment_status', models.CharField(choices=[('not_paid', 'Not Paid'), ('awaiting_verification', 'Awaiting Verification'), ('paid', 'Paid'), ('failed', 'Failed')], default='not_paid', max_length=30, verbose_name='Статус платежа')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('subscription_start_date', models.DateField(blank=True, null=True)),
+                ('subscription_end_date', models.DateField(blank=True, null=True)),
+            ],
+        ),
+        migrations.DeleteModel(
+            name='Client',
+        ),
+    ]
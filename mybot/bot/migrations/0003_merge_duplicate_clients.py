@@ -0,0 +1,63 @@
+import logging
+from django.db import migrations
+from django.db.models import Count
+
+logger = logging.getLogger("bot.migrations")
+
+# Поля, которые у оставшейся записи заполняются из дубликатов, если у неё они пустые
+MERGED_FIELDS = [
+    "vpn_id", "password", "port", "method", "access_url", "tariff",
+    "subscription_start_date", "subscription_end_date",
+]
+
+
+def merge_duplicate_clients(apps, schema_editor):
+    """
+    Оставляет по одной записи на user_id перед добавлением уникального индекса.
+    Главной считается запись с самой поздней датой окончания подписки (затем — самая новая),
+    пустые поля дополняются из остальных записей, остальные записи удаляются.
+    Ключи Outline удалённых записей остаются на сервере: их vpn_id выводятся в лог
+    для отзыва командой revoke_keys.
+    """
+    Clients = apps.get_model("bot", "Clients")
+    duplicated = (
+        Clients.objects.values("user_id")
+        .annotate(rows=Count("id"))
+        .filter(rows__gt=1)
+        .values_list("user_id", flat=True)
+    )
+    discarded = []
+    for user_id in list(duplicated):
+        rows = sorted(
+            Clients.objects.filter(user_id=user_id),
+            key=lambda c: (c.subscription_end_date is not None, c.subscription_end_date, c.id),
+            reverse=True,
+        )
+        keeper, others = rows[0], rows[1:]
+        for other in others:
+            for field in MERGED_FIELDS:
+                if not getattr(keeper, field) and getattr(other, field):
+                    setattr(keeper, field, getattr(other, field))
+            keeper.created_at = min(keeper.created_at, other.created_at)
+
+        # vpn_id уникален: сначала удаляем дубликаты, потом сохраняем объединённую запись
+        Clients.objects.filter(id__in=[other.id for other in others]).delete()
+        keeper.save()
+        discarded += [other.vpn_id for other in others if other.vpn_id and other.vpn_id != keeper.vpn_id]
+
+    if discarded:
+        logger.warning(
+            f"Удалены дубликаты клиентов с ключами Outline ({len(discarded)}), отзовите их: "
+            f"python manage.py revoke_keys {' '.join(discarded)}"
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0002_clients'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_clients, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.7 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0003_merge_duplicate_clients'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='clients',
+            name='user_id',
+            field=models.BigIntegerField(unique=True, verbose_name='ID пользователя'),
+        ),
+        migrations.AddIndex(
+            model_name='clients',
+            index=models.Index(fields=['status', 'subscription_end_date'], name='clients_status_end_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='clients',
+            index=models.Index(fields=['payment_status'], name='clients_payment_status_idx'),
+        ),
+    ]
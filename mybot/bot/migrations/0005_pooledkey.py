@@ -0,0 +1,25 @@
+# Generated by Django 5.1.7 on 2026-10-18 16:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0004_clients_user_id_unique_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PooledKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('vpn_id', models.CharField(max_length=255, unique=True)),
+                ('password', models.CharField(blank=True, default='', max_length=255)),
+                ('port', models.IntegerField(default=0)),
+                ('method', models.CharField(blank=True, default='', max_length=100)),
+                ('access_url', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.7 on 2026-10-18 16:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0005_pooledkey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BotState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=20)),
+                ('namespace', models.CharField(blank=True, default='', max_length=100)),
+                ('key', models.CharField(max_length=255)),
+                ('data', models.JSONField(null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('kind', 'namespace', 'key'), name='bot_state_unique_key')],
+            },
+        ),
+    ]
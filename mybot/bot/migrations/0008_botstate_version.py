@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-18 17:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0007_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='botstate',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
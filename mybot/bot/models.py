@@ -4,7 +4,7 @@ from django.utils import timezone
 from dateutil.relativedelta import relativedelta
 
 class Clients(models.Model):
-    user_id = models.BigIntegerField(verbose_name="ID пользователя")
+    user_id = models.BigIntegerField(unique=True, verbose_name="ID пользователя")
     vpn_id = models.CharField(max_length=255, unique=True,null=True, blank=True)
     name = models.CharField(max_length=100, verbose_name="Имя пользователя")
     password = models.CharField(max_length=255, verbose_name="Пароль")
@@ -40,4 +40,72 @@ class Clients(models.Model):
     subscription_start_date = models.DateField(blank=True, null=True)
     subscription_end_date   = models.DateField(blank=True, null=True)
 
-    
\ No newline at end of file
+    class Meta:
+        indexes = [
+            # ежедневная проверка подписок: status="approved" и диапазон по дате окончания
+            models.Index(fields=["status", "subscription_end_date"], name="clients_status_end_idx"),
+            # очередь платежей на проверку у администраторов
+            models.Index(fields=["payment_status"], name="clients_payment_status_idx"),
+        ]
+
+
+class PooledKey(models.Model):
+    """Ключ, заранее созданный на сервере Outline и ещё не выданный клиенту."""
+    vpn_id = models.CharField(max_length=255, unique=True)
+    password = models.CharField(max_length=255, blank=True, default="")
+    port = models.IntegerField(default=0)
+    method = models.CharField(max_length=100, blank=True, default="")
+    access_url = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class BotState(models.Model):
+    """
+    Состояние python-telegram-bot для DjangoPersistence: одна строка на диалог, пользователя или чат,
+    чтобы несколько процессов бота не перезаписывали чужие данные.
+    """
+    kind = models.CharField(max_length=20)  # conversation / user / chat / bot
+    namespace = models.CharField(max_length=100, blank=True, default="")  # имя ConversationHandler
+    key = models.CharField(max_length=255)
+    data = models.JSONField(null=True)
+    # Растёт при каждой записи состояния диалога: процесс пишет, только если строку не изменил другой
+    version = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["kind", "namespace", "key"], name="bot_state_unique_key"),
+        ]
+
+
+class OutboxMessage(models.Model):
+    """
+    Сообщение пользователю, ожидающее доставки (bot.outbox). Записывается в той же транзакции,
+    что и изменение состояния, и удаляется через OUTBOX_RETENTION_DAYS после отправки.
+    """
+    chat_id = models.BigIntegerField()
+    text = models.TextField()
+    reply_markup = models.JSONField(null=True, blank=True)
+    parse_mode = models.CharField(max_length=20, blank=True, default="")
+    # Ключ идемпотентности: повторная запись того же события не создаёт второе сообщение
+    key = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    status = models.CharField(
+        max_length=10,
+        choices=[
+            ('pending', 'Pending'),
+            ('sent', 'Sent'),
+            ('dead', 'Dead'),
+        ],
+        default='pending',
+    )
+    attempts = models.IntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # выборка доставки: status="pending" и available_at <= now по порядку
+            models.Index(fields=["status", "available_at"], name="outbox_status_available_idx"),
+        ]
@@ -0,0 +1,261 @@
+# outbox.py Исходящие сообщения пользователям через таблицу OutboxMessage
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from itertools import groupby
+from typing import Iterable
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min, Q
+from django.utils import timezone
+from telegram import InlineKeyboardMarkup
+from bot.broadcast import (
+    BLOCKED, FAILED, SENT, THROTTLED, BroadcastSummary, OutgoingMessage, TokenBucket, attempt_send,
+)
+from bot.db import run_db
+from bot.metrics import Counter
+from bot.models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_DELIVERIES = Counter(
+    "bot_outbox_deliveries_total", "Попытки доставки сообщений из outbox по результату", ("result",),
+)
+
+
+# --- запись (в транзакции вызывающего) ---
+
+def enqueue(messages: Iterable[OutgoingMessage]) -> int:
+    """
+    Записывает сообщения в outbox. Вызывается внутри той же транзакции, что и изменение состояния,
+    поэтому сообщение сохраняется тогда и только тогда, когда сохранено изменение.
+    Сообщение с уже записанным ключом идемпотентности (`key`) повторно не добавляется.
+    """
+    rows = [
+        OutboxMessage(
+            chat_id=message.chat_id,
+            text=message.text,
+            reply_markup=message.reply_markup.to_dict() if message.reply_markup else None,
+            parse_mode=message.parse_mode or "",
+            key=message.key,
+        )
+        for message in messages
+    ]
+    if rows:
+        OutboxMessage.objects.bulk_create(rows, ignore_conflicts=True)
+        transaction.on_commit(outbox_worker.wake)
+    return len(rows)
+
+
+async def enqueue_messages(messages: Iterable[OutgoingMessage]) -> int:
+    """Записывает в outbox сообщения, не связанные с изменением состояния (например, напоминания)."""
+    messages = list(messages)
+    return await run_db(enqueue, messages)
+
+
+# --- доставка ---
+
+def _claim(limit: int, lease: float) -> list:
+    """
+    Забирает до `limit` сообщений, время которых подошло, и откладывает их на `lease` секунд:
+    если процесс упадёт, не доставив их, сообщения снова станут доступны после аренды.
+    Строки, занятые другим процессом, пропускаются, как и сообщения чата, у которого есть более раннее
+    неотправленное сообщение вне этой порции (отложенное, арендованное или занятое): порядок в чате важнее.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        rows = list(
+            OutboxMessage.objects.select_for_update(skip_locked=True)
+            .filter(status="pending", available_at__lte=now)
+            .order_by("id")[:limit]
+        )
+        waiting = dict(
+            OutboxMessage.objects.filter(status="pending", chat_id__in={row.chat_id for row in rows})
+            .exclude(id__in=[row.id for row in rows])
+            .values("chat_id").annotate(first=Min("id")).values_list("chat_id", "first")
+        )
+        rows = [row for row in rows if row.id < waiting.get(row.chat_id, float("inf"))]
+        OutboxMessage.objects.filter(id__in=[row.id for row in rows]).update(
+            available_at=now + timedelta(seconds=lease)
+        )
+    return rows
+
+
+def _mark_sent(pk: int) -> None:
+    OutboxMessage.objects.filter(id=pk).update(status="sent", sent_at=timezone.now())
+
+
+def _extend_lease(ids: list, lease: float) -> None:
+    OutboxMessage.objects.filter(id__in=ids, status="pending").update(
+        available_at=timezone.now() + timedelta(seconds=lease)
+    )
+
+
+def _reschedule(pk: int, attempts: int, delay: float, error: str) -> None:
+    OutboxMessage.objects.filter(id=pk).update(
+        attempts=attempts, available_at=timezone.now() + timedelta(seconds=delay), last_error=error[:1000],
+    )
+
+
+def _postpone(chat_id: int, after: int, delay: float) -> None:
+    # Все последующие сообщения чата, а не только из текущей порции: иначе следующая порция их обгонит
+    OutboxMessage.objects.filter(chat_id=chat_id, status="pending", id__gt=after).update(
+        available_at=timezone.now() + timedelta(seconds=delay)
+    )
+
+
+def _dead(pk: int, attempts: int, error: str) -> None:
+    OutboxMessage.objects.filter(id=pk).update(status="dead", attempts=attempts, last_error=error[:1000])
+
+
+def _purge(sent_before, dead_before) -> int:
+    deleted, _ = OutboxMessage.objects.filter(
+        Q(status="sent", sent_at__lt=sent_before) | Q(status="dead", created_at__lt=dead_before)
+    ).delete()
+    return deleted
+
+
+class OutboxWorker:
+    """
+    Доставляет сообщения из outbox: порциями по `batch_size`, с общим лимитом скорости
+    (OUTBOX_RATE в секунду) и лимитом на чат (OUTBOX_CHAT_RATE, всплеск до OUTBOX_CHAT_BURST).
+    Сообщения одного чата отправляются по порядку записи.
+
+    RetryAfter ставит на паузу всю доставку и откладывает сообщение; сетевые ошибки повторяются
+    с экспоненциальной задержкой. После OUTBOX_MAX_ATTEMPTS попыток, а также при Forbidden
+    (пользователь заблокировал бота) и BadRequest сообщение получает статус dead и остаётся
+    в таблице для разбора (OUTBOX_DEAD_RETENTION_DAYS). Каждое сообщение отмечается отправленным
+    сразу после доставки, а аренда ещё не отправленных сообщений чата продлевается, пока они ждут
+    лимита, — другой воркер их не заберёт. Доставка «хотя бы один раз»: при падении между отправкой
+    и отметкой сообщение уйдёт повторно после аренды.
+    """
+
+    def __init__(self, bot=None, rate=None, chat_rate=None, chat_burst=None, batch_size=None, max_attempts=None):
+        self.bot = bot
+        self.bucket = TokenBucket(rate or settings.OUTBOX_RATE)
+        self.chat_rate = chat_rate or settings.OUTBOX_CHAT_RATE
+        self.chat_burst = chat_burst or settings.OUTBOX_CHAT_BURST
+        self.batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+        self.max_attempts = max_attempts or settings.OUTBOX_MAX_ATTEMPTS
+        self.lease = settings.OUTBOX_LEASE
+        self.summary = BroadcastSummary()
+        self._chats = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._purged_at = 0.0
+
+    def wake(self) -> None:
+        """Сообщает работающему циклу доставки, что в outbox появились сообщения."""
+        if self._task is not None:
+            self._task.get_loop().call_soon_threadsafe(self._wakeup.set)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._chats.clear()
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def send(self, row: OutboxMessage) -> tuple:
+        """Одна попытка доставки. Возвращает ('sent' | 'retry' | 'dead', задержка до повтора)."""
+        await self._chat_bucket(row.chat_id).acquire()
+        attempts = row.attempts + 1
+        message = OutgoingMessage(
+            row.chat_id,
+            row.text,
+            InlineKeyboardMarkup.de_json(row.reply_markup, self.bot) if row.reply_markup else None,
+            row.parse_mode or None,
+        )
+        result, delay, error = await attempt_send(self.bot, self.bucket, message, attempts,
+                                                  backoff_base=1.0, backoff_cap=300.0)
+        if result == SENT:
+            return "sent", 0
+        if result == BLOCKED:
+            self.summary.blocked += 1
+            await run_db(_dead, row.id, attempts, f"Forbidden: {error}")
+            return "dead", 0
+        if result == FAILED:
+            logger.error(f"Сообщение {row.id} клиенту {row.chat_id} отклонено: {error}")
+            self.summary.failed += 1
+            await run_db(_dead, row.id, attempts, f"BadRequest: {error}")
+            return "dead", 0
+        if result == THROTTLED:
+            # Лимит Telegram — не вина сообщения: попытка не засчитывается
+            attempts = row.attempts
+        elif attempts >= self.max_attempts:
+            logger.error(f"Сообщение {row.id} клиенту {row.chat_id} не доставлено за {attempts} попыток: {error}")
+            self.summary.failed += 1
+            await run_db(_dead, row.id, attempts, f"{type(error).__name__}: {error}")
+            return "dead", 0
+        self.summary.retried += 1
+        logger.warning(f"Сообщение {row.id} клиенту {row.chat_id} отложено на {delay:.1f}с ({error})")
+        await run_db(_reschedule, row.id, attempts, delay, f"{type(error).__name__}: {error}")
+        return "retry", delay
+
+    async def deliver_batch(self) -> int:
+        """Забирает и доставляет одну порцию; возвращает её размер."""
+        rows = await run_db(_claim, self.batch_size, self.lease)
+
+        async def deliver_chat(chat_rows):
+            leased_at = time.monotonic()
+            for i, row in enumerate(chat_rows):
+                if time.monotonic() - leased_at > self.lease / 2:
+                    # Сообщения чата ждут лимита дольше половины аренды — продлеваем её
+                    await run_db(_extend_lease, [later.id for later in chat_rows[i:]], self.lease)
+                    leased_at = time.monotonic()
+                result, delay = await self.send(row)
+                OUTBOX_DELIVERIES.inc(result)
+                if result == "sent":
+                    await run_db(_mark_sent, row.id)
+                    self.summary.sent += 1
+                elif result == "retry":
+                    # Следующие сообщения чата откладываются вместе с ним, чтобы не нарушить порядок
+                    await run_db(_postpone, row.chat_id, row.id, delay)
+                    break
+
+        by_chat = groupby(sorted(rows, key=lambda row: (row.chat_id, row.id)), key=lambda row: row.chat_id)
+        await asyncio.gather(*(deliver_chat(list(chat_rows)) for _, chat_rows in by_chat))
+        return len(rows)
+
+    async def drain(self) -> BroadcastSummary:
+        """Доставляет всё, что готово к отправке сейчас (для разовых команд); отложенное остаётся в outbox."""
+        while await self.deliver_batch():
+            pass
+        return self.summary
+
+    async def run(self):
+        while True:
+            try:
+                delivered = await self.deliver_batch()
+                if time.monotonic() - self._purged_at > 3600:
+                    self._purged_at = time.monotonic()
+                    now = timezone.now()
+                    await run_db(_purge, now - timedelta(days=settings.OUTBOX_RETENTION_DAYS),
+                                 now - timedelta(days=settings.OUTBOX_DEAD_RETENTION_DAYS))
+            except Exception as e:
+                logger.error(f"Ошибка доставки outbox: {e}")
+                delivered = 0
+            if not delivered:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), settings.OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def start(self, bot):
+        self.bot = bot
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+outbox_worker = OutboxWorker()
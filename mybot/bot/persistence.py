@@ -0,0 +1,297 @@
+# persistence.py Хранение состояния диалогов и user/chat/bot data в БД Django
+import asyncio
+import json
+import logging
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from telegram import Update
+from telegram.ext import BasePersistence, PersistenceInput, TypeHandler
+from bot.models import BotState
+from bot.db import run_db
+
+logger = logging.getLogger(__name__)
+
+_DELETE = object()
+
+
+# Перечитывание диалогов опирается на закрытые части ConversationHandler: в PTB нет открытого способа
+# узнать ключ диалога для обновления и подменить его состояние после запуска. Версия python-telegram-bot
+# закреплена в requirements.txt, а ConversationInternalsTests падает, если эти части изменятся.
+
+def _conversation_key(handler, update) -> tuple:
+    """Ключ диалога `handler` для обновления; RuntimeError, если ключ не вычисляется."""
+    return handler._get_key(update)
+
+
+def _set_conversation_state(handler, key: tuple, state) -> None:
+    """Подменяет состояние диалога в памяти `handler`, не помечая его для записи в persistence."""
+    handler._conversations.update_no_track({key: state})
+
+
+def _drop_conversation_state(handler, key: tuple) -> None:
+    handler._conversations.data.pop(key, None)
+
+
+class DjangoPersistence(BasePersistence):
+    """
+    BasePersistence поверх таблицы BotState.
+
+    Изменения не пишутся сразу: они копятся в буфере и через `flush_delay` секунд
+    сохраняются одной транзакцией (upsert + delete). Неизменившиеся данные не пишутся вовсе.
+    Каждый диалог, пользователь и чат хранится отдельной строкой, поэтому несколько процессов
+    могут работать с одной БД, не затирая чужие записи. Состояние диалога пишется с проверкой
+    версии строки: если её успел изменить другой процесс, остаётся его состояние.
+
+    При PERSISTENCE_REFRESH (несколько процессов) перед каждым обновлением перечитываются
+    user_data/chat_data и состояние диалогов этого пользователя (refresh_conversations),
+    а после обработки изменения сразу записываются (flush_after_update) — см. add_refresh_handlers.
+    Данные должны сериализоваться в JSON.
+    """
+
+    def __init__(self, update_interval=None, flush_delay=None, refresh=None):
+        super().__init__(
+            store_data=PersistenceInput(callback_data=False),
+            update_interval=update_interval or settings.PERSISTENCE_UPDATE_INTERVAL,
+        )
+        self.flush_delay = settings.PERSISTENCE_FLUSH_DELAY if flush_delay is None else flush_delay
+        self.refresh = settings.PERSISTENCE_REFRESH if refresh is None else refresh
+        self.flushes = 0
+        self.rows_written = 0
+        self._dirty = {}
+        self._written = {}
+        # Версия строки диалога, которую видел этот процесс
+        self._versions = {}
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    # --- чтение ---
+
+    def _load(self, kind, namespace=""):
+        rows = BotState.objects.filter(kind=kind, namespace=namespace).values_list("key", "data", "version")
+        result = {}
+        for key, data, version in rows:
+            self._written[(kind, namespace, key)] = json.dumps(data, sort_keys=True)
+            self._versions[(kind, namespace, key)] = version
+            result[key] = data
+        return result
+
+    async def get_user_data(self):
+        rows = await run_db(self._load, "user")
+        return {int(key): data for key, data in rows.items()}
+
+    async def get_chat_data(self):
+        rows = await run_db(self._load, "chat")
+        return {int(key): data for key, data in rows.items()}
+
+    async def get_bot_data(self):
+        rows = await run_db(self._load, "bot")
+        return rows.get("", {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        rows = await run_db(self._load, "conversation", name)
+        return {tuple(json.loads(key)): state for key, state in rows.items()}
+
+    async def _refresh(self, kind, key, data):
+        row = await run_db(BotState.objects.filter(kind=kind, namespace="", key=key).values_list("data", flat=True).first)
+        if row is not None and (kind, "", key) not in self._dirty:
+            data.clear()
+            data.update(row)
+
+    async def refresh_user_data(self, user_id, user_data):
+        if self.refresh:
+            await self._refresh("user", str(user_id), user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        if self.refresh:
+            await self._refresh("chat", str(chat_id), chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    @staticmethod
+    def _read_conversations(idents):
+        query = Q()
+        for namespace, key in idents:
+            query |= Q(kind="conversation", namespace=namespace, key=key)
+        rows = BotState.objects.filter(query).values_list("namespace", "key", "data", "version")
+        return {(namespace, key): (data, version) for namespace, key, data, version in rows}
+
+    async def refresh_conversations(self, update, handlers):
+        """
+        Перечитывает из БД состояние диалогов `handlers` для пользователя и чата обновления:
+        его мог изменить или завершить другой процесс. Ещё не записанные свои изменения не трогаются.
+        """
+        keys = {}
+        for handler in handlers:
+            try:
+                keys[(handler.name, json.dumps(list(_conversation_key(handler, update))))] = handler
+            except RuntimeError:
+                continue
+        if not keys:
+            return
+        rows = await run_db(self._read_conversations, list(keys))
+        for (namespace, key), handler in keys.items():
+            ident = ("conversation", namespace, key)
+            if ident in self._dirty:
+                continue
+            conversation = tuple(json.loads(key))
+            if (namespace, key) in rows:
+                data, version = rows[namespace, key]
+                _set_conversation_state(handler, conversation, data)
+                self._written[ident] = json.dumps(data, sort_keys=True)
+                self._versions[ident] = version
+            else:
+                _drop_conversation_state(handler, conversation)
+                self._written.pop(ident, None)
+                self._versions.pop(ident, None)
+
+    async def flush_after_update(self, update, context):
+        """Сразу отдаёт изменения обновления в БД, чтобы следующее обновление в другом процессе их видело."""
+        await context.application.update_persistence()
+        await self.flush()
+
+    # --- запись ---
+
+    def _mark(self, kind, key, data, namespace=""):
+        # Пустые user_data/chat_data не храним: строки нет — значит данных нет
+        self._dirty[(kind, namespace, key)] = _DELETE if data is None or data == {} else json.loads(json.dumps(data))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush())
+
+    async def update_conversation(self, name, key, new_state):
+        self._mark("conversation", json.dumps(list(key)), new_state, name)
+
+    async def update_user_data(self, user_id, data):
+        self._mark("user", str(user_id), data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._mark("chat", str(chat_id), data)
+
+    async def update_bot_data(self, data):
+        self._mark("bot", "", data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._mark("user", str(user_id), None)
+
+    async def drop_chat_data(self, chat_id):
+        self._mark("chat", str(chat_id), None)
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_delay)
+        await self._write()
+
+    async def flush(self):
+        await self._write()
+
+    async def _write(self):
+        async with self._flush_lock:
+            batch, self._dirty = self._dirty, {}
+            changed = {}
+            for ident, data in batch.items():
+                serialized = None if data is _DELETE else json.dumps(data, sort_keys=True)
+                if self._written.get(ident) != serialized:
+                    changed[ident] = (data, serialized)
+            if not changed:
+                return
+            try:
+                versions = await run_db(self._write_batch, changed, dict(self._versions))
+            except Exception:
+                logger.exception("Не удалось сохранить состояние бота, повторим при следующей записи")
+                for ident, (data, _) in changed.items():
+                    self._dirty.setdefault(ident, data)
+                return
+            for ident, (_, serialized) in changed.items():
+                version = versions.get(ident)
+                if version is False:
+                    # Диалог изменил другой процесс: его состояние новее, следующее обновление его перечитает
+                    logger.warning(f"Состояние диалога {ident[1]} {ident[2]} изменено другим процессом, "
+                                   f"наша запись пропущена")
+                    self._written.pop(ident, None)
+                    self._versions.pop(ident, None)
+                    continue
+                self._written[ident] = serialized
+                if version is not None:
+                    self._versions[ident] = version
+                elif ident[0] == "conversation":
+                    self._versions.pop(ident, None)
+            self.flushes += 1
+            self.rows_written += len(changed)
+
+    @staticmethod
+    def _write_conversation(ident, data, version):
+        """
+        Пишет состояние диалога, если версия строки та же, что видел процесс.
+        Возвращает новую версию, None после удаления или False, если строку изменил другой процесс.
+        """
+        kind, namespace, key = ident
+        row = BotState.objects.filter(kind=kind, namespace=namespace, key=key)
+        if version is not None:
+            row = row.filter(version=version)
+        if data is _DELETE:
+            return None if row.delete()[0] or version is None else False
+        if version is None:
+            try:
+                with transaction.atomic():
+                    BotState.objects.create(kind=kind, namespace=namespace, key=key, data=data, version=1)
+            except IntegrityError:
+                return False
+            return 1
+        updated = row.update(data=data, version=F("version") + 1, updated_at=timezone.now())
+        return version + 1 if updated else False
+
+    def _write_batch(self, changed, versions):
+        conversations = {
+            ident: data for ident, (data, _) in changed.items() if ident[0] == "conversation"
+        }
+        changed = {ident: value for ident, value in changed.items() if ident not in conversations}
+        upserts = [
+            BotState(kind=kind, namespace=namespace, key=key, data=data)
+            for (kind, namespace, key), (data, _) in changed.items()
+            if data is not _DELETE
+        ]
+        deletes = Q()
+        for (kind, namespace, key), (data, _) in changed.items():
+            if data is _DELETE:
+                deletes |= Q(kind=kind, namespace=namespace, key=key)
+
+        with transaction.atomic():
+            result = {
+                ident: self._write_conversation(ident, data, versions.get(ident))
+                for ident, data in conversations.items()
+            }
+            if deletes:
+                BotState.objects.filter(deletes).delete()
+            if upserts:
+                # MySQL определяет конфликт по любому уникальному ключу и не принимает unique_fields
+                unique_fields = (
+                    ["kind", "namespace", "key"] if connection.features.supports_update_conflicts_with_target else None
+                )
+                BotState.objects.bulk_create(
+                    upserts,
+                    update_conflicts=True,
+                    unique_fields=unique_fields,
+                    update_fields=["data", "updated_at"],
+                )
+        return result
+
+
+def add_refresh_handlers(application, handlers) -> None:
+    """
+    Для нескольких процессов с одной БД: перед обработчиками (группа -2) перечитывает состояние
+    диалогов `handlers`, после них (группа 1) сразу записывает изменения обновления.
+    """
+    persistence = application.persistence
+
+    async def refresh_conversations(update, context):
+        await persistence.refresh_conversations(update, handlers)
+
+    application.add_handler(TypeHandler(Update, refresh_conversations), group=-2)
+    application.add_handler(TypeHandler(Update, persistence.flush_after_update), group=1)
@@ -0,0 +1,305 @@
+# repository.py Асинхронный доступ к данным клиентов
+import copy
+from typing import Callable, Iterable, Optional
+from django.db import transaction
+from django.conf import settings
+from django.db.models import Count, Q
+from django.utils import timezone
+from bot import cache
+from bot.db import run_db
+from bot.cache import MISSING, TTLCache, client_cache, invalidate_client
+from bot.models import Clients, PooledKey
+from bot.outbox import enqueue
+from bot.settlement import SETTLED, SettlementResult, key_fields, settle
+
+# Счётчики для /queue: администратор может обновлять экран часто, а точность до секунд не нужна
+totals_cache = TTLCache(1, settings.QUEUE_TOTALS_TTL)
+
+# --- чтение ---
+
+def _get_client(user_id: int) -> Optional[Clients]:
+    return Clients.objects.filter(user_id=user_id).first()
+
+
+async def get_client(user_id: int) -> Optional[Clients]:
+    """
+    Копия записи клиента (или None) через кэш; БД читается только при промахе.
+    Чтение, пересёкшееся с записью этого клиента, в кэш не попадает.
+    """
+    client = client_cache.get(user_id)
+    if client is MISSING:
+        generation = cache.generation()
+        client = await run_db(_get_client, user_id)
+        if generation == cache.generation():
+            client_cache.set(user_id, client)
+    return copy.copy(client)
+
+
+def _fetch_chunk(filters: dict, after, size: int) -> list:
+    qs = Clients.objects.filter(**filters).order_by("subscription_end_date", "id")
+    if after is not None:
+        end_date, pk = after
+        qs = qs.filter(Q(subscription_end_date__gt=end_date) | Q(subscription_end_date=end_date, id__gt=pk))
+    return list(qs.only("id", "user_id", "vpn_id", "subscription_end_date")[:size])
+
+
+async def fetch_clients_chunk(filters: dict, after, size: int) -> list:
+    """
+    Следующая порция клиентов по ключу (subscription_end_date, id) строго после `after`.
+    Загружаются только поля, нужные для рассылки и отзыва ключей.
+    """
+    return await run_db(_fetch_chunk, filters, after, size)
+
+
+def _fetch_by_user(user_ids: list, filters: dict) -> list:
+    qs = Clients.objects.filter(user_id__in=user_ids, **filters)
+    return list(qs.only("id", "user_id", "vpn_id", "subscription_end_date"))
+
+
+async def fetch_clients(user_ids, **filters) -> list:
+    """Клиенты из `user_ids`, подходящие под `filters`, — с теми же полями, что и fetch_clients_chunk."""
+    return await run_db(_fetch_by_user, list(user_ids), filters)
+
+
+def _page(filters: dict, after_id: int, limit: int) -> list:
+    qs = Clients.objects.filter(id__gt=after_id, **filters).order_by("id")
+    return list(qs.only("id", "user_id", "name", "tariff")[:limit])
+
+
+async def pending_requests(after_id: int = 0, limit: int = 10) -> list:
+    """Заявки, ожидающие решения администратора, по возрастанию id начиная после `after_id`."""
+    return await run_db(_page, {"status": "pending"}, after_id, limit)
+
+
+async def awaiting_payments(after_id: int = 0, limit: int = 10) -> list:
+    """Платежи, ожидающие проверки, по возрастанию id начиная после `after_id`."""
+    return await run_db(_page, {"payment_status": "awaiting_verification"}, after_id, limit)
+
+
+async def pending_work_page(after_request: int, after_payment: int, size: int):
+    """
+    Страница необработанной работы: до `size` заявок и платежей после указанных id.
+    Возвращает (заявки, платежи, есть ли следующая страница).
+    """
+    requests = await pending_requests(after_request, size + 1)
+    payments = await awaiting_payments(after_payment, size + 1)
+    more = len(requests) > size or len(payments) > size
+    return requests[:size], payments[:size], more
+
+
+def _pending_totals() -> dict:
+    # Один запрос с группировкой; условие по status/payment_status позволяет
+    # MySQL объединить два индекса вместо полного просмотра таблицы
+    rows = (
+        Clients.objects.filter(Q(status="pending") | Q(payment_status="awaiting_verification"))
+        .values("status", "payment_status")
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+    totals = {"requests": 0, "payments": 0}
+    for row in rows:
+        if row["status"] == "pending":
+            totals["requests"] += row["count"]
+        if row["payment_status"] == "awaiting_verification":
+            totals["payments"] += row["count"]
+    return totals
+
+
+async def pending_totals() -> dict:
+    """Число ожидающих заявок и платежей; кэшируется на QUEUE_TOTALS_TTL секунд."""
+    totals = totals_cache.get("totals")
+    if totals is MISSING:
+        totals = await run_db(_pending_totals)
+        totals_cache.set("totals", totals)
+    return dict(totals)
+
+
+def invalidate_totals() -> None:
+    totals_cache.clear()
+
+
+def _user_ids_by_pk(ids: list, filters: dict) -> list:
+    return list(Clients.objects.filter(id__in=ids, **filters).values_list("user_id", flat=True))
+
+
+async def user_ids_by_pk(ids, **filters) -> list:
+    """user_id клиентов с указанными id, которые всё ещё подходят под `filters`."""
+    return await run_db(_user_ids_by_pk, list(ids), filters)
+
+
+# --- заявки и оплата ---
+
+async def create_request(user_id: int, name: str) -> None:
+    """Создаёт или обновляет заявку пользователя со статусом pending."""
+    await run_db(Clients.objects.update_or_create, user_id=user_id, defaults={"name": name, "status": "pending"})
+    invalidate_client(user_id)
+
+
+async def select_tariff(user_id: int, tariff: str) -> bool:
+    # сохраняем только тариф и статус
+    updated = await run_db(Clients.objects.filter(user_id=user_id).update, tariff=tariff, status="approved")
+    invalidate_client(user_id)
+    return bool(updated)
+
+
+def _update_and_enqueue(filters: dict, changes: dict, messages) -> int:
+    with transaction.atomic():
+        updated = Clients.objects.filter(**filters).update(**changes)
+        if updated:
+            enqueue(messages)
+    return updated
+
+
+async def claim_pending(user_id: int, decision: str, messages: Iterable = ()) -> bool:
+    """
+    Переводит заявку из pending в `decision` (approved/rejected) и в той же транзакции
+    записывает `messages` в outbox. False — заявку уже обработал другой администратор.
+    """
+    updated = await run_db(
+        _update_and_enqueue, {"user_id": user_id, "status": "pending"}, {"status": decision}, list(messages)
+    )
+    invalidate_client(user_id)
+    return bool(updated)
+
+
+def _claim_pending_many(ids: list, decision: str, message: Optional[Callable]) -> list:
+    with transaction.atomic():
+        user_ids = list(
+            Clients.objects.select_for_update().filter(id__in=ids, status="pending").values_list("user_id", flat=True)
+        )
+        if user_ids:
+            Clients.objects.filter(user_id__in=user_ids, status="pending").update(status=decision)
+            if message:
+                enqueue(message(user_id) for user_id in user_ids)
+    return user_ids
+
+
+async def claim_pending_many(ids, decision: str, message: Optional[Callable] = None) -> list:
+    """
+    Переводит заявки клиентов с id из `ids`, всё ещё ожидающие решения, в `decision` одним UPDATE
+    и в той же транзакции записывает в outbox `message(user_id)` каждому. Возвращает их user_id.
+    """
+    user_ids = await run_db(_claim_pending_many, list(ids), decision, message)
+    invalidate_client(*user_ids)
+    return user_ids
+
+
+async def mark_awaiting_verification(user_id: int) -> bool:
+    updated = await run_db(Clients.objects.filter(user_id=user_id).update, payment_status="awaiting_verification")
+    invalidate_client(user_id)
+    return bool(updated)
+
+
+async def mark_paid(user_id: int, key_data: Optional[dict] = None,
+                    messages: Optional[Callable] = None) -> SettlementResult:
+    """Подтверждает оплату одной транзакцией вместе с сообщениями клиенту (см. bot.settlement.settle)."""
+    result = await run_db(settle, user_id, key_data, timezone.now().date(), messages)
+    if result.status == SETTLED:
+        invalidate_client(user_id)
+    return result
+
+
+async def mark_payment_failed(user_id: int, messages: Iterable = ()) -> bool:
+    updated = await run_db(
+        _update_and_enqueue,
+        {"user_id": user_id, "payment_status": "awaiting_verification"}, {"payment_status": "failed"}, list(messages),
+    )
+    invalidate_client(user_id)
+    return bool(updated)
+
+
+# --- ключи ---
+
+async def count_pooled_keys() -> int:
+    return await run_db(PooledKey.objects.count)
+
+
+async def add_pooled_key(key_data: dict) -> None:
+    await run_db(PooledKey.objects.create, **key_fields(key_data))
+
+
+# --- проверка подписок ---
+
+def _claim_expired(ids: list, today) -> dict:
+    with transaction.atomic():
+        claimed = {
+            pk: (vpn_id, access_url)
+            for pk, vpn_id, access_url in Clients.objects.select_for_update()
+            .filter(id__in=ids, status="approved", subscription_end_date__lte=today)
+            .values_list("id", "vpn_id", "access_url")
+        }
+        # Без access_url оплата, пришедшая во время отзыва, выдаст новый ключ, а не оставит отозванный
+        Clients.objects.filter(id__in=claimed).update(access_url="")
+    return claimed
+
+
+async def claim_expired(clients: list, today) -> list:
+    """
+    Под блокировкой строк отбирает клиентов, чья подписка всё ещё истекла к `today`, и снимает
+    с них access_url перед отзывом ключа. Возвращает этих клиентов с vpn_id и access_url,
+    прочитанными под блокировкой.
+    """
+    claimed = await run_db(_claim_expired, [client.id for client in clients], today)
+    invalidate_client(*(client.user_id for client in clients))
+    result = []
+    for client in clients:
+        if client.id in claimed:
+            client.vpn_id, client.access_url = claimed[client.id]
+            result.append(client)
+    return result
+
+
+def _restore_access(urls: dict) -> int:
+    restored = 0
+    with transaction.atomic():
+        for pk, (vpn_id, access_url) in urls.items():
+            # Если за это время клиент оплатил и получил новый ключ, строку не трогаем
+            restored += Clients.objects.filter(id=pk, vpn_id=vpn_id, access_url="").update(access_url=access_url)
+    return restored
+
+
+async def restore_access(clients: list) -> int:
+    """
+    Возвращает access_url клиентам, чей ключ отозвать не удалось: ключ ещё работает,
+    и оплата до следующей попытки отзыва должна продлить его, а не выдать второй.
+    """
+    urls = {client.id: (client.vpn_id, client.access_url) for client in clients if client.access_url}
+    restored = await run_db(_restore_access, urls) if urls else 0
+    invalidate_client(*(client.user_id for client in clients))
+    return restored
+
+
+def _reset_expired(keys: dict, messages: dict, today) -> int:
+    with transaction.atomic():
+        # Сбрасываем и уведомляем только тех, кто с момента отбора не продлил подписку и не получил
+        # новый ключ; остальных уже обработали или они оплатили заново
+        locked = Clients.objects.select_for_update().filter(
+            id__in=keys, status="approved", subscription_end_date__lte=today,
+        ).values_list("id", "vpn_id")
+        reset = [pk for pk, vpn_id in locked if vpn_id == keys[pk]]
+        enqueue(messages[pk] for pk in reset if pk in messages)
+        # при желании можно и subscription_start_date/subscription_end_date занулять,
+        # но обычно они остаются для истории
+        return Clients.objects.filter(id__in=reset).update(
+            vpn_id=None,
+            access_url="",
+            password="",
+            port=0,
+            method="",
+            payment_status="not_paid",
+            status="pending",
+            tariff="",
+        )
+
+
+async def reset_expired(clients: list, today, message: Optional[Callable] = None) -> int:
+    """
+    Одним UPDATE сбрасывает ключ и статус у клиентов с истёкшей подпиской и в той же транзакции
+    записывает в outbox `message(client)` для каждого из них. Клиент, у которого под блокировкой
+    другой vpn_id или подписка уже не истекла к `today`, пропускается.
+    """
+    messages = {client.id: message(client) for client in clients} if message else {}
+    keys = {client.id: client.vpn_id for client in clients}
+    updated = await run_db(_reset_expired, keys, messages, today)
+    invalidate_client(*(client.user_id for client in clients))
+    return updated
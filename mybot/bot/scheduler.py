@@ -0,0 +1,176 @@
+# scheduler.py Напоминания о продлении и отключение клиентов в срок, в процессе бота
+import asyncio
+import heapq
+import logging
+import time
+from datetime import date, datetime, timedelta
+from datetime import timezone as dt_timezone
+from django.conf import settings
+from django.utils import timezone
+from bot import expiry, repository
+from bot.metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+REMIND = "remind"
+REVOKE = "revoke"
+
+EXPIRY_EVENTS = Counter(
+    "bot_expiry_events_total", "События планировщика подписок по виду и результату", ("kind", "result"),
+)
+
+
+def _spread(user_id: int, seconds: float) -> float:
+    """Постоянный для пользователя сдвиг в пределах `seconds`: события одного дня не идут одной пачкой."""
+    return (user_id * 2654435761) % 2 ** 32 / 2 ** 32 * seconds
+
+
+def _midnight(day: date) -> float:
+    # Даты подписки считаются по timezone.now().date(), то есть в UTC
+    return datetime.combine(day, datetime.min.time(), tzinfo=dt_timezone.utc).timestamp()
+
+
+def remind_at(user_id: int, end_date: date) -> float:
+    """Время напоминания: накануне окончания, между EXPIRY_REMIND_FROM и EXPIRY_REMIND_TO часами."""
+    window = (settings.EXPIRY_REMIND_TO - settings.EXPIRY_REMIND_FROM) * 3600
+    return _midnight(end_date - timedelta(days=1)) + settings.EXPIRY_REMIND_FROM * 3600 + _spread(user_id, window)
+
+
+def revoke_at(user_id: int, end_date: date) -> float:
+    """Время отключения: начало дня окончания подписки плюс сдвиг до EXPIRY_REVOKE_SPREAD секунд."""
+    return _midnight(end_date) + _spread(user_id, settings.EXPIRY_REVOKE_SPREAD)
+
+
+class ExpiryScheduler:
+    """
+    Куча (время, вид, user_id, дата окончания) для одобренных клиентов, чья подписка кончается
+    в ближайшие EXPIRY_HORIZON_DAYS дней. При запуске загружается из БД, раз в EXPIRY_RELOAD_INTERVAL
+    дочитывается до нового горизонта, а подтверждённая оплата добавляет события через schedule().
+
+    Подошедшие события обрабатываются порциями по EXPIRY_BATCH_SIZE: перед отправкой состояние
+    клиента перечитывается из БД, так что устаревшие записи кучи (продлил, отклонён) ничего не делают.
+    Напоминания защищены от повтора ключом идемпотентности outbox, отключение — блокировкой строки
+    в reset_expired; неотозванные ключи повторяются через EXPIRY_RETRY_DELAY секунд.
+    """
+
+    def __init__(self):
+        self._heap = []
+        # Текущая дата окончания по user_id: записи кучи с другой датой устарели и пропускаются
+        self._ends = {}
+        self.loaded_until = None
+        self._reload_at = 0.0
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _push(self, user_id: int, end_date: date) -> None:
+        if self._ends.get(user_id) == end_date:
+            return
+        self._ends[user_id] = end_date
+        heapq.heappush(self._heap, (remind_at(user_id, end_date), REMIND, user_id, end_date))
+        heapq.heappush(self._heap, (revoke_at(user_id, end_date), REVOKE, user_id, end_date))
+
+    def schedule(self, user_id: int, end_date: date) -> None:
+        """Новая дата окончания подписки (после оплаты); дальние даты подхватит следующая загрузка."""
+        if self._task is None or end_date is None:
+            return
+        if self.loaded_until is not None and end_date <= self.loaded_until:
+            self._push(user_id, end_date)
+            self._wakeup.set()
+
+    async def load(self) -> int:
+        """Дочитывает из БД одобренных клиентов, у которых подписка кончается до нового горизонта."""
+        self.loaded_until = timezone.now().date() + timedelta(days=settings.EXPIRY_HORIZON_DAYS)
+        self._reload_at = time.time() + settings.EXPIRY_RELOAD_INTERVAL
+        loaded = 0
+        async for chunk in expiry.iter_chunks(settings.SWEEP_CHUNK_SIZE, status="approved",
+                                              subscription_end_date__lte=self.loaded_until):
+            for client in chunk:
+                self._push(client.user_id, client.subscription_end_date)
+            loaded += len(chunk)
+        logger.info(f"Планировщик подписок: клиентов до {self.loaded_until} — {loaded}, событий {len(self._heap)}")
+        return loaded
+
+    def pop_due(self, now: float) -> list:
+        """Снимает с кучи до EXPIRY_BATCH_SIZE подошедших событий, пропуская устаревшие."""
+        batch = []
+        while self._heap and self._heap[0][0] <= now and len(batch) < settings.EXPIRY_BATCH_SIZE:
+            entry = heapq.heappop(self._heap)
+            _, kind, user_id, end_date = entry
+            if self._ends.get(user_id) != end_date:
+                continue
+            if kind == REVOKE:
+                del self._ends[user_id]
+            batch.append(entry)
+        return batch
+
+    async def fire(self, batch: list) -> None:
+        """Напоминает и отключает по порции событий; опоздавшее напоминание (подписка уже кончилась) не шлётся."""
+        today = timezone.now().date()
+        reminders = {user_id: end for _, kind, user_id, end in batch if kind == REMIND}
+        if reminders:
+            clients = await repository.fetch_clients(reminders, status="approved", subscription_end_date__gt=today)
+            due = [client for client in clients if client.subscription_end_date == reminders[client.user_id]]
+            await expiry.remind(due)
+            EXPIRY_EVENTS.inc(REMIND, "sent", amount=len(due))
+            EXPIRY_EVENTS.inc(REMIND, "skipped", amount=len(reminders) - len(due))
+
+        revocations = [user_id for _, kind, user_id, _ in batch if kind == REVOKE]
+        if revocations:
+            clients = await repository.fetch_clients(revocations, status="approved", subscription_end_date__lte=today)
+            disabled, failed = await expiry.expire(clients, today=today)
+            EXPIRY_EVENTS.inc(REVOKE, "disabled", amount=len(disabled))
+            EXPIRY_EVENTS.inc(REVOKE, "failed", amount=len(failed))
+            EXPIRY_EVENTS.inc(REVOKE, "skipped", amount=len(revocations) - len(clients))
+            for client in failed:
+                self._retry(REVOKE, client.user_id, client.subscription_end_date)
+
+    def _retry(self, kind: str, user_id: int, end_date: date) -> None:
+        # Повтор через EXPIRY_RETRY_DELAY, если дата окончания за это время не сменилась
+        if self._ends.setdefault(user_id, end_date) == end_date:
+            heapq.heappush(self._heap, (time.time() + settings.EXPIRY_RETRY_DELAY, kind, user_id, end_date))
+
+    async def run(self):
+        while True:
+            batch = []
+            try:
+                if time.time() >= self._reload_at:
+                    await self.load()
+                batch = self.pop_due(time.time())
+                if batch:
+                    await self.fire(batch)
+                    continue
+            except Exception as e:
+                logger.error(f"Ошибка планировщика подписок: {e}")
+                for _, kind, user_id, end_date in batch:
+                    self._retry(kind, user_id, end_date)
+                self._reload_at = min(self._reload_at, time.time() + settings.EXPIRY_RETRY_DELAY)
+            now = time.time()
+            timeout = self._reload_at - now
+            if self._heap:
+                timeout = min(timeout, self._heap[0][0] - now)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(timeout, 0.0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+expiry_scheduler = ExpiryScheduler()
+
+Gauge("bot_expiry_scheduled", "Событий в очереди планировщика подписок", func=lambda: len(expiry_scheduler))
@@ -0,0 +1,112 @@
+# settlement.py Подтверждение оплаты одной транзакцией
+from dataclasses import dataclass
+from datetime import date
+from typing import Callable, Optional
+from dateutil.relativedelta import relativedelta
+from django.db import transaction
+from bot.models import Clients, PooledKey
+from bot.outbox import enqueue
+
+TARIFF_MONTHS = {"1 месяц": 1, "3 месяца": 3, "6 месяцев": 6}
+
+SETTLED = "settled"
+ALREADY_PROCESSED = "already_processed"
+NOT_FOUND = "not_found"
+KEY_REQUIRED = "key_required"
+
+
+@dataclass(frozen=True)
+class SettlementResult:
+    status: str
+    user_id: int
+    subscription_start_date: Optional[date] = None
+    subscription_end_date: Optional[date] = None
+    access_url: str = ""
+    vpn_id: str = ""
+    name: str = ""
+    # True, если в запись сохранён переданный key_data
+    key_used: bool = False
+    # True, если ключ взят из заранее созданного пула и его ещё нужно переименовать
+    key_from_pool: bool = False
+    # Прежний ключ клиента, который заменён новым и должен быть отозван
+    replaced_vpn_id: str = ""
+
+
+def key_fields(key_data: dict) -> dict:
+    """Поля Clients, которые заполняются из ответа Outline API."""
+    return {
+        "vpn_id": str(key_data["id"]),
+        "access_url": key_data.get("accessUrl", ""),
+        "password": key_data.get("password", ""),
+        "port": key_data.get("port", 0),
+        "method": key_data.get("method", ""),
+    }
+
+
+def settle(user_id: int, key_data: Optional[dict], today: date,
+           messages: Optional[Callable] = None) -> SettlementResult:
+    """
+    Под блокировкой строки клиента переводит платёж из awaiting_verification в paid,
+    рассчитывает период подписки и сохраняет ключ — всё в одной транзакции.
+    Если у клиента нет ключа и key_data не передан, ключ берётся из пула PooledKey;
+    если пул пуст, возвращает KEY_REQUIRED без изменений. Заменённый ключ возвращается
+    в replaced_vpn_id — его отзывает вызывающий.
+    `messages(result)` — сообщения клиенту, которые записываются в outbox в той же транзакции.
+    """
+    with transaction.atomic():
+        try:
+            client = Clients.objects.select_for_update().get(user_id=user_id)
+        except Clients.DoesNotExist:
+            return SettlementResult(NOT_FOUND, user_id)
+        if client.payment_status != "awaiting_verification":
+            return SettlementResult(ALREADY_PROCESSED, user_id)
+
+        # Новый период начинается с конца текущей подписки, если она ещё действует
+        months = TARIFF_MONTHS.get(client.tariff, 0)
+        if client.subscription_end_date and client.subscription_end_date > today:
+            new_start = client.subscription_end_date
+        else:
+            new_start = today
+        new_end = new_start + relativedelta(months=months)
+
+        changes = {
+            "payment_status": "paid",
+            "subscription_start_date": new_start,
+            "subscription_end_date": new_end,
+        }
+        key_used = key_from_pool = False
+        if not client.access_url:
+            if key_data:
+                changes.update(key_fields(key_data))
+                key_used = True
+            else:
+                # Забираем готовый ключ из пула; занятые другой транзакцией строки пропускаем
+                pooled = PooledKey.objects.select_for_update(skip_locked=True).order_by("id").first()
+                if pooled is None:
+                    # Ничего не пишем: вызывающий создаст ключ и повторит расчёт
+                    return SettlementResult(KEY_REQUIRED, user_id)
+                changes.update({
+                    "vpn_id": pooled.vpn_id,
+                    "access_url": pooled.access_url,
+                    "password": pooled.password,
+                    "port": pooled.port,
+                    "method": pooled.method,
+                })
+                pooled.delete()
+                key_from_pool = True
+
+        # vpn_id без access_url остаётся, пока отзывается ключ истёкшей подписки; если отзыв
+        # не удался, этот ключ ещё работает, а после замены его никто не отслеживает
+        replaced_vpn_id = client.vpn_id if "vpn_id" in changes and client.vpn_id != changes["vpn_id"] else None
+        for field, value in changes.items():
+            setattr(client, field, value)
+        client.save(update_fields=list(changes))
+
+        result = SettlementResult(
+            SETTLED, user_id, new_start, new_end, client.access_url, client.vpn_id or "", client.name,
+            key_used=key_used, key_from_pool=key_from_pool, replaced_vpn_id=replaced_vpn_id or "",
+        )
+        if messages:
+            enqueue(messages(result))
+    return result
+
@@ -1,3 +1,1039 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import statistics
+import time
+from datetime import date, datetime, timedelta
+from datetime import timezone as dt_timezone
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+import httpx
+from django.conf import settings
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from telegram import Bot, Update
+from telegram.error import Forbidden, NetworkError
+from telegram.ext import Application, CallbackContext, CommandHandler, ConversationHandler, DictPersistence
+from bot import admin_handlers, db, expiry, handlers, repository, vpn_service
+from bot.admin_notify import admin_notifier
+from bot.broadcast import Broadcaster, OutgoingMessage
+from bot.cache import client_cache
+from bot.callbacks import MAX_LENGTH, Action, CallbackData, CallbackRouter, decode, encode, max_items
+from bot.db import run_db
+from bot.fake_outline import FakeOutline
+from bot.fake_telegram import InMemoryBotRequest, fake_message
+from bot.metrics import db_execute_wrapper
+from bot.models import BotState, Clients, OutboxMessage, PooledKey
+from bot.outbox import OutboxWorker, _purge, enqueue
+from bot.persistence import (
+    DjangoPersistence, _conversation_key, _drop_conversation_state, _set_conversation_state, add_refresh_handlers,
+)
+from bot.repository import totals_cache
+from bot.scheduler import ExpiryScheduler, remind_at, revoke_at
+from bot.update_processor import KeyedUpdateProcessor
+from bot.settlement import KEY_REQUIRED, settle
+from bot.utils import _channel_membership, is_user_subscribed
+from bot.webhook import WebhookApp
 
-# Create your tests here.
+
+class ClientsIndexTests(TestCase):
+    """Проверяет по EXPLAIN, что горячие запросы к Clients идут по индексам, а не полным сканом."""
+
+    @classmethod
+    def setUpTestData(cls):
+        statuses = ["pending", "approved", "rejected"]
+        payment_statuses = ["not_paid", "awaiting_verification", "paid", "failed"]
+        Clients.objects.bulk_create(
+            Clients(
+                user_id=100000 + i,
+                name=f"user{i}",
+                status=statuses[i % 3],
+                payment_status=payment_statuses[i % 4],
+                subscription_end_date=date(2025, 1, 1) + timedelta(days=i % 90),
+            )
+            for i in range(500)
+        )
+
+    def assertUsesIndex(self, queryset, index_name=None):
+        plan = queryset.explain()
+        if connection.vendor == "sqlite":
+            self.assertNotIn("SCAN bot_clients", plan)
+        elif connection.vendor == "mysql":
+            # колонка type = ALL в EXPLAIN означает полный просмотр таблицы
+            self.assertNotIn(" ALL ", f" {plan} ")
+        if index_name:
+            self.assertIn(index_name, plan)
+
+    def test_lookup_by_user_id(self):
+        self.assertUsesIndex(Clients.objects.filter(user_id=100001))
+
+    def test_expiry_sweep(self):
+        self.assertUsesIndex(
+            Clients.objects.filter(status="approved", subscription_end_date__lte=date(2025, 2, 1))
+            .order_by("subscription_end_date", "id"),
+            "clients_status_end_idx",
+        )
+
+    def test_payment_queue(self):
+        self.assertUsesIndex(
+            Clients.objects.filter(payment_status="awaiting_verification"),
+            "clients_payment_status_idx",
+        )
+
+
+ADMIN_ID = settings.ADMIN_IDS[0]
+USER_ID = 900001
+
+
+def message_update(user_id: int, text: str) -> dict:
+    update = {"update_id": 1, "message": fake_message(1, user_id, text)}
+    update["message"]["from"] = {"id": user_id, "is_bot": False, "first_name": "test", "username": f"user{user_id}"}
+    if text.startswith("/"):
+        update["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return update
+
+
+def callback_update(user_id: int, data: str) -> dict:
+    return {"update_id": 1, "callback_query": {
+        "id": "1",
+        "chat_instance": "test",
+        "from": {"id": user_id, "is_bot": False, "first_name": "test", "username": f"user{user_id}"},
+        "message": fake_message(1, user_id),
+        "data": data,
+    }}
+
+
+def client(**fields):
+    """Возвращает функцию, которая приводит клиента USER_ID к состоянию `fields` (и чистит остальное)."""
+    def setup():
+        Clients.objects.exclude(user_id=USER_ID).delete()
+        PooledKey.objects.all().delete()
+        Clients.objects.update_or_create(user_id=USER_ID, defaults={
+            "name": "test", "status": "pending", "payment_status": "not_paid", "tariff": "",
+            "vpn_id": None, "access_url": "", "subscription_start_date": None, "subscription_end_date": None,
+            **fields,
+        })
+    return setup
+
+
+def with_pooled_key(setup):
+    def setup_with_key():
+        setup()
+        PooledKey.objects.create(vpn_id="pool-1", access_url="ss://pool-1@127.0.0.1:443/?outline=1")
+    return setup_with_key
+
+
+def bulk(count: int, **fields):
+    """Клиенты USER_ID, USER_ID + 1, ... в состоянии `fields`; после setup их id — в bulk.ids."""
+    def setup():
+        Clients.objects.all().delete()
+        Clients.objects.bulk_create(
+            Clients(user_id=USER_ID + i, name=f"test{i}", tariff="1 месяц", **fields) for i in range(count)
+        )
+        bulk.ids = list(Clients.objects.order_by("id").values_list("id", flat=True))
+    return setup
+
+
+def no_clients():
+    Clients.objects.all().delete()
+
+
+# Бюджеты обработчиков: (запросов к БД, вызовов Bot API, запросов к Outline) за одно обновление
+# на холодных кэшах, вместе с фоновыми задачами (уведомления администраторам, переименование ключа).
+# Сообщения пользователям записываются в outbox (один INSERT) и в вызовы Bot API обработчика не входят.
+# Управление транзакциями (BEGIN, SAVEPOINT и т.п.) зависит от СУБД и не считается.
+# Бюджет можно поднять, только если новый запрос или вызов действительно нужен.
+HANDLER_CASES = {
+    "start[new user]": (
+        handlers.start, lambda: message_update(USER_ID, "/start"), no_clients, (1, 2, 0)),
+    "start[active subscription]": (
+        handlers.start, lambda: message_update(USER_ID, "/start"),
+        client(status="approved", subscription_end_date=date.today() + timedelta(days=10)), (1, 2, 0)),
+    "help_command": (
+        handlers.help_command, lambda: message_update(USER_ID, "/help"), no_clients, (0, 1, 0)),
+    "subscription": (
+        handlers.subscription, lambda: message_update(USER_ID, "/subscription"),
+        client(status="approved", subscription_end_date=date.today() + timedelta(days=1)), (1, 1, 0)),
+    "cancel": (
+        handlers.cancel, lambda: message_update(USER_ID, "/cancel"), no_clients, (0, 1, 0)),
+    "handle_user_request": (
+        handlers.handle_user_request, lambda: callback_update(USER_ID, encode(Action.USER_REQUEST)),
+        no_clients, (3, 3, 0)),
+    "handle_tariff_selection": (
+        handlers.handle_tariff_selection, lambda: callback_update(USER_ID, encode(Action.TARIFF, USER_ID, 1)),
+        client(status="approved"), (1, 3, 0)),
+    "handle_payment_choice": (
+        handlers.handle_payment_choice, lambda: callback_update(USER_ID, encode(Action.USER_PAID, USER_ID)),
+        client(status="approved", tariff="1 месяц"), (2, 3, 0)),
+    "handle_renewal_choice[yes]": (
+        handlers.handle_renewal_choice, lambda: callback_update(USER_ID, encode(Action.RENEW, USER_ID, True)),
+        no_clients, (0, 2, 0)),
+    "handle_renewal_choice[no]": (
+        handlers.handle_renewal_choice, lambda: callback_update(USER_ID, encode(Action.RENEW, USER_ID, False)),
+        no_clients, (0, 2, 0)),
+    "handle_admin_decision[approve]": (
+        admin_handlers.handle_admin_decision,
+        lambda: callback_update(ADMIN_ID, encode(Action.ADMIN_DECISION, USER_ID, True)),
+        client(), (3, 2, 0)),
+    "handle_admin_decision[reject]": (
+        admin_handlers.handle_admin_decision,
+        lambda: callback_update(ADMIN_ID, encode(Action.ADMIN_DECISION, USER_ID, False)),
+        client(), (2, 2, 0)),
+    "handle_payment_confirmation[pooled key]": (
+        admin_handlers.handle_payment_confirmation,
+        lambda: callback_update(ADMIN_ID, encode(Action.PAYMENT, USER_ID, True)),
+        with_pooled_key(client(status="approved", tariff="1 месяц", payment_status="awaiting_verification")),
+        (5, 2, 1)),
+    "handle_payment_confirmation[new key]": (
+        admin_handlers.handle_payment_confirmation,
+        lambda: callback_update(ADMIN_ID, encode(Action.PAYMENT, USER_ID, True)),
+        client(status="approved", tariff="1 месяц", payment_status="awaiting_verification"), (6, 2, 2)),
+    "handle_payment_confirmation[failed]": (
+        admin_handlers.handle_payment_confirmation,
+        lambda: callback_update(ADMIN_ID, encode(Action.PAYMENT, USER_ID, False)),
+        client(status="approved", tariff="1 месяц", payment_status="awaiting_verification"), (2, 2, 0)),
+    "handle_bulk_action[approve 5]": (
+        admin_handlers.handle_bulk_action,
+        lambda: callback_update(ADMIN_ID, encode(Action.BULK_APPROVE, 0, *bulk.ids)),
+        bulk(5, status="pending"), (3, 2, 0)),
+    "handle_digest_page": (
+        admin_handlers.handle_digest_page,
+        lambda: callback_update(ADMIN_ID, encode(Action.DIGEST_PAGE, 0, 0, 0)),
+        bulk(5, status="pending", payment_status="awaiting_verification"), (2, 2, 0)),
+}
+
+# Верхняя граница медианы времени обработчика: ловит случайные sleep, блокирующие вызовы и т.п.
+# Зависит от машины, поэтому проверяется только с HANDLER_TIMING_TESTS=1
+HANDLER_TIME_BUDGET = 0.1
+BENCH_ROUNDS = 10
+
+TRANSACTION_CONTROL = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE SAVEPOINT")
+
+
+@override_settings(CHANNEL_GATE=True, CHANNEL_ID="@test_channel")
+class HandlerBudgetTests(TransactionTestCase):
+    """
+    Прогоняет обработчики из handlers.py и admin_handlers.py на синтетических Update
+    с поддельными Bot API (InMemoryBotRequest) и Outline (FakeOutline) и сверяет число
+    запросов к БД, вызовов Bot API и Outline с бюджетом из HANDLER_CASES.
+    TransactionTestCase: запросы идут из потоков пула БД, которым не видна транзакция TestCase.
+    """
+
+    @classmethod
+    def tearDownClass(cls):
+        db.db_pool.close_connections()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.sql = []
+
+        def record(execute, sql, params, many, context):
+            if not sql.lstrip().upper().startswith(TRANSACTION_CONTROL):
+                self.sql.append(sql)
+            return db_execute_wrapper(execute, sql, params, many, context)
+
+        patcher = mock.patch.object(db, "db_execute_wrapper", record)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def drive(self, handler, make_update, setup, rounds: int) -> list:
+        """Выполняет обработчик `rounds` раз; возвращает [(SQL-запросы, методы Bot API, запросов к Outline, время)]."""
+        request = InMemoryBotRequest()
+        application = Application.builder().token("1:test").request(request)\
+            .get_updates_request(InMemoryBotRequest()).build()
+        outline = FakeOutline()
+        outline_client = vpn_service.OutlineClient("http://outline/access-keys/", transport=httpx.ASGITransport(app=outline))
+        # Общие объекты модулей подменяются на время прогона и восстанавливаются после него
+        for target, attribute, value in (
+            (vpn_service, "_outline_client", outline_client),
+            (admin_notifier, "admin_ids", [ADMIN_ID]),
+            (admin_notifier, "digest_mode", False),
+            (admin_notifier, "_broadcaster", None),
+        ):
+            patcher = mock.patch.object(target, attribute, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        results = []
+        try:
+            async with application:
+                await application.start()
+                for _ in range(rounds):
+                    await run_db(setup)
+                    outline.keys = {"pool-1": {"id": "pool-1", "name": ""}}
+                    outline.requests = 0
+                    request.calls.clear()
+                    for cache in (client_cache, totals_cache, _channel_membership.cache):
+                        cache.clear()
+                    admin_notifier.digest_mode, admin_notifier._broadcaster = False, None
+                    admin_notifier._events.clear()
+
+                    update = Update.de_json(make_update(), application.bot)
+                    context = CallbackContext.from_update(update, application)
+                    args = (update, context)
+                    if update.callback_query:
+                        args += (decode(update.callback_query.data),)
+                    background = asyncio.all_tasks()
+                    self.sql.clear()
+                    started = time.perf_counter()
+                    await handler(*args)
+                    elapsed = time.perf_counter() - started
+                    # Фоновые задачи обработчика тоже входят в бюджет
+                    await asyncio.gather(*(asyncio.all_tasks() - background))
+                    results.append((list(self.sql), list(request.calls), outline.requests, elapsed))
+                await application.stop()
+        finally:
+            await outline_client.aclose()
+        return results
+
+    def test_budgets(self):
+        for name, (handler, make_update, setup, budget) in HANDLER_CASES.items():
+            with self.subTest(name):
+                (queries, calls, outline, _), = asyncio.run(self.drive(handler, make_update, setup, 1))
+                self.assertLessEqual(len(queries), budget[0], f"{name}: запросы к БД " + "\n".join(queries))
+                self.assertLessEqual(len(calls), budget[1], f"{name}: вызовов Bot API {calls}")
+                self.assertLessEqual(outline, budget[2], f"{name}: запросов к Outline")
+
+    def test_bulk_approve_does_not_grow_with_size(self):
+        make_update = lambda: callback_update(ADMIN_ID, encode(Action.BULK_APPROVE, 0, *bulk.ids))
+        queries = {}
+        for size in (2, 8):
+            (sql, _, _, _), = asyncio.run(self.drive(admin_handlers.handle_bulk_action, make_update,
+                                                     bulk(size, status="pending"), 1))
+            queries[size] = len(sql)
+            self.assertEqual(Clients.objects.filter(status="approved").count(), size)
+            self.assertEqual(OutboxMessage.objects.count(), size)
+            OutboxMessage.objects.all().delete()
+        self.assertEqual(queries[2], queries[8], queries)
+
+    @skipUnless(os.getenv("HANDLER_TIMING_TESTS") == "1", "замеры времени включаются HANDLER_TIMING_TESTS=1")
+    def test_timings(self):
+        for name, (handler, make_update, setup, _) in HANDLER_CASES.items():
+            with self.subTest(name):
+                results = asyncio.run(self.drive(handler, make_update, setup, BENCH_ROUNDS))
+                median = statistics.median(elapsed for *_, elapsed in results)
+                self.assertLess(median, HANDLER_TIME_BUDGET, f"{name}: медиана {median * 1000:.1f} мс")
+
+
+class StubBot:
+    """Бот, который записывает отправленные сообщения и бросает исключения из `errors[chat_id]`."""
+
+    def __init__(self, errors=None):
+        self.sent = []
+        self.errors = errors or {}
+
+    async def send_message(self, chat_id, text, reply_markup=None, parse_mode=None):
+        error = self.errors.get(chat_id)
+        if error is not None:
+            raise error
+        self.sent.append((chat_id, text, reply_markup))
+
+
+class OutboxTests(TransactionTestCase):
+    """Запись в outbox и доставка OutboxWorker: идемпотентность, порядок в чате, повторы и dead."""
+
+    @classmethod
+    def tearDownClass(cls):
+        db.db_pool.close_connections()
+        super().tearDownClass()
+
+    def worker(self, bot, **options):
+        return OutboxWorker(bot, rate=1000, chat_rate=1000, chat_burst=10, **options)
+
+    def test_enqueue_is_idempotent(self):
+        message = OutgoingMessage(USER_ID, "напоминание", key=f"renewal:{USER_ID}:2025-01-01")
+        enqueue([message])
+        enqueue([message])
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+
+    def test_delivery_and_dead_letter(self):
+        markup = admin_handlers.get_tariff_keyboard(USER_ID)
+        enqueue([OutgoingMessage(USER_ID, f"сообщение {i}", markup if i == 0 else None) for i in range(3)])
+        enqueue([OutgoingMessage(USER_ID + 1, "заблокировал бота")])
+        bot = StubBot({USER_ID + 1: Forbidden("bot was blocked by the user")})
+        worker = self.worker(bot)
+
+        asyncio.run(worker.drain())
+
+        self.assertEqual([text for _, text, _ in bot.sent], ["сообщение 0", "сообщение 1", "сообщение 2"])
+        self.assertEqual(bot.sent[0][2], markup)
+        self.assertEqual(OutboxMessage.objects.filter(status="sent").count(), 3)
+        dead = OutboxMessage.objects.get(chat_id=USER_ID + 1)
+        self.assertEqual((dead.status, dead.attempts), ("dead", 1))
+        self.assertIn("Forbidden", dead.last_error)
+        self.assertEqual((worker.summary.sent, worker.summary.blocked), (3, 1))
+
+    def test_retry_keeps_chat_order(self):
+        enqueue([OutgoingMessage(USER_ID, "первое"), OutgoingMessage(USER_ID, "второе")])
+        bot = StubBot({USER_ID: NetworkError("connection reset")})
+
+        asyncio.run(self.worker(bot, max_attempts=2).drain())
+
+        first, second = OutboxMessage.objects.order_by("id")
+        self.assertEqual((first.status, first.attempts), ("pending", 1))
+        self.assertGreater(first.available_at, timezone.now())
+        # Второе сообщение не обогнало первое
+        self.assertEqual((second.status, second.attempts), ("pending", 0))
+        self.assertGreater(second.available_at, timezone.now())
+
+        OutboxMessage.objects.update(available_at=timezone.now())
+        asyncio.run(self.worker(bot, max_attempts=2).drain())
+        first.refresh_from_db()
+        self.assertEqual((first.status, first.attempts), ("dead", 2))
+
+    def test_retry_holds_chat_beyond_batch(self):
+        enqueue([OutgoingMessage(USER_ID, f"сообщение {i}") for i in range(4)])
+        enqueue([OutgoingMessage(USER_ID + 1, "другой чат")])
+        bot = StubBot({USER_ID: NetworkError("connection reset")})
+
+        with self.assertLogs("bot.outbox", "WARNING"):
+            asyncio.run(self.worker(bot, batch_size=2).drain())
+        # Сообщения 2 и 3 не попали в порцию с первым, но тоже ждут его повтора
+        self.assertEqual(bot.sent, [(USER_ID + 1, "другой чат", None)])
+        pending = OutboxMessage.objects.filter(chat_id=USER_ID).order_by("id")
+        self.assertTrue(all(row.available_at > timezone.now() for row in pending))
+
+        # Пока первое сообщение отложено или арендовано, последующие сообщения чата не забираются
+        OutboxMessage.objects.exclude(id=pending[0].id).update(available_at=timezone.now())
+        bot.errors.clear()
+        asyncio.run(self.worker(bot, batch_size=2).drain())
+        self.assertEqual(len(bot.sent), 1)
+
+        OutboxMessage.objects.update(available_at=timezone.now())
+        asyncio.run(self.worker(bot, batch_size=2).drain())
+        self.assertEqual([text for _, text, _ in bot.sent[1:]], [f"сообщение {i}" for i in range(4)])
+
+
+    def test_rows_are_marked_sent_one_by_one(self):
+        enqueue([OutgoingMessage(USER_ID, "первое"), OutgoingMessage(USER_ID, "второе")])
+        statuses = []
+
+        class CheckingBot(StubBot):
+            async def send_message(self, chat_id, text, **kwargs):
+                # Пока второе сообщение отправляется, первое уже отмечено в таблице
+                statuses.append(await run_db(lambda: list(OutboxMessage.objects.order_by("id")
+                                                          .values_list("status", flat=True))))
+                await super().send_message(chat_id, text, **kwargs)
+
+        asyncio.run(self.worker(CheckingBot()).drain())
+        self.assertEqual(statuses, [["pending", "pending"], ["sent", "pending"]])
+
+    def test_purge_keeps_recent_and_pending(self):
+        enqueue([OutgoingMessage(USER_ID, str(i)) for i in range(5)])
+        old = timezone.now() - timedelta(days=60)
+        first, second, third, fourth, _ = OutboxMessage.objects.order_by("id")
+        OutboxMessage.objects.filter(id=first.id).update(status="sent", sent_at=old)
+        OutboxMessage.objects.filter(id=second.id).update(status="sent", sent_at=timezone.now())
+        OutboxMessage.objects.filter(id=third.id).update(status="dead", created_at=old)
+        OutboxMessage.objects.filter(id=fourth.id).update(status="dead")
+        now = timezone.now()
+        _purge(now - timedelta(days=settings.OUTBOX_RETENTION_DAYS),
+               now - timedelta(days=settings.OUTBOX_DEAD_RETENTION_DAYS))
+        self.assertEqual(sorted(OutboxMessage.objects.values_list("status", flat=True)), ["dead", "pending", "sent"])
+
+
+class ExpirySchedulerTests(TransactionTestCase):
+    """Планировщик подписок: время событий, загрузка горизонта, напоминание и отключение по порции."""
+
+    @classmethod
+    def tearDownClass(cls):
+        db.db_pool.close_connections()
+        super().tearDownClass()
+
+    def test_due_times(self):
+        end = date(2025, 3, 10)
+        remind = datetime.fromtimestamp(remind_at(USER_ID, end), dt_timezone.utc)
+        revoke = datetime.fromtimestamp(revoke_at(USER_ID, end), dt_timezone.utc)
+        self.assertEqual(remind.date(), end - timedelta(days=1))
+        self.assertTrue(settings.EXPIRY_REMIND_FROM <= remind.hour < settings.EXPIRY_REMIND_TO)
+        self.assertEqual(revoke.date(), end)
+        self.assertLess(revoke.hour * 3600 + revoke.minute * 60, settings.EXPIRY_REVOKE_SPREAD)
+        # Сдвиг постоянный для пользователя и разный у разных пользователей
+        self.assertEqual(remind_at(USER_ID, end), remind_at(USER_ID, end))
+        self.assertNotEqual(remind_at(USER_ID, end), remind_at(USER_ID + 1, end))
+
+    def test_load_and_fire(self):
+        today = timezone.now().date()
+        approved = {"status": "approved", "payment_status": "paid", "tariff": "1 месяц"}
+        Clients.objects.create(user_id=USER_ID, name="завтра", subscription_end_date=today + timedelta(days=1),
+                               **approved)
+        Clients.objects.create(user_id=USER_ID + 1, name="сегодня", vpn_id="key-1", access_url="ss://key-1",
+                               subscription_end_date=today, **approved)
+        Clients.objects.create(user_id=USER_ID + 2, name="продлил", subscription_end_date=today + timedelta(days=1),
+                               **approved)
+        Clients.objects.create(user_id=USER_ID + 3, name="не скоро", subscription_end_date=today + timedelta(days=30),
+                               **approved)
+        outline = FakeOutline()
+        outline.keys = {"key-1": {"id": "key-1", "name": "сегодня"}}
+        scheduler = ExpiryScheduler()
+
+        async def run():
+            vpn_service._outline_client = vpn_service.OutlineClient(
+                "http://outline/access-keys/", transport=httpx.ASGITransport(app=outline)
+            )
+            try:
+                await scheduler.load()
+                # Продлил после загрузки: устаревшая запись кучи ничего не отправит
+                await run_db(Clients.objects.filter(user_id=USER_ID + 2).update,
+                             subscription_end_date=today + timedelta(days=31))
+                batch = scheduler.pop_due(max(remind_at(USER_ID, today + timedelta(days=1)),
+                                              revoke_at(USER_ID + 1, today)))
+                await scheduler.fire(batch)
+            finally:
+                await vpn_service.close_outline_client()
+
+        asyncio.run(run())
+
+        # Дальняя подписка в кучу не попала, у отключённого клиента событий больше нет
+        self.assertEqual({entry[2] for entry in scheduler._heap}, {USER_ID, USER_ID + 2})
+        self.assertEqual(
+            sorted(OutboxMessage.objects.values_list("key", flat=True)),
+            [f"expired:{USER_ID + 1}:{today}", f"renewal:{USER_ID}:{today + timedelta(days=1)}"],
+        )
+        expired = Clients.objects.get(user_id=USER_ID + 1)
+        self.assertEqual((expired.status, expired.vpn_id), ("pending", None))
+        self.assertEqual(outline.keys, {})
+
+
+    def test_renewal_during_revocation_is_kept(self):
+        today = timezone.now().date()
+        Clients.objects.create(user_id=USER_ID, name="продлевает", status="approved", tariff="1 месяц",
+                               payment_status="awaiting_verification", vpn_id="key-1", access_url="ss://key-1",
+                               subscription_end_date=today)
+        clients = asyncio.run(repository.fetch_clients([USER_ID], status="approved"))
+
+        async def revoke_while_admin_confirms(vpn_ids, concurrency=None):
+            # Оплата подтверждается, пока ключ отзывается: отозванный ключ ей не достаётся
+            result = await run_db(settle, USER_ID, None, today)
+            self.assertEqual(result.status, KEY_REQUIRED)
+            await run_db(settle, USER_ID, {"id": "key-2", "accessUrl": "ss://key-2"}, today)
+            return {vpn_id: True for vpn_id in vpn_ids}
+
+        with mock.patch("bot.expiry.revoke_keys", revoke_while_admin_confirms):
+            asyncio.run(expiry.expire(clients, today=today))
+
+        renewed = Clients.objects.get(user_id=USER_ID)
+        self.assertEqual((renewed.status, renewed.vpn_id, renewed.access_url), ("approved", "key-2", "ss://key-2"))
+        self.assertGreater(renewed.subscription_end_date, today)
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_failed_revocation_keeps_key_for_renewal(self):
+        today = timezone.now().date()
+        Clients.objects.create(user_id=USER_ID, name="продлевает", status="approved", tariff="1 месяц",
+                               vpn_id="key-1", access_url="ss://key-1", subscription_end_date=today)
+        clients = asyncio.run(repository.fetch_clients([USER_ID], status="approved"))
+
+        async def revoke_fails(vpn_ids, concurrency=None):
+            return {vpn_id: False for vpn_id in vpn_ids}
+
+        with mock.patch("bot.expiry.revoke_keys", revoke_fails), self.assertLogs("bot.expiry", "ERROR"):
+            disabled, failed = asyncio.run(expiry.expire(clients, today=today))
+        self.assertEqual((len(disabled), len(failed)), (0, 1))
+        self.assertEqual(Clients.objects.get(user_id=USER_ID).access_url, "ss://key-1")
+
+        # Оплата после неудачного отзыва продлевает тот же ключ, а не выдаёт второй
+        Clients.objects.filter(user_id=USER_ID).update(payment_status="awaiting_verification")
+        result = settle(USER_ID, None, today)
+        self.assertEqual((result.vpn_id, result.access_url, result.replaced_vpn_id), ("key-1", "ss://key-1", ""))
+        self.assertGreater(result.subscription_end_date, today)
+
+    def test_key_replaced_during_failed_revocation_is_reported(self):
+        today = timezone.now().date()
+        Clients.objects.create(user_id=USER_ID, name="продлевает", status="approved", tariff="1 месяц",
+                               payment_status="awaiting_verification", vpn_id="key-1", access_url="ss://key-1",
+                               subscription_end_date=today)
+        clients = asyncio.run(repository.fetch_clients([USER_ID], status="approved"))
+        settled = []
+
+        async def revoke_fails_while_admin_confirms(vpn_ids, concurrency=None):
+            settled.append(await run_db(settle, USER_ID, {"id": "key-2", "accessUrl": "ss://key-2"}, today))
+            return {vpn_id: False for vpn_id in vpn_ids}
+
+        with mock.patch("bot.expiry.revoke_keys", revoke_fails_while_admin_confirms), \
+                self.assertLogs("bot.expiry", "ERROR"):
+            asyncio.run(expiry.expire(clients, today=today))
+        # Новый ключ не затирается восстановлением, а прежний передаётся на отзыв
+        renewed = Clients.objects.get(user_id=USER_ID)
+        self.assertEqual((renewed.vpn_id, renewed.access_url), ("key-2", "ss://key-2"))
+        self.assertEqual(settled[0].replaced_vpn_id, "key-1")
+
+        async def revoke_fails(vpn_ids, concurrency=None):
+            return {vpn_id: False for vpn_id in vpn_ids}
+
+        with mock.patch.object(admin_handlers, "revoke_keys", revoke_fails), \
+                self.assertLogs("bot.admin_handlers", "ERROR") as logs:
+            self.assertFalse(asyncio.run(admin_handlers.revoke_replaced_key(USER_ID, "key-1")))
+        self.assertIn("revoke_keys key-1", logs.output[0])
+
+
+class WebhookTests(SimpleTestCase):
+    """Webhook принимает только запросы с секретом Telegram и ограниченным телом."""
+
+    def setUp(self):
+        self.application = Application.builder().token("1:test").request(InMemoryBotRequest())\
+            .get_updates_request(InMemoryBotRequest()).build()
+
+    def post(self, webhook, content, headers=None):
+        async def run():
+            transport = httpx.ASGITransport(app=webhook)
+            async with httpx.AsyncClient(transport=transport, base_url="http://webhook") as client:
+                return (await client.post(webhook.path, content=content, headers=headers or {})).status_code
+        return asyncio.run(run())
+
+    def test_secret_is_required(self):
+        with self.assertRaises(ImproperlyConfigured):
+            WebhookApp(self.application, secret="")
+
+    def test_rejects_forged_and_oversized_updates(self):
+        webhook = WebhookApp(self.application, secret="s3cret")
+        update = b'{"update_id": 1}'
+        self.assertEqual(self.post(webhook, update), 403)
+        self.assertEqual(self.post(webhook, update, {"X-Telegram-Bot-Api-Secret-Token": "wrong"}), 403)
+        token = {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+        self.assertEqual(self.post(webhook, b" " * (settings.WEBHOOK_MAX_BODY + 1) + update, token), 413)
+        self.assertEqual(self.post(webhook, update, token), 200)
+        self.assertEqual(self.application.update_queue.get_nowait().update_id, 1)
+
+
+class ChannelMembershipTests(SimpleTestCase):
+    """Проверка подписки на канал: один запрос на всех ожидающих, TTL кэша, пропуск при ошибке Bot API."""
+
+    class Bot:
+        def __init__(self, status="member", error=None):
+            self.status, self.error, self.calls = status, error, 0
+
+        async def get_chat_member(self, chat_id, user_id):
+            self.calls += 1
+            await asyncio.sleep(0.01)
+            if self.error is not None:
+                raise self.error
+            return SimpleNamespace(status=self.status)
+
+    def setUp(self):
+        _channel_membership.cache.clear()
+        self.addCleanup(_channel_membership.cache.clear)
+        self.now = 1000.0
+        # Часы кэша — только в bot.cache: цикл событий продолжает жить по настоящему времени
+        patcher = mock.patch("bot.cache.time", SimpleNamespace(monotonic=lambda: self.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def check(self, bot, count=1):
+        context = SimpleNamespace(bot=bot)
+
+        async def run():
+            return await asyncio.gather(*(is_user_subscribed(USER_ID, context) for _ in range(count)))
+        return asyncio.run(run())
+
+    def test_concurrent_callers_share_one_request(self):
+        bot = self.Bot()
+        self.assertEqual(self.check(bot, count=10), [True] * 10)
+        self.assertEqual(bot.calls, 1)
+
+    def test_ttl_expiry(self):
+        bot = self.Bot(status="left")
+        self.check(bot)
+        self.now += settings.SUBSCRIPTION_CACHE_MISS_TTL / 2
+        self.check(bot)
+        self.assertEqual(bot.calls, 1)
+        # «Не подписан» живёт SUBSCRIPTION_CACHE_MISS_TTL, «подписан» — SUBSCRIPTION_CACHE_TTL
+        self.now += settings.SUBSCRIPTION_CACHE_MISS_TTL
+        bot.status = "member"
+        self.assertEqual(self.check(bot), [True])
+        self.now += settings.SUBSCRIPTION_CACHE_TTL - 1
+        self.check(bot)
+        self.assertEqual(bot.calls, 2)
+        self.now += 2
+        self.check(bot)
+        self.assertEqual(bot.calls, 3)
+
+    def test_api_error_lets_user_through(self):
+        bot = self.Bot(error=NetworkError("timeout"))
+        self.assertEqual(self.check(bot), [True])
+        self.check(bot)
+        # Ошибка не кэшируется: следующая проверка снова идёт в Bot API
+        self.assertEqual(bot.calls, 2)
+
+    @override_settings(CHANNEL_ID=None)
+    def test_gate_message_without_channel(self):
+        self.assertIsNone(handlers.channel_gate_message()["reply_markup"])
+
+
+class ConversationInternalsTests(SimpleTestCase):
+    """
+    Закрытые части ConversationHandler, на которых держится refresh_conversations: при обновлении
+    python-telegram-bot этот тест показывает, что bot.persistence нужно переписать.
+    """
+
+    def test_key_and_state_overrides(self):
+        conversation = ConversationHandler(
+            entry_points=[CommandHandler("start", handlers.start)],
+            states={1: [CommandHandler("next", handlers.start)]},
+            fallbacks=[],
+            name="internals",
+            persistent=True,
+        )
+        application = Application.builder().token("1:test").request(InMemoryBotRequest())\
+            .get_updates_request(InMemoryBotRequest()).persistence(DictPersistence()).build()
+        application.add_handler(conversation)
+
+        async def run():
+            async with application:
+                update = Update.de_json(message_update(USER_ID, "/next"), application.bot)
+                key = _conversation_key(conversation, update)
+                self.assertEqual(key, (USER_ID, USER_ID))
+                self.assertIsNone(conversation.check_update(update))
+
+                _set_conversation_state(conversation, key, 1)
+                self.assertIsNotNone(conversation.check_update(update))
+                # Подменённое состояние не уходит обратно в persistence как изменение
+                await application.update_persistence()
+                self.assertEqual(application.persistence.conversations.get("internals", {}), {})
+
+                _drop_conversation_state(conversation, key)
+                self.assertIsNone(conversation.check_update(update))
+
+        asyncio.run(run())
+
+
+class SharedConversationTests(TransactionTestCase):
+    """Состояние диалога при PERSISTENCE_REFRESH видно всем процессам и не затирается устаревшей записью."""
+
+    @classmethod
+    def tearDownClass(cls):
+        db.db_pool.close_connections()
+        super().tearDownClass()
+
+    def process(self, calls):
+        """Отдельный «процесс» бота: своё Application, своя DjangoPersistence, общая БД."""
+        def step(name, state):
+            async def callback(update, context):
+                calls.append(name)
+                return state
+            return callback
+
+        conversation = ConversationHandler(
+            entry_points=[CommandHandler("start", step("start", 1))],
+            states={1: [CommandHandler("next", step("next", 2))], 2: []},
+            fallbacks=[],
+            name="shared",
+            persistent=True,
+        )
+        application = Application.builder().token("1:test").request(InMemoryBotRequest())\
+            .get_updates_request(InMemoryBotRequest()).persistence(DjangoPersistence(flush_delay=0, refresh=True))\
+            .build()
+        application.add_handler(conversation)
+        add_refresh_handlers(application, [conversation])
+        return application
+
+    def test_state_follows_user_across_processes(self):
+        calls = []
+        first, second = self.process(calls), self.process(calls)
+
+        async def run():
+            async with first, second:
+                for application, text in ((first, "/start"), (second, "/next"), (first, "/next")):
+                    await application.process_update(Update.de_json(message_update(USER_ID, text), application.bot))
+                # Первый процесс пишет состояние по устаревшей версии — запись отклоняется
+                ident = ("conversation", "shared", json.dumps([USER_ID, USER_ID]))
+                first.persistence._versions[ident] = 1
+                await first.persistence.update_conversation("shared", (USER_ID, USER_ID), 1)
+                with self.assertLogs("bot.persistence", "WARNING"):
+                    await first.persistence.flush()
+
+        asyncio.run(run())
+
+        # Второй процесс продолжил диалог, начатый первым; первый увидел, что шаг уже пройден
+        self.assertEqual(calls, ["start", "next"])
+        row = BotState.objects.get(kind="conversation", namespace="shared")
+        self.assertEqual((row.data, row.version), (2, 2))
+
+
+class KeyedUpdateProcessorTests(SimpleTestCase):
+    """Обновления разных пользователей обрабатываются одновременно, одного пользователя — по порядку."""
+
+    def test_order_per_key_and_overlap_across_keys(self):
+        events = []
+
+        async def handle(user_id, number, delay):
+            events.append(("start", user_id, number))
+            await asyncio.sleep(delay)
+            events.append(("end", user_id, number))
+
+        async def run():
+            processor = KeyedUpdateProcessor(concurrency=4)
+            tasks = []
+            # Первые обновления каждого пользователя дольше последующих: без очереди по ключу они бы обогнались
+            for number, delay in enumerate((0.05, 0.02, 0.01)):
+                for user_id in (USER_ID, USER_ID + 1):
+                    update = Update.de_json(message_update(user_id, f"шаг {number}"), None)
+                    tasks.append(asyncio.create_task(
+                        processor.process_update(update, handle(user_id, number, delay))
+                    ))
+            await asyncio.gather(*tasks)
+
+        asyncio.run(run())
+
+        for user_id in (USER_ID, USER_ID + 1):
+            own = [(kind, number) for kind, uid, number in events if uid == user_id]
+            self.assertEqual(own, [(kind, number) for number in range(3) for kind in ("start", "end")])
+        # Второй пользователь начал, пока первый ещё обрабатывался
+        self.assertLess(events.index(("start", USER_ID + 1, 0)), events.index(("end", USER_ID, 0)))
+
+
+@override_settings(OUTLINE_RETRIES=2, OUTLINE_BREAKER_THRESHOLD=2, OUTLINE_BREAKER_COOLDOWN=30)
+class OutlineClientTests(SimpleTestCase):
+    """Повторы запросов к Outline и переходы предохранителя: замкнут → разомкнут → одна проба."""
+
+    def run_client(self, outline, scenario):
+        async def run():
+            client = vpn_service.OutlineClient("http://outline/access-keys/",
+                                               transport=httpx.ASGITransport(app=outline))
+            try:
+                return await scenario(client)
+            finally:
+                await client.aclose()
+        return asyncio.run(run())
+
+    def test_retries_only_idempotent_requests(self):
+        outline = FakeOutline(error_rate=1.0)
+
+        async def scenario(client):
+            with self.assertRaises(vpn_service.OutlineUnavailable):
+                await client.list_keys()
+            self.assertEqual(outline.requests, settings.OUTLINE_RETRIES + 1)
+            with self.assertRaises(vpn_service.OutlineUnavailable):
+                await client.create_key()
+            # POST не повторяется, чтобы не создать лишний ключ
+            self.assertEqual(outline.requests, settings.OUTLINE_RETRIES + 2)
+
+        self.run_client(outline, scenario)
+
+    def test_breaker_opens_and_lets_one_probe_through(self):
+        outline = FakeOutline(error_rate=1.0)
+
+        async def fail(client, times):
+            for _ in range(times):
+                with self.assertRaises(vpn_service.OutlineUnavailable):
+                    await client.list_keys()
+
+        async def scenario(client):
+            await fail(client, settings.OUTLINE_BREAKER_THRESHOLD)
+            self.assertTrue(client.breaker.is_open)
+            # Разомкнут: запросы отклоняются, не доходя до сервера
+            requests = outline.requests
+            await fail(client, 3)
+            self.assertEqual(outline.requests, requests)
+
+            # Пауза прошла, сервер восстановился: из одновременных вызовов к нему идёт только проба
+            client.breaker.opened_at -= settings.OUTLINE_BREAKER_COOLDOWN
+            outline.error_rate, outline.latency = 0.0, 0.02
+            results = await asyncio.gather(*(client.list_keys() for _ in range(5)), return_exceptions=True)
+            self.assertEqual(sum(isinstance(r, vpn_service.OutlineUnavailable) for r in results), 4)
+            self.assertEqual(outline.requests, requests + 1)
+            self.assertFalse(client.breaker.is_open)
+            await client.list_keys()
+
+            # Неудачная проба снова размыкает предохранитель
+            outline.error_rate = 1.0
+            await fail(client, settings.OUTLINE_BREAKER_THRESHOLD)
+            client.breaker.opened_at -= settings.OUTLINE_BREAKER_COOLDOWN
+            requests = outline.requests
+            await fail(client, 2)
+            self.assertEqual(outline.requests, requests + settings.OUTLINE_RETRIES + 1)
+            self.assertTrue(client.breaker.is_open)
+
+        self.run_client(outline, scenario)
+
+
+class CallbackDataTests(SimpleTestCase):
+    """callback_data: упаковка и разбор всех действий, старый строковый формат, некорректные данные."""
+
+    PAYLOADS = {
+        Action.USER_REQUEST: (0, ()),
+        Action.TARIFF: (USER_ID, (6,)),
+        Action.USER_PAID: (USER_ID, ()),
+        Action.RENEW: (USER_ID, (False,)),
+        Action.ADMIN_DECISION: (USER_ID, (True,)),
+        Action.PAYMENT: (USER_ID, (False,)),
+        Action.BULK_APPROVE: (0, (1, 2, 4_000_000_000)),
+        Action.BULK_CONFIRM: (0, ()),
+        Action.DIGEST_PAGE: (0, (10, 20)),
+        Action.QUEUE_PAGE: (0, (0, 7)),
+        Action.QUEUE_ACTION: (USER_ID, (2, 10, 20)),
+    }
+
+    def test_round_trip_for_every_action(self):
+        self.assertEqual(set(self.PAYLOADS), set(Action))
+        for action, (user_id, args) in self.PAYLOADS.items():
+            with self.subTest(action=action.name):
+                data = encode(action, user_id, *args)
+                self.assertLessEqual(len(data.encode()), MAX_LENGTH)
+                self.assertEqual(decode(data), CallbackData(action, user_id, args))
+        # Telegram user_id больше 2**32 тоже помещается
+        self.assertEqual(decode(encode(Action.USER_PAID, 8_000_000_000)).user_id, 8_000_000_000)
+
+    def test_longest_list_fits(self):
+        ids = tuple(range(max_items(Action.BULK_APPROVE)))
+        self.assertEqual(decode(encode(Action.BULK_APPROVE, 0, *ids)).args, ids)
+        with self.assertRaises(ValueError):
+            encode(Action.BULK_APPROVE, 0, *ids, 0)
+
+    def test_legacy_format(self):
+        cases = {
+            "user_request": CallbackData(Action.USER_REQUEST),
+            f"tariff_3months_{USER_ID}": CallbackData(Action.TARIFF, USER_ID, (3,)),
+            f"user_paid_{USER_ID}": CallbackData(Action.USER_PAID, USER_ID),
+            f"renew_yes_{USER_ID}": CallbackData(Action.RENEW, USER_ID, (True,)),
+            f"admin_reject_{USER_ID}": CallbackData(Action.ADMIN_DECISION, USER_ID, (False,)),
+            f"payment_success_{USER_ID}": CallbackData(Action.PAYMENT, USER_ID, (True,)),
+        }
+        for data, expected in cases.items():
+            with self.subTest(data=data):
+                self.assertEqual(decode(data), expected)
+
+    def test_rejects_malformed_data(self):
+        valid = encode(Action.DIGEST_PAGE, 0, 1, 2)
+        for data in (
+            "", "1", "1!!!", "1" + "A" * 10, valid[:-2], valid + "AAAA",  # битый base64, неверная длина
+            encode(Action.USER_PAID, USER_ID).replace("1A", "1_", 1),  # неизвестное действие
+            "tariff_2years_1", "admin_approve_x", "something",
+            "1" + "A" * MAX_LENGTH,  # длиннее 64 байт
+        ):
+            with self.subTest(data=data):
+                self.assertIsNone(decode(data))
+
+    def test_invalid_data_is_logged_once(self):
+        update = Update.de_json(callback_update(USER_ID, "garbage"), None)
+        routers = [CallbackRouter({Action.USER_REQUEST: None}), CallbackRouter({Action.TARIFF: None})]
+        with self.assertLogs("bot.callbacks", "WARNING") as logs:
+            for router in routers:
+                self.assertIsNone(router.check_update(update))
+        self.assertEqual(len(logs.records), 1)
+
+
+class ThrottledBotRequest(InMemoryBotRequest):
+    """InMemoryBotRequest, который запоминает время каждого sendMessage и отвечает 429 на первые сообщения в `limited`."""
+
+    def __init__(self, limited=(), retry_after=1):
+        super().__init__()
+        self.limited = set(limited)
+        self.retry_after = retry_after
+        self.sent = []
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        if url.endswith("/sendMessage"):
+            chat_id = request_data.parameters["chat_id"]
+            self.sent.append((time.monotonic(), chat_id))
+            if chat_id in self.limited:
+                self.limited.discard(chat_id)
+                return 429, json.dumps({"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                        "parameters": {"retry_after": self.retry_after}}).encode()
+        return await super().do_request(url, method, request_data, **kwargs)
+
+
+class BroadcastRateTests(SimpleTestCase):
+    """
+    Лимиты рассылки на поддельном Bot API: общий (Broadcaster), на чат (OutboxWorker) и пауза по RetryAfter.
+    Проверяется только нижняя граница времени — медленная машина её не нарушит.
+    """
+
+    def run_with_bot(self, request, send):
+        async def run():
+            bot = Bot("1:test", request=request)
+            await bot.initialize()
+            try:
+                return await send(bot)
+            finally:
+                await bot.shutdown()
+        return asyncio.run(run())
+
+    def assertRate(self, times, rate, burst):
+        # В любом окне [t_i, t_j] отправлено не больше burst + rate * (t_j - t_i) сообщений
+        # (плюс одно на округление на границе окна)
+        times = sorted(times)
+        for i in range(len(times)):
+            for j in range(i, len(times)):
+                self.assertLessEqual(j - i + 1, burst + rate * (times[j] - times[i]) + 1)
+
+    def test_burst_respects_global_rate(self):
+        request = ThrottledBotRequest()
+        messages = [OutgoingMessage(chat_id=USER_ID + i, text="привет") for i in range(60)]
+        summary = self.run_with_bot(request, lambda bot: Broadcaster(bot, rate=40, concurrency=10).send_many(messages))
+        self.assertEqual((summary.sent, summary.failed, summary.retried), (60, 0, 0))
+        self.assertEqual(sorted(chat_id for _, chat_id in request.sent), [m.chat_id for m in messages])
+        times = [t for t, _ in request.sent]
+        self.assertGreaterEqual(max(times) - min(times), (60 - 40 - 1) / 40)
+        self.assertRate(times, 40, 40)
+
+    def test_burst_respects_chat_rate(self):
+        request = ThrottledBotRequest()
+        chats = (USER_ID, USER_ID + 1)
+
+        async def send(bot):
+            worker = OutboxWorker(bot, rate=100, chat_rate=10, chat_burst=2)
+
+            async def deliver_chat(chat_id):
+                for i in range(6):
+                    self.assertEqual(await worker.send(OutboxMessage(id=i, chat_id=chat_id, text="привет")), ("sent", 0))
+
+            await asyncio.gather(*(deliver_chat(chat_id) for chat_id in chats))
+
+        self.run_with_bot(request, send)
+        for chat_id in chats:
+            times = [t for t, sent_to in request.sent if sent_to == chat_id]
+            self.assertEqual(len(times), 6)
+            self.assertGreaterEqual(times[-1] - times[0], (6 - 2 - 1) / 10)
+            self.assertRate(times, 10, 2)
+
+    def test_retry_after_pauses_every_sender(self):
+        request = ThrottledBotRequest(limited={USER_ID + 2}, retry_after=1)
+        messages = [OutgoingMessage(chat_id=USER_ID + i, text="привет") for i in range(6)]
+        with self.assertLogs("bot.broadcast", "WARNING"):
+            summary = self.run_with_bot(request, lambda bot: Broadcaster(bot, rate=100, concurrency=2).send_many(messages))
+        self.assertEqual((summary.sent, summary.failed, summary.retried), (6, 0, 1))
+        limited_at = next(t for t, chat_id in request.sent if chat_id == USER_ID + 2)
+        retried_at = [t for t, chat_id in request.sent if chat_id == USER_ID + 2][1]
+        self.assertGreaterEqual(retried_at - limited_at, 1)
+        # Пока длится пауза, может завершиться лишь запрос второго воркера, уже взявшего токен
+        during_pause = [t for t, _ in request.sent if limited_at < t < limited_at + 1]
+        self.assertLessEqual(len(during_pause), 1)
+
+
+class PaymentConfirmationTests(SimpleTestCase):
+    """Подтверждение платежа, когда запись клиента исчезла между расчётом и чтением."""
+
+    def test_missing_client_is_reported_to_admin(self):
+        provision = mock.AsyncMock()
+        with mock.patch.object(repository, "mark_paid", mock.AsyncMock(return_value=SimpleNamespace(status=KEY_REQUIRED))), \
+                mock.patch.object(repository, "get_client", mock.AsyncMock(return_value=None)), \
+                mock.patch.object(admin_handlers, "provision_vpn_key", provision), \
+                self.assertLogs("bot.admin_handlers", "ERROR"):
+            result = asyncio.run(admin_handlers.confirm_payment(USER_ID, None))
+        self.assertEqual(result, (False, "Ошибка: клиент не найден."))
+        provision.assert_not_called()
+
+
+class MergeDuplicateClientsMigrationTests(TransactionTestCase):
+    """Миграция 0003 объединяет дубликаты клиентов и выводит vpn_id ключей удалённых записей."""
+
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([("bot", target)])
+        return executor.loader.project_state([("bot", target)]).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes("bot")[0][1])
+
+    def test_discarded_keys_are_logged(self):
+        Clients = self.migrate("0002_clients").get_model("bot", "Clients")
+        for i, (vpn_id, end) in enumerate((("kept", 10), ("stale", 5), ("", 1))):
+            Clients.objects.create(user_id=USER_ID, name=f"test{i}", vpn_id=vpn_id or None,
+                                   subscription_end_date=date.today() + timedelta(days=end))
+        with self.assertLogs("bot.migrations", "WARNING") as logs:
+            Clients = self.migrate("0003_merge_duplicate_clients").get_model("bot", "Clients")
+        self.assertEqual(list(Clients.objects.values_list("vpn_id", flat=True)), ["kept"])
+        self.assertIn("revoke_keys stale", logs.output[0])
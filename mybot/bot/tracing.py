@@ -0,0 +1,154 @@
+# tracing.py Трассировка обновлений: куда ушло время — БД, Bot API или Outline
+import cProfile
+import heapq
+import logging
+import os
+import random
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Optional
+from django.conf import settings
+from telegram import Update
+from telegram.ext import ContextTypes
+from bot.logs import bind_update_context, log_context
+from mybot.settings import ADMIN_IDS
+
+logger = logging.getLogger(__name__)
+# Медленные обновления пишутся этим логгером; configure_logging направляет его в TRACE_LOG_FILE
+trace_logger = logging.getLogger("bot.trace")
+
+SPAN_KINDS = ("db", "telegram", "outline")
+
+
+class Trace:
+    """Корневой span обновления и дочерние span'ы (вид, имя, начало от старта обновления, длительность)."""
+
+    __slots__ = ("update_id", "user_id", "handler", "started", "duration", "spans", "profile", "finished")
+
+    def __init__(self, update_id, user_id):
+        self.update_id = update_id
+        self.user_id = user_id
+        self.handler = None
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.spans = []
+        self.profile = None
+        self.finished = False
+
+    def breakdown(self) -> dict:
+        """Сумма времени и число вызовов по видам; параллельные вызовы суммируются, поэтому
+        сумма может превышать длительность обновления, а «other» — это остаток, не меньше нуля."""
+        totals = {kind: [0.0, 0] for kind in SPAN_KINDS}
+        for kind, _, _, elapsed in self.spans:
+            totals[kind][0] += elapsed
+            totals[kind][1] += 1
+        result = {kind: {"ms": round(total * 1000, 1), "calls": calls} for kind, (total, calls) in totals.items()}
+        result["other_ms"] = round(max(0.0, self.duration - sum(total for total, _ in totals.values())) * 1000, 1)
+        return result
+
+    def as_dict(self) -> dict:
+        return {
+            "update_id": self.update_id,
+            "user_id": self.user_id,
+            "handler": self.handler,
+            "duration_ms": round(self.duration * 1000, 1),
+            "breakdown": self.breakdown(),
+            "spans": [
+                {"kind": kind, "name": name, "at_ms": round(offset * 1000, 1), "ms": round(elapsed * 1000, 1)}
+                for kind, name, offset, elapsed in self.spans[:settings.TRACE_MAX_SPANS]
+            ],
+        }
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+# Последние завершённые трассы для /slow
+recent_traces = deque(maxlen=settings.TRACE_RECENT)
+_profiling = False
+
+
+def record_span(kind: str, name: str, started: float, elapsed: float) -> None:
+    """Добавляет дочерний span к трассе текущего обновления (started — time.perf_counter() начала вызова)."""
+    trace = current_trace.get()
+    if trace is not None and not trace.finished:
+        trace.spans.append((kind, name, started - trace.started, elapsed))
+
+
+async def trace_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    TypeHandler группы -1: задаёт поля лога обновления и открывает его трассу. Трассу закрывает
+    KeyedUpdateProcessor после всех обработчиков (finish_trace), в той же задаче asyncio.
+    """
+    global _profiling
+    await bind_update_context(update, context)
+    if not settings.TRACE_ENABLED:
+        return
+    user = update.effective_user
+    trace = Trace(update.update_id, user.id if user else None)
+    # cProfile один на поток и видит все задачи цикла событий, поэтому профилируем не больше одного обновления
+    if settings.TRACE_PROFILE_RATE and not _profiling and random.random() < settings.TRACE_PROFILE_RATE:
+        _profiling = True
+        trace.profile = cProfile.Profile()
+        trace.profile.enable()
+    current_trace.set(trace)
+
+
+def finish_trace() -> None:
+    global _profiling
+    trace = current_trace.get()
+    if trace is None or trace.finished:
+        return
+    trace.duration = time.perf_counter() - trace.started
+    trace.finished = True
+    trace.handler = (log_context.get() or {}).get("handler")
+    if trace.profile is not None:
+        trace.profile.disable()
+        _profiling = False
+    recent_traces.append(trace)
+    if trace.duration * 1000 < settings.TRACE_SLOW_MS:
+        trace.profile = None
+        return
+    entry = trace.as_dict()
+    if trace.profile is not None:
+        entry["profile"] = dump_profile(trace)
+    trace_logger.warning(
+        f"Медленное обновление {trace.update_id} ({trace.handler}): {entry['duration_ms']} мс", extra={"trace": entry}
+    )
+
+
+def dump_profile(trace: Trace) -> Optional[str]:
+    path = os.path.join(settings.TRACE_PROFILE_DIR, f"update-{trace.update_id}-{int(time.time())}.prof")
+    try:
+        os.makedirs(settings.TRACE_PROFILE_DIR, exist_ok=True)
+        trace.profile.dump_stats(path)
+    except OSError as e:
+        logger.error(f"Не удалось сохранить профиль обновления {trace.update_id}: {e}")
+        return None
+    finally:
+        trace.profile = None
+    return path
+
+
+def slowest(count: int) -> list:
+    return heapq.nlargest(count, recent_traces, key=lambda trace: trace.duration)
+
+
+def format_trace(trace: Trace) -> str:
+    parts = trace.breakdown()
+    times = ", ".join(f"{kind} {parts[kind]['ms']} мс ×{parts[kind]['calls']}" for kind in SPAN_KINDS)
+    return (f"• {trace.duration * 1000:.0f} мс — {trace.handler or '?'} (update {trace.update_id}, "
+            f"ID {trace.user_id}): {times}, прочее {parts['other_ms']} мс")
+
+
+async def slow_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/slow [N] — самые медленные из последних TRACE_RECENT обновлений с разбивкой времени."""
+    if update.message.from_user.id not in ADMIN_IDS:
+        return
+    count = int(context.args[0]) if context.args and context.args[0].isdigit() else 10
+    traces = slowest(min(count, 20))
+    if not traces:
+        await update.message.reply_text("Трасс пока нет.")
+        return
+    lines = [f"🐢 Самые медленные из последних {len(recent_traces)} обновлений:"]
+    lines += [format_trace(trace) for trace in traces]
+    await update.message.reply_text("\n".join(lines))
@@ -0,0 +1,143 @@
+# update_processor.py Параллельная обработка обновлений с порядком внутри пользователя и чата
+import asyncio
+import logging
+import time
+from collections import deque
+from django.conf import settings
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+from bot.metrics import begin_update, finish_update
+from bot.tracing import finish_trace
+
+logger = logging.getLogger(__name__)
+
+
+class _Ticket:
+    __slots__ = ("keys", "ready")
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.ready = asyncio.Event()
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает обновления разных пользователей параллельно, не более `concurrency` одновременно,
+    а обновления одного пользователя и одного чата — строго по очереди, в порядке поступления
+    (двойное нажатие «Я оплатил» или «Одобрить» выполнится последовательно).
+
+    При поступлении обновление сразу встаёт в очередь каждого своего ключа (user, chat) и
+    запускается, когда оказывается первым во всех этих очередях; только после этого оно занимает
+    один из `concurrency` слотов. Поэтому ожидающие своей очереди обновления одного пользователя
+    не занимают слоты и не задерживают остальных. Базовый семафор PTB ограничивает общее число
+    принятых в обработку обновлений (`max_pending`).
+    """
+
+    def __init__(self, concurrency=None, max_pending=None):
+        self.concurrency = concurrency or settings.UPDATE_CONCURRENCY
+        super().__init__(max(max_pending or settings.UPDATE_MAX_PENDING, self.concurrency))
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._queues = {}
+        self.waiting = 0
+        self.active = 0
+        self.processed = 0
+        self.max_key_depth = 0
+        self.key_wait_total = 0.0
+        self.key_wait_max = 0.0
+        self.slot_wait_total = 0.0
+        self.slot_wait_max = 0.0
+
+    @staticmethod
+    def keys_for(update) -> tuple:
+        if not isinstance(update, Update):
+            return ()
+        keys = set()
+        if update.effective_user:
+            keys.add(("user", update.effective_user.id))
+        if update.effective_chat:
+            keys.add(("chat", update.effective_chat.id))
+        return tuple(keys)
+
+    def _enqueue(self, ticket):
+        ready = True
+        for key in ticket.keys:
+            queue = self._queues.setdefault(key, deque())
+            queue.append(ticket)
+            ready = ready and len(queue) == 1
+            self.max_key_depth = max(self.max_key_depth, len(queue))
+        if ready:
+            ticket.ready.set()
+
+    def _release(self, ticket):
+        heads = []
+        for key in ticket.keys:
+            queue = self._queues[key]
+            queue.remove(ticket)
+            if queue:
+                heads.append(queue[0])
+            else:
+                del self._queues[key]
+        for head in heads:
+            if all(self._queues[key][0] is head for key in head.keys):
+                head.ready.set()
+
+    async def do_process_update(self, update, coroutine):
+        ticket = _Ticket(self.keys_for(update))
+        self._enqueue(ticket)
+        self.waiting += 1
+        started = False
+        arrived = time.perf_counter()
+        try:
+            await ticket.ready.wait()
+            queued = time.perf_counter()
+            async with self._slots:
+                running = time.perf_counter()
+                self.waiting -= 1
+                self.active += 1
+                started = True
+                self.key_wait_total += queued - arrived
+                self.key_wait_max = max(self.key_wait_max, queued - arrived)
+                self.slot_wait_total += running - queued
+                self.slot_wait_max = max(self.slot_wait_max, running - queued)
+                stats = begin_update()
+                try:
+                    await coroutine
+                finally:
+                    finish_update(stats)
+                    finish_trace()
+                    self.active -= 1
+                    self.processed += 1
+        finally:
+            if not started:
+                self.waiting -= 1
+                # Обработка отменена до запуска — закрываем корутину, чтобы не было предупреждения
+                coroutine.close()
+            self._release(ticket)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        logger.info(f"Обработка обновлений: {self.stats()}")
+
+    def stats(self) -> dict:
+        count = self.processed or 1
+        return {
+            "concurrency": self.concurrency,
+            "active": self.active,
+            "waiting": self.waiting,
+            "keys_queued": len(self._queues),
+            "max_key_depth": self.max_key_depth,
+            "processed": self.processed,
+            "key_wait_avg_ms": self.key_wait_total / count * 1000,
+            "key_wait_max_ms": self.key_wait_max * 1000,
+            "slot_wait_avg_ms": self.slot_wait_total / count * 1000,
+            "slot_wait_max_ms": self.slot_wait_max * 1000,
+        }
+
+
+async def log_update_stats(context):
+    """Задача JobQueue: периодически пишет в лог метрики обработки обновлений."""
+    processor = context.application.update_processor
+    if isinstance(processor, KeyedUpdateProcessor):
+        logger.info(f"Очередь обновлений: {context.application.update_queue.qsize()}, {processor.stats()}")
@@ -1,20 +1,34 @@
 # utils.py Вспомогательные функции
 import logging
-from functools import lru_cache
 from telegram.ext import ContextTypes
 from django.conf import settings
+from bot.cache import async_cached
 
 logger = logging.getLogger(__name__)
-CHANNEL_ID = settings.CHANNEL_ID
 
-@lru_cache(maxsize=1000)
+@async_cached(
+    settings.SUBSCRIPTION_CACHE_SIZE,
+    settings.SUBSCRIPTION_CACHE_TTL,
+    key=lambda user_id, context: user_id,
+    falsy_ttl=settings.SUBSCRIPTION_CACHE_MISS_TTL,
+)
+async def _channel_membership(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    chat_member = await context.bot.get_chat_member(chat_id=settings.CHANNEL_ID, user_id=user_id)
+    return chat_member.status in ["member", "administrator", "creator"]
+
+
 async def is_user_subscribed(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """
+    Подписан ли пользователь на CHANNEL_ID. Ответ кэшируется (отрицательный — ненадолго,
+    чтобы только что подписавшийся пользователь не ждал), ошибки Bot API не кэшируются.
+    При ошибке (Bot API недоступен, бот не администратор канала) пользователь пропускается:
+    сбой проверки не должен закрывать бота для всех.
+    """
     try:
-        chat_member = await context.bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        return chat_member.status in ["member", "administrator", "creator"]
+        return await _channel_membership(user_id, context)
     except Exception as e:
-        logger.error(f"Ошибка при проверке подписки: {e}")
-        return False
+        logger.error(f"Не удалось проверить подписку {user_id} на канал, пропускаем: {e}")
+        return True
 
 # Константы для состояний диалога
 GET_STATE_USER_REQUEST = 1
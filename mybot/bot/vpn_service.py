@@ -1,52 +1,212 @@
 # vpn_service.py Взаимодействие с API VPN-сервиса
+import asyncio
 import logging
+import random
+import time
 import httpx
-from asgiref.sync import sync_to_async
 from django.conf import settings
-from bot.models import Clients
+from bot.metrics import OUTLINE_LATENCY
+from bot.tracing import record_span
 
 logger = logging.getLogger(__name__)
-VPN_BASE_URL = settings.VPN_BASE_URL
 
-async def create_vpn_key(name: str, user_id: int) -> dict:
-    async with httpx.AsyncClient(verify=False) as client:
-        try:
-            post_response = await client.post(VPN_BASE_URL)
-            post_response.raise_for_status()
-            key_data = post_response.json()
-        except Exception as e:
-            logger.error(f"Ошибка при создании VPN-ключа (POST): {e}")
-            return {}
 
+class OutlineUnavailable(Exception):
+    """Сервер Outline не ответил или предохранитель разомкнут."""
+
+
+class CircuitBreaker:
+    """
+    После `threshold` неудачных вызовов подряд размыкается на `cooldown` секунд:
+    в это время вызовы сразу отклоняются, не дожидаясь таймаутов медленного сервера.
+    По истечении паузы пропускает ровно один пробный вызов (полуоткрытое состояние), остальные
+    по-прежнему отклоняются: успех пробы замыкает предохранитель, неудача размыкает его снова.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None and (self.probing or time.monotonic() - self.opened_at < self.cooldown)
+
+    def allow(self) -> bool:
+        """Можно ли обратиться к серверу; в полуоткрытом состоянии разрешает только пробу."""
+        if self.opened_at is None:
+            return True
+        if self.is_open:
+            return False
+        self.probing = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def release(self):
+        """Проба прервана без результата (например, отменена) — следующий вызов станет пробой."""
+        self.probing = False
+
+
+class OutlineClient:
+    """
+    Клиент Outline Management API с одним пулом keep-alive соединений на весь процесс.
+    Идемпотентные вызовы (PUT, DELETE, GET) повторяются с джиттером,
+    создание ключа (POST) — нет, чтобы не плодить лишние ключи.
+    """
+
+    def __init__(self, base_url: str = None, transport: httpx.AsyncBaseTransport = None):
+        self.base_url = base_url or settings.VPN_BASE_URL
+        self.retries = settings.OUTLINE_RETRIES
+        self.breaker = CircuitBreaker(settings.OUTLINE_BREAKER_THRESHOLD, settings.OUTLINE_BREAKER_COOLDOWN)
+        self._client = httpx.AsyncClient(
+            verify=False,
+            transport=transport,
+            limits=httpx.Limits(
+                max_connections=settings.OUTLINE_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.OUTLINE_MAX_KEEPALIVE,
+            ),
+            timeout=httpx.Timeout(settings.OUTLINE_TIMEOUT, connect=settings.OUTLINE_CONNECT_TIMEOUT),
+        )
+
+    async def _request(self, method: str, url: str, idempotent: bool, **kwargs) -> httpx.Response:
+        if not self.breaker.allow():
+            raise OutlineUnavailable("Outline API временно отключен после серии ошибок")
+        probe = self.breaker.probing
         try:
-            key_id = key_data.get("id")
-            if not key_id:
-                logger.error("Ошибка: key_id отсутствует в ответе API")
-                return {}
-            put_url = f"{VPN_BASE_URL}{key_id}/name"
-            put_response = await client.put(put_url, json={"name": name})
-            put_response.raise_for_status()
+            return await self._attempt(method, url, idempotent, **kwargs)
+        finally:
+            if probe and self.breaker.probing:
+                self.breaker.release()
+
+    async def _attempt(self, method: str, url: str, idempotent: bool, **kwargs) -> httpx.Response:
+        attempts = self.retries + 1 if idempotent else 1
+        for attempt in range(attempts):
+            started = time.perf_counter()
             try:
-                updated_data = put_response.json()
-                key_data.update(updated_data)
-            except Exception:
-                logger.warning("PUT запрос вернул пустой ответ, продолжаем с данными из POST запроса.")
-        except Exception as e:
-            logger.warning(f"Не удалось задать имя для ключа: {e}")
-
-        defaults = {
-            "name": key_data.get("name") or name,
-            "password": key_data.get("password", ""),
-            "port": key_data.get("port", 0),
-            "method": key_data.get("method", ""),
-            "access_url": key_data.get("accessUrl", ""),
-        }
-
-        # Обновляем или создаем запись по user_id
-        vpn_key, created = await sync_to_async(Clients.objects.update_or_create)(
-            user_id=user_id,
-            defaults={**defaults, "vpn_id": str(key_data.get("id"))}
-        )
-        logger.info(f"VPN-ключ сохранен: {vpn_key}")
+                response = await self._client.request(method, url, **kwargs)
+                elapsed = time.perf_counter() - started
+                OUTLINE_LATENCY.observe(elapsed, method, f"{response.status_code // 100}xx")
+                record_span("outline", f"{method} {response.status_code}", started, elapsed)
+                if response.status_code < 500:
+                    self.breaker.record_success()
+                    return response
+                error = httpx.HTTPStatusError(
+                    f"Outline API ответил {response.status_code}", request=response.request, response=response
+                )
+            except httpx.TransportError as e:
+                elapsed = time.perf_counter() - started
+                OUTLINE_LATENCY.observe(elapsed, method, type(e).__name__)
+                record_span("outline", f"{method} {type(e).__name__}", started, elapsed)
+                error = e
+            if attempt + 1 < attempts:
+                await asyncio.sleep(random.uniform(0, 0.2 * 2 ** attempt))
+
+        self.breaker.record_failure()
+        raise OutlineUnavailable(f"{method} {url}: {error}") from error
+
+    async def create_key(self) -> dict:
+        response = await self._request("POST", self.base_url, idempotent=False)
+        response.raise_for_status()
+        return response.json()
+
+    async def rename_key(self, key_id: str, name: str) -> None:
+        response = await self._request("PUT", f"{self.base_url}{key_id}/name", idempotent=True, json={"name": name})
+        response.raise_for_status()
+
+    async def delete_key(self, key_id: str) -> bool:
+        """Удаляет ключ. Уже удалённый ключ (404) тоже считается успехом."""
+        response = await self._request("DELETE", f"{self.base_url}{key_id}", idempotent=True)
+        if response.status_code == 404:
+            return True
+        response.raise_for_status()
+        return True
+
+    async def list_keys(self) -> list:
+        response = await self._request("GET", self.base_url, idempotent=True)
+        response.raise_for_status()
+        return response.json().get("accessKeys", [])
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+_outline_client = None
+
+
+def get_outline_client() -> OutlineClient:
+    """Общий для процесса клиент Outline (создаётся при первом обращении)."""
+    global _outline_client
+    if _outline_client is None:
+        _outline_client = OutlineClient()
+    return _outline_client
+
+
+async def close_outline_client(*args):
+    """Закрывает пул соединений; подходит для post_shutdown приложения."""
+    global _outline_client
+    if _outline_client is not None:
+        await _outline_client.aclose()
+        _outline_client = None
+
+
+async def revoke_keys(vpn_ids, concurrency: int = None) -> dict:
+    """
+    Параллельно удаляет ключи через общий пул соединений, не больше `concurrency` запросов одновременно.
+    Возвращает {vpn_id: True/False} — удалось ли отозвать каждый ключ.
+    """
+    outline = get_outline_client()
+    semaphore = asyncio.Semaphore(concurrency or settings.OUTLINE_REVOKE_CONCURRENCY)
+
+    async def revoke(vpn_id):
+        async with semaphore:
+            try:
+                return vpn_id, await outline.delete_key(vpn_id)
+            except Exception as e:
+                logger.error(f"Ошибка при отзыве VPN-ключа {vpn_id}: {e}")
+                return vpn_id, False
+
+    return dict(await asyncio.gather(*(revoke(vpn_id) for vpn_id in vpn_ids)))
+
+
+async def provision_vpn_key(name: str = None) -> dict:
+    """
+    Создаёт ключ на сервере Outline и задаёт ему имя (если оно передано), ничего не сохраняя в БД.
+    При ошибке возвращает {}.
+    """
+    outline = get_outline_client()
+    try:
+        key_data = await outline.create_key()
+    except Exception as e:
+        logger.error(f"Ошибка при создании VPN-ключа (POST): {e}")
+        return {}
+
+    key_id = key_data.get("id")
+    if not key_id:
+        logger.error("Ошибка: key_id отсутствует в ответе API")
+        return {}
+    if name:
+        await rename_vpn_key(key_id, name)
+        key_data["name"] = name
+    return key_data
+
+
+async def rename_vpn_key(key_id: str, name: str) -> bool:
+    try:
+        await get_outline_client().rename_key(key_id, name)
+        return True
+    except Exception as e:
+        logger.warning(f"Не удалось задать имя для ключа {key_id}: {e}")
+        return False
 
-        return key_data
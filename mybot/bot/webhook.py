@@ -0,0 +1,135 @@
+# webhook.py Приём обновлений Telegram через webhook (ASGI)
+import asyncio
+import hmac
+import json
+import logging
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookApp:
+    """
+    ASGI-приложение, принимающее обновления Telegram на WEBHOOK_PATH.
+
+    Запрос без правильного X-Telegram-Bot-Api-Secret-Token отклоняется (403), тело больше
+    WEBHOOK_MAX_BODY байт — 413. Без WEBHOOK_SECRET приложение не создаётся: иначе любой,
+    кто видит адрес, мог бы прислать обновление от имени администратора.
+    Обновление кладётся в ограниченную очередь application.update_queue; если она не
+    освободилась за WEBHOOK_ENQUEUE_TIMEOUT, отвечаем 503 и Telegram повторит доставку позже.
+    Остальные пути передаются в `fallback` (например, в Django), если он задан.
+    Через lifespan запускает и останавливает Application вместе с ASGI-сервером.
+    """
+
+    def __init__(self, application, fallback=None, path=None, secret=None, enqueue_timeout=None):
+        self.application = application
+        self.fallback = fallback
+        self.path = path or settings.WEBHOOK_PATH
+        self.secret = settings.WEBHOOK_SECRET if secret is None else secret
+        if not self.secret:
+            raise ImproperlyConfigured("Для режима webhook задайте WEBHOOK_SECRET")
+        self.enqueue_timeout = enqueue_timeout or settings.WEBHOOK_ENQUEUE_TIMEOUT
+        self.max_body = settings.WEBHOOK_MAX_BODY
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] == "http" and scope["path"] == self.path:
+            status = await self.receive_update(scope, receive)
+            return await self.respond(send, status)
+        if self.fallback is not None:
+            return await self.fallback(scope, receive, send)
+        await self.respond(send, 404)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.start()
+                except Exception as e:
+                    logger.exception("Не удалось запустить бота в режиме webhook")
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.stop()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def start(self):
+        application = self.application
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        if settings.WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=settings.WEBHOOK_URL,
+                secret_token=self.secret,
+                max_connections=settings.WEBHOOK_MAX_CONNECTIONS,
+            )
+        await application.start()
+
+    async def stop(self):
+        application = self.application
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+    async def receive_update(self, scope, receive) -> int:
+        if scope["method"] != "POST":
+            return 405
+        headers = dict(scope["headers"])
+        token = headers.get(b"x-telegram-bot-api-secret-token", b"")
+        if not hmac.compare_digest(token, self.secret.encode()):
+            return 403
+        try:
+            if int(headers.get(b"content-length", 0)) > self.max_body:
+                return 413
+        except ValueError:
+            return 400
+
+        body = bytearray()
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if len(body) > self.max_body:
+                return 413
+            if not message.get("more_body"):
+                break
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception:
+            logger.warning("Webhook: получено некорректное обновление")
+            return 400
+
+        try:
+            await asyncio.wait_for(self.application.update_queue.put(update), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Webhook: очередь обновлений заполнена, update {update.update_id} отклонён")
+            return 503
+        return 200
+
+    @staticmethod
+    async def respond(send, status: int):
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"text/plain")]})
+        await send({"type": "http.response.body", "body": b""})
+
+
+def serve_webhook(application):
+    """Запускает локальный HTTP-сервер webhook (uvicorn) для `runbot --webhook`."""
+    import uvicorn
+
+    uvicorn.run(
+        WebhookApp(application),
+        host=settings.WEBHOOK_LISTEN,
+        port=settings.WEBHOOK_PORT,
+        lifespan="on",
+        log_level="warning",
+    )
@@ -9,8 +9,19 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mybot.settings')
 
 application = get_asgi_application()
+
+# В режиме webhook бот принимает обновления на WEBHOOK_PATH, остальное обслуживает Django
+if settings.BOT_MODE == "webhook":
+    from bot.bot import build_application
+    from bot.logs import configure_logging
+    from bot.webhook import WebhookApp
+
+    # Как в bot.main: очередь логов и контекст обновления до сборки приложения
+    configure_logging()
+    application = WebhookApp(build_application(), fallback=application)
@@ -26,6 +26,140 @@ ADMIN_IDS = list(map(int, os.getenv("ADMIN_IDS").split(",")))
 CHANNEL_ID = os.getenv("CHANNEL_ID")
 YOUR_CHAT_ID = list(map(int, os.getenv("YOUR_CHAT_ID").split(",")))
 VPN_BASE_URL = os.getenv("VPN_BASE_URL")
+# Адрес Bot API: можно направить бота на локальный telegram-bot-api или поддельный сервер нагрузочного теста
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL", "https://api.telegram.org/bot")
+
+# Массовая рассылка: Bot API допускает ~30 сообщений в секунду на бота
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", 3))
+
+# Outbox: сообщения пользователям доставляются фоновым воркером. Общий лимит OUTBOX_RATE в секунду,
+# на чат — OUTBOX_CHAT_RATE со всплеском до OUTBOX_CHAT_BURST; после OUTBOX_MAX_ATTEMPTS неудач — dead
+OUTBOX_RATE = float(os.getenv("OUTBOX_RATE", 25))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", 1))
+OUTBOX_CHAT_BURST = float(os.getenv("OUTBOX_CHAT_BURST", 3))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 100))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 8))
+# Сколько секунд забранная порция недоступна другим воркерам; после падения процесса она доставится снова
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", 60))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 5))
+# Сколько дней хранить отправленные сообщения и сообщения со статусом dead (для разбора)
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", 7))
+OUTBOX_DEAD_RETENTION_DAYS = int(os.getenv("OUTBOX_DEAD_RETENTION_DAYS", 30))
+
+# Уведомления администраторам: больше ADMIN_DIGEST_THRESHOLD в минуту — вместо отдельных сообщений
+# раз в ADMIN_DIGEST_INTERVAL секунд отправляется сводка по ADMIN_DIGEST_PAGE_SIZE записей на странице
+ADMIN_DIGEST_THRESHOLD = int(os.getenv("ADMIN_DIGEST_THRESHOLD", 20))
+ADMIN_DIGEST_INTERVAL = int(os.getenv("ADMIN_DIGEST_INTERVAL", 60))
+ADMIN_DIGEST_PAGE_SIZE = int(os.getenv("ADMIN_DIGEST_PAGE_SIZE", 8))
+
+# Команда /queue: записей на странице и сколько секунд кэшировать счётчики
+QUEUE_PAGE_SIZE = int(os.getenv("QUEUE_PAGE_SIZE", 5))
+QUEUE_TOTALS_TTL = float(os.getenv("QUEUE_TOTALS_TTL", 5))
+
+# Пул соединений и устойчивость клиента Outline API
+OUTLINE_MAX_CONNECTIONS = int(os.getenv("OUTLINE_MAX_CONNECTIONS", 20))
+OUTLINE_MAX_KEEPALIVE = int(os.getenv("OUTLINE_MAX_KEEPALIVE", 10))
+OUTLINE_TIMEOUT = float(os.getenv("OUTLINE_TIMEOUT", 10))
+OUTLINE_CONNECT_TIMEOUT = float(os.getenv("OUTLINE_CONNECT_TIMEOUT", 5))
+OUTLINE_RETRIES = int(os.getenv("OUTLINE_RETRIES", 2))
+OUTLINE_BREAKER_THRESHOLD = int(os.getenv("OUTLINE_BREAKER_THRESHOLD", 5))
+OUTLINE_BREAKER_COOLDOWN = float(os.getenv("OUTLINE_BREAKER_COOLDOWN", 30))
+OUTLINE_REVOKE_CONCURRENCY = int(os.getenv("OUTLINE_REVOKE_CONCURRENCY", 10))
+
+# Пул заранее созданных ключей: пополняется до HIGH, когда свободных меньше LOW (0 — пул выключен)
+KEY_POOL_LOW = int(os.getenv("KEY_POOL_LOW", 5))
+KEY_POOL_HIGH = int(os.getenv("KEY_POOL_HIGH", 20))
+KEY_POOL_REFILL_INTERVAL = int(os.getenv("KEY_POOL_REFILL_INTERVAL", 60))
+
+# Режим получения обновлений: "polling" или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес, который регистрируется в Telegram
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook/")
+# Обязателен в режиме webhook: Telegram присылает его в X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+# Очередь входящих обновлений и сколько ждать места в ней, прежде чем ответить 503
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", 1))
+# Предельный размер тела запроса webhook, байт (обновления Telegram — единицы килобайт)
+WEBHOOK_MAX_BODY = int(os.getenv("WEBHOOK_MAX_BODY", 256 * 1024))
+
+# Хранение состояния диалогов в БД (bot.persistence.DjangoPersistence); по умолчанию выключено
+PERSISTENCE_ENABLED = os.getenv("PERSISTENCE_ENABLED", "0") == "1"
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", 5))
+PERSISTENCE_FLUSH_DELAY = float(os.getenv("PERSISTENCE_FLUSH_DELAY", 0.5))
+# Несколько процессов с одной БД: перечитывать user_data/chat_data и состояние диалога перед каждым
+# обновлением и записывать изменения сразу после него
+PERSISTENCE_REFRESH = os.getenv("PERSISTENCE_REFRESH", "0") == "1"
+
+# Размер порции клиентов в ежедневной проверке подписок
+SWEEP_CHUNK_SIZE = int(os.getenv("SWEEP_CHUNK_SIZE", 500))
+
+# Планировщик подписок в процессе бота (bot.scheduler): напоминание накануне окончания между
+# EXPIRY_REMIND_FROM и EXPIRY_REMIND_TO часами (UTC), отключение в начале дня окончания со сдвигом
+# до EXPIRY_REVOKE_SPREAD секунд. В памяти — подписки на EXPIRY_HORIZON_DAYS дней вперёд,
+# перечитываются раз в EXPIRY_RELOAD_INTERVAL секунд. EXPIRY_SCHEDULER=0 — вернуть ежедневный cron
+EXPIRY_SCHEDULER = os.getenv("EXPIRY_SCHEDULER", "1") == "1"
+EXPIRY_REMIND_FROM = int(os.getenv("EXPIRY_REMIND_FROM", 10))
+EXPIRY_REMIND_TO = int(os.getenv("EXPIRY_REMIND_TO", 20))
+EXPIRY_REVOKE_SPREAD = float(os.getenv("EXPIRY_REVOKE_SPREAD", 3600))
+EXPIRY_HORIZON_DAYS = int(os.getenv("EXPIRY_HORIZON_DAYS", 2))
+EXPIRY_RELOAD_INTERVAL = float(os.getenv("EXPIRY_RELOAD_INTERVAL", 6 * 3600))
+EXPIRY_BATCH_SIZE = int(os.getenv("EXPIRY_BATCH_SIZE", 50))
+EXPIRY_RETRY_DELAY = float(os.getenv("EXPIRY_RETRY_DELAY", 600))
+
+# Кэш записей клиентов в памяти процесса бота
+CLIENT_CACHE_SIZE = int(os.getenv("CLIENT_CACHE_SIZE", 10000))
+CLIENT_CACHE_TTL = float(os.getenv("CLIENT_CACHE_TTL", 60))
+
+# Лог бота: JSON-строки, запись в файл в фоновом потоке, ротация по размеру и по времени
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_ROTATE_INTERVAL = int(os.getenv("LOG_ROTATE_INTERVAL", 24 * 60 * 60))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 7))
+
+# Метрики Prometheus на локальном порту (0 — не поднимать эндпоинт); итоги check_subscriptions
+# пишутся в METRICS_SWEEP_FILE и отдаются тем же эндпоинтом
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+METRICS_SWEEP_FILE = os.getenv(
+    "METRICS_SWEEP_FILE", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sweep.prom")
+)
+METRICS_EXTRA_FILES = [METRICS_SWEEP_FILE] if METRICS_SWEEP_FILE else []
+
+# Трассировка обновлений: разбивка времени по БД, Bot API и Outline; обновления дольше TRACE_SLOW_MS
+# пишутся в TRACE_LOG_FILE, доля TRACE_PROFILE_RATE профилируется cProfile (файлы в TRACE_PROFILE_DIR)
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") == "1"
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", 1000))
+TRACE_LOG_FILE = os.getenv("TRACE_LOG_FILE", "trace.log")
+TRACE_RECENT = int(os.getenv("TRACE_RECENT", 500))
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", 50))
+TRACE_PROFILE_RATE = float(os.getenv("TRACE_PROFILE_RATE", 0))
+TRACE_PROFILE_DIR = os.getenv("TRACE_PROFILE_DIR", "profiles")
+
+# Доступ к боту только для подписчиков CHANNEL_ID; результат проверки кэшируется.
+# Без CHANNEL_ID проверка выключена
+CHANNEL_GATE = os.getenv("CHANNEL_GATE", "1") == "1" and bool(CHANNEL_ID)
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", 10000))
+SUBSCRIPTION_CACHE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_TTL", 600))
+# «Не подписан» помним недолго: пользователь может подписаться и сразу нажать /start
+SUBSCRIPTION_CACHE_MISS_TTL = float(os.getenv("SUBSCRIPTION_CACHE_MISS_TTL", 15))
+
+# Потоки для запросов к БД из асинхронного кода бота (bot.repository)
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", 8))
+
+# Параллельная обработка обновлений: разные пользователи одновременно, один пользователь — по порядку
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 16))
+# Сколько обновлений может одновременно ждать своей очереди
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", 1000))
+# Как часто писать в лог метрики обработки обновлений, сек (0 — не писать)
+UPDATE_STATS_INTERVAL = int(os.getenv("UPDATE_STATS_INTERVAL", 300))
 
 
 
@@ -47,7 +181,8 @@ DEBUG = True
 ALLOWED_HOSTS = []
 
 
-CRONJOBS = [
+# Ежедневная проверка подписок нужна, только если планировщик в процессе бота выключен
+CRONJOBS = [] if EXPIRY_SCHEDULER else [
     ('0 8 * * *', 'django.core.management.call_command', ['check_subscriptions']),
 ]
 
@@ -100,19 +235,41 @@ WSGI_APPLICATION = 'mybot.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.mysql',
-        'NAME': os.getenv("DB_NAME"),         # 'telegram_bot'
-        'USER': os.getenv("DB_USER"),         # 'ArtBasilioBot'
-        'PASSWORD': os.getenv("DB_PASSWORD"), # 'pP92u1RTz!!mfiTzS5t'
-        'HOST': '',                         # Оставляем пустым
-        'PORT': '',                         # Оставляем пустым
-        'OPTIONS': {
-            'unix_socket': '/tmp/mysql.sock',  # Путь к Unix-сокету
-        },
+# DB_ENGINE=sqlite — локальная проверка без MySQL
+DB_ENGINE = os.getenv("DB_ENGINE", "mysql")
+# Время жизни постоянного соединения, сек; должно быть меньше wait_timeout MySQL
+DB_CONN_MAX_AGE = int(os.getenv("DB_CONN_MAX_AGE", 300))
+
+if DB_ENGINE == "sqlite":
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv("DB_NAME") or BASE_DIR / 'db.sqlite3',
+            # Ждём блокировку вместо ошибки «database is locked» при параллельной записи из пула потоков
+            'OPTIONS': {'timeout': 20, 'transaction_mode': 'IMMEDIATE'},
+            # Тестовая БД — файл: общая in-memory БД sqlite не ждёт блокировок, а тесты пишут из потоков пула
+            'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.mysql',
+            'NAME': os.getenv("DB_NAME"),         # 'telegram_bot'
+            'USER': os.getenv("DB_USER"),         # 'ArtBasilioBot'
+            'PASSWORD': os.getenv("DB_PASSWORD"), # 'pP92u1RTz!!mfiTzS5t'
+            'HOST': '',                         # Оставляем пустым
+            'PORT': '',                         # Оставляем пустым
+            'OPTIONS': {
+                'unix_socket': os.getenv("DB_SOCKET", '/tmp/mysql.sock'),  # Путь к Unix-сокету
+            },
+            # Соединение переиспользуется до DB_CONN_MAX_AGE секунд и проверяется перед повторным использованием
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+        }
     }
-}
 
 
 